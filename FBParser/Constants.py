@@ -8,22 +8,64 @@ __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 
 __all__ = [
             'INDENT_WIDTH',
+            'TOKEN_TEXT', 'TOKEN_OPEN', 'TOKEN_CLOSE', 'TOKEN_EMPTY',
             'MODE_MONO', 'MODE_BABBLE',
-            'PIPE_FIELDS',
+            'REF_CSS_HTML', 'REF_CSS_JSON', 'REF_JS_HTML', 'REF_JS_JSON',
+            'REF_IMG_HTML', 'REF_SEARCH', 'REF_ICON', 'REF_IFRAME',
+            'REF_NOSCRIPT', 'REF_HREF', 'REF_KINDS',
+            'PIPE_FIELDS', 'PIPE_KEYS',
+            'JSON_ESCAPES', 'JSON_UNESCAPES',
             'EMPTY_ELEMENTS', 'HTML_ELEMENTS', 'EXEMPTED_TAGS',
           ]
 
 INDENT_WIDTH = 2
 
+# kinds of tokens yielded by FBParser.dom.tokenize
+TOKEN_TEXT = 0  # content between tags
+TOKEN_OPEN = 1  # opening tag, to be paired
+TOKEN_CLOSE = 2  # closing tag
+TOKEN_EMPTY = 3  # tag of an empty element (see EMPTY_ELEMENTS)
+
 # how to anonymize characters
 MODE_MONO = 0
 MODE_BABBLE = 1
 
+# kinds of resource references found by FBParser.scan.scan_resources
+REF_CSS_HTML = 0  # <link href="...css">
+REF_CSS_JSON = 1  # "src":"...css"
+REF_JS_HTML = 2  # <script ...>...</script>, with or without a src
+REF_JS_JSON = 3  # "src":"...js"
+REF_IMG_HTML = 4  # <img src="...">
+REF_SEARCH = 5  # <link rel="search" ...>
+REF_ICON = 6  # <link rel="shortcut icon" ...>
+REF_IFRAME = 7  # <iframe src="...html"
+REF_NOSCRIPT = 8  # <noscript>...content="..."...</noscript>
+REF_HREF = 9  # href="http://..."
+REF_KINDS = range(10)
+
 # list
 PIPE_FIELDS = ('id', 'phase', 'last', 'append', 'dep', 'boot',
                'css', 'js', 'rscmap', 'require', 'provide',
                'oncache', 'onaftercache', 'refresh', 'invalidate',
                'content', 'cache')
+# JSON key in big pipes -> name of the field (as in PIPE_FIELDS)
+PIPE_KEYS = {
+             'id': 'id', 'phase': 'phase', 'is_last': 'last',
+             'append': 'append', 'display_dependency': 'dep',
+             'bootloadable': 'boot', 'css': 'css', 'js': 'js',
+             'resource_map': 'rscmap', 'requires': 'require',
+             'provides': 'provide', 'onload': 'onload',
+             'onafterload': 'onafterload', 'onpagecache': 'oncache',
+             'onafterpagecache': 'onaftercache',
+             'refresh_pagelets': 'refresh', 'invalidate_cache': 'invalidate',
+             'content': 'content', 'page_cache': 'cache',
+            }
+
+# chars escaped by FBParser.jsonify, backslash first
+JSON_ESCAPES = (('\\', '\\\\'), ('/', '\\/'), ("'", "\\'"), ('"', '\\"'),
+                ('\r', '\\r'), ('\n', '\\n'))
+# char following a backslash -> char it stands for, see FBParser.dejsonify
+JSON_UNESCAPES = dict((escape[1], char) for char, escape in JSON_ESCAPES)
 
 EMPTY_ELEMENTS = [
                   'area', 'base', 'basefont', 'br', 'col', 'frame', 'wbr',
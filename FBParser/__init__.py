@@ -7,23 +7,36 @@ to get DOM & CSS characteristics.
 __author__ = 'Yao Yue (yueyao@facebook.com)'
 
 __all__ = [
-            'css', 'dom', 'js', 'img', 'garble_image',
+            'css', 'dom', 'js', 'img', 'garble_image', 'fetch', 'cache',
+            'archive', 'match',
+            'stages', 'timing', 'synth', 'graph', 'bigpipe', 'scan', 'serve',
             'Constants',
-            'get_content', 'save_content',
+            'get_content', 'save_content', 'read_chunks', 'save_chunks',
+            'map_content',
             'url_to_file', 'save_resource',
-            'del_blockcomment',
-            'jsonify', 'dejsonify',
+            'del_blockcomment', 'splice', 'EditBuffer', 'Memo',
+            'stream_sub', 'stream_del_blockcomment',
+            'jsonify', 'dejsonify', 'stream_jsonify', 'stream_dejsonify',
           ]
 
 #
 # Imports
 #
-from FBParser.regexp import re_doctype, re_blockcomment
+from FBParser.regexp import re_doctype, re_blockcomment, re_json_escape
+from FBParser.Constants import JSON_ESCAPES, JSON_UNESCAPES
+from FBParser.fetch import Fetcher, retrieve_cached
+from FBParser.cache import temp_file
 # external imports
 import sys
 import codecs
 import os.path
-from urllib import urlretrieve
+import mmap
+import httplib
+from itertools import chain
+from bisect import bisect_right
+
+CHUNK_SIZE = 1 << 16  # of streamed content
+WRITE_BUFFER_SIZE = 1 << 20  # of files written
 
 #
 # APIs, common
@@ -57,87 +70,427 @@ def del_blockcomment(s):
     return  s[:start] + re_blockcomment.sub("", s[start:])
 
 
+# @param s(str)  string to be worked on
+# @param head(str)  what every match starts with
+# @param tail(str)  what every match ends with, at its first occurrence
+# @return (int)  a position in s that no match can run across, whatever
+#                follows s
+def _safe_cut(s, head, tail):
+  limit = max(0, len(s) - len(head) + 1)  # a head may be cut by the end
+  spans = []
+  start = s.find(head)
+  while 0 <= start < limit:
+    end = s.find(tail, start + len(head))
+    spans.append((start, end + len(tail) if end >= 0 else len(s) + 1))
+    start = s.find(head, start + 1)
+  cut = limit
+  for start, end in reversed(spans):
+    if start < cut < end:
+      cut = start
+  return cut
+
+
+# @param chunks(iterable)  strings to be worked on, in chunks of any size
+# @param regexp(RegexObject)  pattern to be replaced
+# @param repl(str)  replacement
+# @param head(str)  what every match of regexp starts with
+# @param tail(str)  what every match of regexp ends with, at the first
+#                   occurrence after head (i.e. regexp is lazy on it)
+# @return (generator)  chunks of regexp.sub(repl, ''.join(chunks))
+def stream_sub(chunks, regexp, repl, head, tail):
+  '''
+  Substitute a regular expression in a stream of chunks.
+  Text is held back only from the first possible match that is not complete
+  yet, so that every match is seen whole.
+  '''
+  rest = ''
+  for chunk in chunks:
+    rest += chunk
+    cut = _safe_cut(rest, head, tail)
+    if cut:
+      yield regexp.sub(repl, rest[:cut])
+      rest = rest[cut:]
+  if rest:
+    yield regexp.sub(repl, rest)
+
+
+# @param chunks(iterable)  strings to be worked on, in chunks of any size
+# @return (generator)  chunks with block comments removed
+def stream_del_blockcomment(chunks):
+  '''
+  Same as del_blockcomment, on a stream. The DOCTYPE info, if any, is
+  expected in the first chunk.
+  '''
+  chunks = iter(chunks)
+  first = next(chunks, '')
+  m_doctype = re_doctype.match(first)
+  if m_doctype:
+    yield m_doctype.group(0)
+    first = first[m_doctype.end():]
+  for chunk in stream_sub(chain([first], chunks), re_blockcomment, '',
+                          '/*', '*/'):
+    yield chunk
+
+
+# @param s(str)  string to be worked on
+# @param edits(list)  (start, end, replacement) tuples, ordered by start and
+#                     not overlapping
+# @param start=0(int)  start of the part of s to be returned
+# @param end=None(int)  end of the part of s to be returned, default to len(s)
+# @return (str)  the string (part) with all replacements applied
+def splice(s, edits, start=0, end=None):
+  '''
+  Replace a list of spans of the string in one linear pass, rather than
+  copying the whole string once per replacement.
+  '''
+  pieces = []
+  pos = start
+  for edit_start, edit_end, replacement in edits:
+    pieces.append(s[pos:edit_start])
+    pieces.append(replacement)
+    pos = edit_end
+  pieces.append(s[pos:end])
+  return ''.join(pieces)
+
+
+class EditBuffer(object):
+  '''
+  Replacements of spans of a string, all given against the offsets of the
+  original string and applied together by one splice.
+  Usage:
+    buffer = EditBuffer(dom)
+    for m in regexp.finditer(dom):
+      buffer.replace(m.start('url'), m.end('url'), local_file)
+    dom = buffer.apply()
+  Edits must not overlap: an edit is refused (ValueError) if it runs into
+  one already recorded, or sits at the very same place, so that no edit
+  lands on text another one has changed.
+  '''
+
+  # @param s(str)  the original string
+  def __init__(self, s):
+    self.s = s
+    self.starts = []  # of the edits, sorted
+    self.edits = []  # (start, end, replacement), in the order of starts
+
+  # @param start(int)  start of a span of the original string
+  # @param end(int)  end of the span
+  # @return (int)  index the span would be recorded at, -1 if it overlaps an
+  #                edit already recorded
+  def _slot(self, start, end):
+    idx = bisect_right(self.starts, start)
+    if idx > 0:
+      prev_start, prev_end, replacement = self.edits[idx - 1]
+      if start < prev_end or (prev_start, prev_end) == (start, end):
+        return -1
+    if idx < len(self.edits) and self.edits[idx][0] < end:
+      return -1
+    return idx
+
+  # @param start(int)  start of a span of the original string
+  # @param end(int)  end of the span
+  # @return (Boolean)  whether the span overlaps an edit already recorded
+  def overlaps(self, start, end):
+    return self._slot(start, end) < 0
+
+  # @param start(int)  start of the span to be replaced
+  # @param end(int)  end of the span, start for an insertion
+  # @param replacement(str)  new text of the span
+  def replace(self, start, end, replacement):
+    if not 0 <= start <= end <= len(self.s):
+      raise ValueError('edit out of bounds: {start}-{end}'.format(
+        start=start, end=end))
+    idx = self._slot(start, end)
+    if idx < 0:
+      raise ValueError('overlapping edit: {start}-{end}'.format(
+        start=start, end=end))
+    self.starts.insert(idx, start)
+    self.edits.insert(idx, (start, end, replacement))
+
+  # @param edits(list)  (start, end, replacement) tuples, e.g. as returned
+  #                     by the localizers
+  def extend(self, edits):
+    for start, end, replacement in edits:
+      self.replace(start, end, replacement)
+
+  # @param start(int)  start of the span to be deleted
+  # @param end(int)  end of the span
+  def delete(self, start, end):
+    self.replace(start, end, '')
+
+  # @param old(str)  text to be replaced, wherever it is in the original
+  # @param new(str)  replacement
+  # @return (int)  number of occurrences replaced
+  def replace_all(self, old, new):
+    '''
+    Same as str.replace, on the original string: occurrences are found from
+    left to right, without overlapping each other. Occurrences in text that
+    an edit already changes are left to that edit.
+    '''
+    count = 0
+    pos = self.s.find(old) if old else -1
+    while pos >= 0:
+      if not self.overlaps(pos, pos + len(old)):
+        self.replace(pos, pos + len(old), new)
+        count += 1
+      pos = self.s.find(old, pos + len(old))
+    return count
+
+  def __len__(self):
+    return len(self.edits)
+
+  # @return (str)  the original string with every edit applied
+  def apply(self):
+    return splice(self.s, self.edits)
+
+
+class Memo(object):
+  '''
+  Bounded memo of results, forgetting the least recently used keys first.
+  Keys live in two generations: a lookup promotes a key to the recent one,
+  and once the recent generation is full the old one is dropped as a whole.
+  Every key used within the last `size` insertions is kept, at the cost of
+  plain dict operations.
+  Usage:
+    memo = Memo(1024)
+    value = memo.get(key)
+    if value is None:
+      value = memo[key] = compute(key)
+  '''
+
+  # @param size(int)  number of keys kept in each generation
+  def __init__(self, size):
+    self.size = size
+    self.recent = {}
+    self.old = {}
+
+  # @param key  a hashable key
+  # @return  the memoized value, None if the key is unknown
+  def get(self, key):
+    value = self.recent.get(key)
+    if value is None:
+      value = self.old.get(key)
+      if value is not None:
+        self[key] = value
+    return value
+
+  def __setitem__(self, key, value):
+    if len(self.recent) >= self.size:
+      self.old = self.recent
+      self.recent = {}
+    self.recent[key] = value
+
+  def __len__(self):
+    return len(self.recent) + len(self.old)
+
+  def clear(self):
+    self.recent = {}
+    self.old = {}
+
+
 # @param s(str)  string to be JSON-ified
 # @return (str)  JSON-ifyed string
 def jsonify(s):
   '''
-  Add backslash to escape characters.
+  Add backslash to escape characters (see JSON_ESCAPES).
+  Each char is escaped on its own, backslash first, so a replace per char
+  gives the same result as one pass; it is faster too, as every pass is
+  run by str.replace rather than by a callback for each escape.
   '''
-  s = s.replace("\\", "\\\\")
-  s = s.replace("/", "\\/")
-  s = s.replace("'", "\\'")
-  s = s.replace('"', '\\"')
-  s = s.replace('\r', '\\r')
-  s = s.replace('\n', '\\n')
+  for char, escape in JSON_ESCAPES:
+    s = s.replace(char, escape)
   return s
 
 
-# @param s(str)  string to be JSON-ified
-# @return (String)  JSON-ifyed string
+# @param s(str)  JSON-ified string
+# @return (String)  the string before jsonify
 def dejsonify(s):
   '''
-  Remove backslash from escape characters.
+  Remove backslash from escape characters, in one pass: an escaped
+  backslash is not taken to escape the char after it, so that
+  dejsonify(jsonify(s)) == s. Other backslashes are left alone.
   '''
-  s = s.replace("\\\\", "\\")
-  s = s.replace("\\/", "/")
-  s = s.replace("\\'", "'")
-  s = s.replace('\\"', '"')
-  s = s.replace('\\r', '\r')
-  s = s.replace('\\n', '\n')
-  return s
+  if '\\' not in s:
+    return s
+  parts = re_json_escape.split(s)
+  parts[1::2] = map(JSON_UNESCAPES.__getitem__, parts[1::2])
+  return ''.join(parts)
+
+
+# @param chunks(iterable)  strings to be JSON-ified, in chunks of any size
+# @return (generator)  chunks of jsonify(''.join(chunks))
+def stream_jsonify(chunks):
+  '''
+  Same as jsonify, on a stream: chars are escaped one by one, so chunks
+  are escaped as they come, without being joined first.
+  '''
+  for chunk in chunks:
+    yield jsonify(chunk)
+
+
+# @param chunks(iterable)  JSON-ified strings, in chunks of any size
+# @return (generator)  chunks of dejsonify(''.join(chunks))
+def stream_dejsonify(chunks):
+  '''
+  Same as dejsonify, on a stream. A chunk ending with an odd number of
+  backslashes has the last one held back, as it escapes the next char.
+  '''
+  rest = ''
+  for chunk in chunks:
+    rest += chunk
+    cut = len(rest)
+    if (cut - len(rest.rstrip('\\'))) % 2:
+      cut -= 1
+    if cut:
+      yield dejsonify(rest[:cut])
+      rest = rest[cut:]
+  if rest:
+    yield dejsonify(rest)
 
 
 # @param filename(str)  name of the file whose content we want
-# @param encoding='utf-8'(str)  encoding used by the file
+# @return (str)  the content as bytes: a read-only mmap of the file, or a
+#                plain string if the file is empty or cannot be mapped
+def map_content(filename):
+  '''
+  Map the file in memory, without decoding it. Regular expressions run on
+  the mapping as they do on a string, and slicing it copies only the slice.
+  The caller closes the mapping once done with it.
+  '''
+  f = open(filename, 'rb')
+  try:
+    try:
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):  # empty, a pipe, ...
+      return f.read()
+  finally:
+    f.close()
+
+
+# @param filename(str)  name of the file whose content we want
+# @param encoding='utf-8'(str)  encoding used by the file, None for bytes
 # @return (str)  the content as a string
 def get_content(filename, encoding='utf-8'):
   '''
   Fetch the content of the file and return it as a string.
+  The file is decoded in one go, straight from its mapping in memory, so
+  that the decoded string is the only copy of the content held.
+  '''
+  try:
+    data = map_content(filename)
+  except EnvironmentError, err:
+    print >> sys.stderr, err
+    return ''
+  try:
+    if encoding is None:
+      return data[:]
+    return codecs.lookup(encoding).decode(data)[0]
+  finally:
+    if isinstance(data, mmap.mmap):
+      data.close()
+
+
+# @param filename(str)  name of the file whose content we want
+# @param encoding='utf-8'(str)  encoding used by the file
+# @param size=CHUNK_SIZE(int)  (approximate) size of the chunks
+# @return (generator)  the content in chunks
+def read_chunks(filename, encoding='utf-8', size=CHUNK_SIZE):
+  '''
+  Read the content of the file chunk by chunk, to be streamed.
   '''
   try:
     f = codecs.open(filename, 'r', encoding)
-    s = ''.join(f.readlines())
-    f.close()
   except IOError, err:
     print >> sys.stderr, err
-    s = ''
-  return s
+    return
+  try:
+    chunk = f.read(size)
+    while chunk:
+      yield chunk
+      chunk = f.read(size)
+  finally:
+    f.close()
 
 
-# @param s(str)  content
+# @param chunks(iterable)  content, in chunks
 # @param filename(str)  name of the file to keep the content
 # @param mode='w'(str)  mode used to open the file
 # @param encoding='utf-8'(str)  encoding used for the file
+# @param atomic=False(Boolean)  whether to write to a temporary file, renamed
+#                               to filename once complete (mode 'w' only)
 # @return (Boolean)  success (or not)
-def save_content(s, filename, mode='w', encoding='utf-8'):
+def save_chunks(chunks, filename, mode='w', encoding='utf-8', atomic=False):
   '''
-  Save the content to a file.
+  Save a stream of content to a file, writing chunks as they come.
+  Chunks are encoded as they come and written through a large buffer.
+  See save_content.
   '''
+  atomic = atomic and mode[0] == 'w'
+  tmp = None  # written, then renamed to filename if atomic
   try:
-    f = codecs.open(filename, mode, encoding)
-    f.write(s)
-    f.close()
-  except IOError, err:
+    if atomic:
+      tmp = temp_file(os.path.dirname(filename) or '.')
+    elif mode[0] == 'w' and os.path.isfile(filename):
+      os.remove(filename)
+    encoder = codecs.getincrementalencoder(encoding)()
+    f = open(tmp or filename, mode.replace('b', '') + 'b', WRITE_BUFFER_SIZE)
+    try:
+      for chunk in chunks:
+        f.write(encoder.encode(chunk))
+      f.write(encoder.encode(u'', True))
+    finally:
+      f.close()
+    if atomic:
+      os.rename(tmp, filename)
+      tmp = None
+  except EnvironmentError, err:
     print >> sys.stderr, err
     return False
+  finally:
+    if tmp is not None and os.path.isfile(tmp):  # left over by a failure
+      os.remove(tmp)
   return True
 
 
+# @param s(str)  content
+# @param filename(str)  name of the file to keep the content
+# @param mode='w'(str)  mode used to open the file
+# @param encoding='utf-8'(str)  encoding used for the file
+# @param atomic=False(Boolean)  whether to replace the file only once the
+#                               content is all written, see save_chunks
+# @return (Boolean)  success (or not)
+def save_content(s, filename, mode='w', encoding='utf-8', atomic=False):
+  '''
+  Save the content to a file.
+  An existing file is replaced rather than rewritten, as it may be a
+  hardlink to a blob of the resource cache.
+  '''
+  return save_chunks([s], filename, mode, encoding, atomic)
+
+
 # @param url(str)  complete url of the external resource
 # @param dir(str)  Directory where the file should be saved
 # @param file(str)  Name of the file to be saved. Note: we can but don't infer
 #                   from url for sublties/variances in url encoding
+# @param fetcher=None(Fetcher)  if given, only schedule the retrieval on it;
+#                               the caller must call fetcher.wait() before
+#                               using the file
 # @return (Boolean)  success (or not)
-def save_resource(url, dir, file):
+def save_resource(url, dir, file, fetcher=None):
   '''
-  Retrieve resource (url) and save it to file in the given directory.
+  Retrieve resource (url) and save it to file in the given directory,
+  going through the resource archive (FBParser.archive) and the resource
+  cache (FBParser.cache) if they are in use and url is http(s).
   If the retrieval fails, the url and filename are appended to a log file,
   inside the target directory, so that one can retry later.
   '''
+  if fetcher is not None:
+    fetcher.submit(url, dir, file)
+    return True
   if not os.path.isfile(os.path.join(dir, file)):
     try:
-      urlretrieve(url, os.path.join(dir, file))
-    except ValueError, err:
+      retrieve_cached(url, os.path.join(dir, file))
+    except (IOError, ValueError, httplib.HTTPException), err:
       print >> sys.stderr, "Cannot retrieve {url}: {err}".format(
         url=url, err=err)
       f = open(os.path.join(dir, 'missing_files.log'), 'a')
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/archive.py
+
+Record/replay of the external resources of a crawl, in one archive file.
+When recording, every http(s) resource that save_resource (or a Fetcher)
+gets, from the network or from the resource cache alike, is appended to the
+archive (local files are copied as they are, never archived);
+resources already in it are served from it. When replaying, all of them
+are served from the archive through a memory map and the network is never
+used: a url missing from the archive fails like a broken link does
+(missing_files.log), so that converting a stored crawl is offline and
+deterministic.
+
+Layout of an archive, append-only:
+  MAGIC
+  records  header (RECORD: url length, content size, CRC-32 of the
+           content), url, content
+  index    a last record with an empty url, whose content is the JSON of
+           url -> [offset of the content, size]
+  footer   (FOOTER: offset of the index record, MAGIC)
+An archive whose recording was cut short has no footer: it is indexed by
+walking the record headers, and recording into it again drops the record
+that was being written.
+
+Run this module directly to check the records of an archive.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'ResourceArchive', 'use_archive', 'active_archive',
+          ]
+
+#
+# Imports
+#
+import sys
+import os
+import json
+import mmap
+import zlib
+import fcntl
+import atexit
+import struct
+import threading
+from FBParser.cache import normalize_url
+try:
+  from argparse import ArgumentParser, RawDescriptionHelpFormatter
+except ImportError:
+  ArgumentParser = None
+
+#
+# Internal functions
+#
+
+MAGIC = 'FBPARC01'
+RECORD = struct.Struct('>IQI')  # url length, content size, CRC-32
+FOOTER = struct.Struct('>Q8s')  # offset of the index record, MAGIC
+MODES = ('record', 'replay')
+CHUNK_SIZE = 1 << 16
+
+_active = None  # archive consulted by FBParser.save_resource, see use_archive
+
+#
+# APIs
+#
+
+
+class ResourceArchive(object):
+  '''
+  Resources by url, in one append-only file.
+  Usage:
+    archive = ResourceArchive('crawl.arc', 'record')
+    archive.record(url, filename)
+    archive.close()  # writes the index
+    archive = ResourceArchive('crawl.arc', 'replay')
+    archive.materialize(url, filename)
+  Urls are normalized like those of the resource cache. All methods are
+  safe to call from the workers of a Fetcher; an archive being recorded is
+  locked against other processes.
+  '''
+
+  # @param filename(str)  the archive, created if recording
+  # @param mode='replay'(str)  'record' or 'replay'
+  def __init__(self, filename, mode='replay'):
+    if mode not in MODES:
+      raise ValueError('unknown archive mode: ' + mode)
+    self.filename = filename
+    self.mode = mode
+    self.index = {}  # normalized url -> (offset of the content, size)
+    self.stats = dict.fromkeys(('hits', 'misses', 'records', 'bytes'), 0)
+    self._lock = threading.Lock()
+    self.map = None
+    if mode == 'record':
+      self.f = open(filename, 'r+b' if os.path.isfile(filename) else 'w+b')
+      fcntl.flock(self.f, fcntl.LOCK_EX)  # waits for other recordings
+      self.end = self._load()
+      if not self.end:
+        self.f.write(MAGIC)
+        self.end = len(MAGIC)
+      self.f.truncate(self.end)  # index and footer are written on close
+    else:
+      self.f = open(filename, 'rb')
+      self.end = self._load()
+      if self.end:
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  # @param url(str)  url of a resource
+  # @return (str)  key of its record
+  def _key(self, url):
+    key = normalize_url(url)
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    return key
+
+  # @return (int)  end of the last complete record, 0 for an empty file
+  def _load(self):
+    '''
+    Read the index, or rebuild it from the record headers if there is none.
+    '''
+    f = self.f
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if not size:
+      return 0
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError('not a resource archive: ' + self.filename)
+    if size >= len(MAGIC) + RECORD.size + FOOTER.size:
+      f.seek(size - FOOTER.size)
+      offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+      if magic == MAGIC and len(MAGIC) <= offset < size - FOOTER.size:
+        f.seek(offset)
+        url_len, length, crc = RECORD.unpack(f.read(RECORD.size))
+        index = f.read(length)
+        if not url_len and len(index) == length and \
+           zlib.crc32(index) & 0xffffffff == crc:
+          for url, entry in json.loads(index).items():
+            self.index[url.encode('utf-8')] = tuple(entry)
+          return offset
+    pos = len(MAGIC)
+    while pos + RECORD.size <= size:
+      f.seek(pos)
+      url_len, length, crc = RECORD.unpack(f.read(RECORD.size))
+      start = pos + RECORD.size + url_len
+      if not url_len or start + length > size:  # index, or cut short
+        break
+      self.index[f.read(url_len)] = (start, length)
+      pos = start + length
+    return pos
+
+  # @param offset(int)  where the content is in the archive
+  # @param size(int)  its size
+  # @param out(file)  where to copy it
+  def _copy(self, offset, size, out):
+    if self.map is not None:
+      out.write(buffer(self.map, offset, size))
+      return
+    with self._lock:  # shared with record()
+      self.f.seek(offset)
+      while size > 0:
+        chunk = self.f.read(min(CHUNK_SIZE, size))
+        if not chunk:
+          raise IOError('archive cut short: ' + self.filename)
+        out.write(chunk)
+        size -= len(chunk)
+      self.f.seek(self.end)
+
+  # @param url(str)  url of the resource
+  # @return (Boolean)  whether the archive has it
+  def __contains__(self, url):
+    return self._key(url) in self.index
+
+  # @param url(str)  url of the resource
+  # @param filename(str)  where to put its archived copy
+  # @return (Boolean)  whether the archive has it (a hit)
+  def materialize(self, url, filename):
+    '''
+    Write the archived copy of url to filename, counting a hit or a miss.
+    '''
+    entry = self.index.get(self._key(url))
+    with self._lock:
+      self.stats['hits' if entry else 'misses'] += 1
+    if entry is None:
+      return False
+    out = open(filename, 'wb')
+    try:
+      self._copy(entry[0], entry[1], out)
+    except:
+      out.close()
+      os.remove(filename)
+      raise
+    out.close()
+    return True
+
+  # @param url(str)  url of the resource
+  # @param filename(str)  retrieved copy of the resource
+  # @return (Boolean)  whether it was appended, i.e. it was not archived yet
+  def record(self, url, filename):
+    '''
+    Append a resource to the archive. The header is written last, so that
+    a record cut short is left out when the archive is read again.
+    '''
+    if self.mode != 'record':
+      raise ValueError('archive opened for replay: ' + self.filename)
+    key = self._key(url)
+    src = open(filename, 'rb')
+    try:
+      with self._lock:
+        if key in self.index:
+          return False
+        start = self.end + RECORD.size + len(key)
+        self.f.seek(start)
+        crc, size = 0, 0
+        chunk = src.read(CHUNK_SIZE)
+        while chunk:
+          self.f.write(chunk)
+          crc = zlib.crc32(chunk, crc)
+          size += len(chunk)
+          chunk = src.read(CHUNK_SIZE)
+        self.f.seek(self.end)
+        self.f.write(RECORD.pack(len(key), size, crc & 0xffffffff) + key)
+        self.end = start + size
+        self.f.seek(self.end)
+        self.index[key] = (start, size)
+        self.stats['records'] += 1
+        self.stats['bytes'] += size
+    finally:
+      src.close()
+    return True
+
+  # @return (list)  urls whose content does not match its CRC-32
+  def verify(self):
+    '''
+    Check every record, reading the whole archive.
+    '''
+    bad = []
+    f = open(self.filename, 'rb')
+    try:
+      for url, (offset, size) in sorted(self.index.items(),
+                                        key=lambda item: item[1]):
+        f.seek(offset - len(url) - RECORD.size)
+        url_len, length, crc = RECORD.unpack(f.read(RECORD.size))
+        f.seek(offset)
+        actual = 0
+        while size > 0:
+          chunk = f.read(min(CHUNK_SIZE, size))
+          if not chunk:
+            break
+          actual = zlib.crc32(chunk, actual)
+          size -= len(chunk)
+        if size or length != self.index[url][1] or \
+           actual & 0xffffffff != crc:
+          bad.append(url)
+    finally:
+      f.close()
+    return bad
+
+  # @return (dict)  counters of this run, plus the number of entries and the
+  #                 size of the records
+  def report(self):
+    with self._lock:
+      report = dict(self.stats)
+      lookups = report['hits'] + report['misses']
+      report['hit_rate'] = float(report['hits']) / lookups if lookups else 0.0
+      report['entries'] = len(self.index)
+      report['size'] = self.end
+    return report
+
+  def close(self):
+    '''
+    Write the index when recording, and release the archive.
+    '''
+    global _active
+    with self._lock:
+      if self.f is None:
+        return
+      if self.mode == 'record':
+        index = json.dumps(dict((url, list(entry))
+                                for url, entry in self.index.items()),
+                           sort_keys=True)
+        self.f.seek(self.end)
+        self.f.write(RECORD.pack(0, len(index),
+                                 zlib.crc32(index) & 0xffffffff) +
+                     index + FOOTER.pack(self.end, MAGIC))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+      if self.map is not None:
+        self.map.close()
+        self.map = None
+      self.f.close()  # and the lock with it
+      self.f = None
+    if _active is self:
+      _active = None
+
+
+# @param filename(str)  the archive
+# @param mode(str)  'record' or 'replay'
+# @return (ResourceArchive)  the archive now used by save_resource/Fetcher
+def use_archive(filename, mode):
+  '''
+  Open an archive and make it the one used by all subsequent retrievals.
+  A recorded archive gets its index when the interpreter exits, even after
+  an error.
+  '''
+  global _active
+  _active = ResourceArchive(filename, mode)
+  atexit.register(_active.close)
+  return _active
+
+
+# @return (ResourceArchive)  the archive in use, None if there is none
+def active_archive():
+  return _active
+
+
+def main():
+  if ArgumentParser is None:
+    print >> sys.stderr, 'This module uses the argparse module.'
+    sys.exit(1)
+  parser = ArgumentParser(
+    formatter_class=RawDescriptionHelpFormatter,
+    description=__doc__)
+  parser.add_argument('archive', help='archive to be checked')
+  parser.add_argument('-l', '--list', action='store_true',
+                      help='list the urls archived, with their size')
+  args = parser.parse_args()
+  archive = ResourceArchive(args.archive)
+  if args.list:
+    for url, (offset, size) in sorted(archive.index.items()):
+      print size, url
+  bad = archive.verify()
+  for url in bad:
+    print >> sys.stderr, 'corrupted:', url
+  print '{n} resources, {size} bytes, {bad} corrupted'.format(
+    n=len(archive.index), size=archive.end, bad=len(bad))
+  archive.close()
+  sys.exit(1 if bad else 0)
+
+if __name__ == '__main__':
+  main()
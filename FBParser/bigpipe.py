@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/bigpipe.py
+
+Parsing of big pipe scripts, <script>big_pipe.onPageletArrive({...});</script>.
+The payload is walked as JSON, in one pass: strings (the content of a
+pagelet may be megabytes of escaped markup) are skipped with a single
+non-backtracking match each, and nesting is tracked on brackets only.
+Fields are returned in source order, with their exact spans, so that a pipe
+can be rebuilt from them; fields the parser doesn't know of are kept like
+any other.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'PIPE_HEAD', 'PIPE_TAIL',
+            'parse_pipe', 'skip_value', 'pipe_id', 'build_pipe',
+          ]
+
+#
+# Imports
+#
+from FBParser.Constants import PIPE_KEYS
+# external imports
+import re
+from collections import OrderedDict
+
+#
+# Internal functions
+#
+
+PIPE_HEAD = '<script>big_pipe.onPageletArrive('
+PIPE_TAIL = ');</script>'
+
+re_json_string = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+re_json_other = re.compile(r'[^"\[\]{}]*')  # up to the next string/bracket
+re_json_literal = re.compile(r'[^,\]}\s]+')  # number, true, false or null
+re_json_space = re.compile(r'\s*')
+
+#
+# APIs
+#
+
+
+# @param s(str)  JSON text
+# @param pos(int)  start of a value in s
+# @param end=None(int)  end of s to be considered, default to len(s)
+# @return (int)  end of the value, -1 if it is not terminated before end
+def skip_value(s, pos, end=None):
+  '''
+  Skip a JSON value, in time linear in its length.
+  '''
+  if end is None:
+    end = len(s)
+  if pos >= end:
+    return -1
+  c = s[pos]
+  if c == '"':
+    m = re_json_string.match(s, pos, end)
+    return m.end() if m else -1
+  if c not in '[{':
+    m = re_json_literal.match(s, pos, end)
+    return m.end() if m else -1
+  depth = 0
+  while pos < end:
+    c = s[pos]
+    if c == '"':
+      m = re_json_string.match(s, pos, end)
+      if not m:
+        return -1
+      pos = m.end()
+      continue
+    if c in '[{':
+      depth += 1
+    elif c in ']}':
+      depth -= 1
+      if not depth:
+        return pos + 1
+    pos = re_json_other.match(s, pos + 1, end).end()
+  return -1
+
+
+# @param s(str)  markup, e.g. a script element as matched by re_html_js
+# @param start=0(int)  start of the script in s
+# @param end=None(int)  end of the script in s, default to len(s)
+# @return (OrderedDict)  JSON key -> (start, value start, end), span in s of
+#                        each '"key":value' field, in source order; None if
+#                        s[start:end] is not a big pipe
+def parse_pipe(s, start=0, end=None):
+  '''
+  Parse the payload of a big pipe script.
+  '''
+  if end is None:
+    end = len(s)
+  if not s.startswith(PIPE_HEAD, start) or \
+     not s.endswith(PIPE_TAIL, start, end):
+    return None
+  pos = start + len(PIPE_HEAD)
+  stop = end - len(PIPE_TAIL)
+  if pos >= stop or s[pos] != '{':
+    return None
+  fields = OrderedDict()
+  pos = re_json_space.match(s, pos + 1, stop).end()
+  if pos < stop and s[pos] == '}':
+    pos += 1
+  else:
+    while True:
+      m_key = re_json_string.match(s, pos, stop)
+      if not m_key:
+        return None
+      colon = re_json_space.match(s, m_key.end(), stop).end()
+      if colon >= stop or s[colon] != ':':
+        return None
+      value = re_json_space.match(s, colon + 1, stop).end()
+      value_end = skip_value(s, value, stop)
+      if value_end < 0:
+        return None
+      fields[m_key.group(0)[1:-1]] = (pos, value, value_end)
+      pos = re_json_space.match(s, value_end, stop).end()
+      if pos < stop and s[pos] == ',':
+        pos = re_json_space.match(s, pos + 1, stop).end()
+      elif pos < stop and s[pos] == '}':
+        pos += 1
+        break
+      else:
+        return None
+  if re_json_space.match(s, pos, stop).end() != stop:
+    return None
+  return fields
+
+
+# @param s(str)  markup the pipe was parsed from
+# @param fields(OrderedDict)  as returned by parse_pipe
+# @return (str)  id of the pagelet, None if the pipe has no (string) id
+def pipe_id(s, fields):
+  if 'id' not in fields:
+    return None
+  start, value, end = fields['id']
+  if s[value] != '"':
+    return None
+  return s[value + 1:end - 1]
+
+
+# @param s(str)  markup the pipe was parsed from
+# @param fields(OrderedDict)  as returned by parse_pipe
+# @param keep(function)  name of a known field (see PIPE_KEYS) -> whether
+#                        to keep the field
+# @param values={}(dict)  JSON key -> new '"key":value' text of the field,
+#                         fields not in the pipe yet are added last
+# @return (str)  the pipe rebuilt from the fields kept, in source order;
+#                fields unknown to PIPE_KEYS are all kept
+def build_pipe(s, fields, keep, values={}):
+  items = []
+  for key in fields.keys() + [key for key in values if key not in fields]:
+    if key in PIPE_KEYS and not keep(PIPE_KEYS[key]):
+      continue
+    if key in values:
+      items.append(values[key])
+    else:
+      items.append(s[fields[key][0]:fields[key][2]])
+  return PIPE_HEAD + '{' + ','.join(items) + '}' + PIPE_TAIL
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/cache.py
+
+Persistent, content-addressed cache of external resources, shared by all the
+pages of a crawl. Entries are keyed by normalized url and point to blobs
+named after the SHA-1 of their content, so the same bundle served under
+different urls is only kept once. Cached files are materialized into a
+page's css/, js/, img/ and misc/ dirs as hardlinks (copies across devices).
+
+The same machinery keeps garbled images (see GarbleCache), keyed by the
+content of the original image rather than by url.
+
+Selectors found in css files are kept apart, in one SQLite file keyed by the
+SHA-1 of the css content (see SelectorCache): they are small and many, and
+pages mostly share the same bundles.
+
+Layout of the cache directory:
+  index.json        url -> [sha1, size, last used, seconds it took to fetch],
+                    plus hit/miss counters accumulated over runs
+  objects/ab/ab...  blobs
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'ResourceCache', 'GarbleCache', 'SelectorCache', 'normalize_url',
+            'use_cache', 'active_cache', 'temp_file',
+          ]
+
+#
+# Imports
+#
+import os
+import json
+import atexit
+import time
+import errno
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from urlparse import urlsplit, urlunsplit
+
+#
+# Internal functions
+#
+
+DEFAULT_MAX_BYTES = 1 << 30  # 1GB
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+COUNTERS = ('hits', 'misses', 'stores', 'evictions',
+            'bytes_saved', 'seconds_saved', 'bytes_fetched')
+
+_active = None  # cache consulted by FBParser.save_resource, see use_cache
+_umask = os.umask(0)  # there is no reading it without setting it
+os.umask(_umask)
+
+
+# @param filename(str)  file to be hashed
+# @return (str)  hex SHA-1 digest of the content
+def _hash_file(filename):
+  sha1 = hashlib.sha1()
+  f = open(filename, 'rb')
+  try:
+    chunk = f.read(1 << 16)
+    while chunk:
+      sha1.update(chunk)
+      chunk = f.read(1 << 16)
+  finally:
+    f.close()
+  return sha1.hexdigest()
+
+
+# @param src(str)  existing file
+# @param dst(str)  new file, must not exist
+def _link(src, dst):
+  '''
+  Hardlink src to dst, fall back to copying across devices/filesystems.
+  '''
+  try:
+    os.link(src, dst)
+  except OSError, err:
+    if err.errno == errno.EEXIST:
+      raise
+    shutil.copyfile(src, dst)
+
+#
+# APIs
+#
+
+
+# @param url(str)  a url
+# @return (str)  the url with case-insensitive parts lowered, default port
+#                and fragment dropped and html-escaped ampersands restored
+def normalize_url(url):
+  '''
+  Normalize a url so that trivially different spellings share one entry.
+  '''
+  parts = urlsplit(url.replace('&amp;', '&'))
+  scheme = parts.scheme.lower()
+  host = parts.netloc.lower()
+  if ':' in host and host.rsplit(':', 1)[1] == str(DEFAULT_PORTS.get(scheme)):
+    host = host.rsplit(':', 1)[0]
+  return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+class ResourceCache(object):
+  '''
+  Size-bounded LRU cache of resources on disk.
+  The index is loaded on creation and written back by save()/close(); blobs
+  it doesn't refer to are removed then. A cache directory is meant to be
+  used by one process at a time, whose methods are all safe to call from
+  the workers of a Fetcher.
+  '''
+
+  # @param dir(str)  directory of the cache, created if necessary
+  # @param max_bytes=DEFAULT_MAX_BYTES(int)  size bound of all blobs
+  def __init__(self, dir, max_bytes=DEFAULT_MAX_BYTES):
+    self.dir = dir
+    self.max_bytes = max_bytes
+    self._lock = threading.RLock()
+    self.entries = {}  # normalized url -> [sha1, size, last used, seconds]
+    self.stats = dict.fromkeys(COUNTERS, 0)
+    if not os.path.isdir(os.path.join(dir, 'objects')):
+      os.makedirs(os.path.join(dir, 'objects'))
+    index = os.path.join(dir, 'index.json')
+    if os.path.isfile(index):
+      try:
+        f = open(index, 'r')
+        saved = json.load(f)
+        f.close()
+        self.entries = saved['entries']
+        self.stats.update(saved['stats'])
+      except (IOError, ValueError, KeyError):
+        self.entries = {}  # corrupted index, start over
+    # blobs whose index entries are gone are dropped, and vice versa
+    self.blobs = {}  # sha1 -> size
+    for url, entry in self.entries.items():
+      if os.path.isfile(self._blob(entry[0])):
+        self.blobs[entry[0]] = entry[1]
+      else:
+        del self.entries[url]
+    self._sweep()
+    self.size = sum(self.blobs.values())
+
+  def _sweep(self):
+    '''
+    Remove the files under objects/ that no entry refers to: blobs stored
+    by a run that ended before saving the index, and temporary copies.
+    '''
+    objects = os.path.join(self.dir, 'objects')
+    for subdir in os.listdir(objects):
+      subdir = os.path.join(objects, subdir)
+      if not os.path.isdir(subdir):
+        continue
+      for name in os.listdir(subdir):
+        if name not in self.blobs:
+          os.remove(os.path.join(subdir, name))
+
+  # @param sha1(str)  hex digest
+  # @return (str)  where the blob is kept
+  def _blob(self, sha1):
+    return os.path.join(self.dir, 'objects', sha1[:2], sha1)
+
+  # @param url(str)  url of a resource
+  # @return (str)  key of its entry
+  def _key(self, url):
+    return normalize_url(url)
+
+  # @param url(str)  url of the resource
+  # @param filename(str)  where to put the cached copy
+  # @return (Boolean)  whether the resource was cached (a hit)
+  def materialize(self, url, filename):
+    '''
+    Link the cached copy of url to filename, counting a hit or a miss.
+    '''
+    key = self._key(url)
+    with self._lock:
+      entry = self.entries.get(key)
+      if entry is None or not os.path.isfile(self._blob(entry[0])):
+        self.stats['misses'] += 1
+        return False
+      entry[2] = time.time()
+      self.stats['hits'] += 1
+      self.stats['bytes_saved'] += entry[1]
+      self.stats['seconds_saved'] += entry[3]
+      blob = self._blob(entry[0])
+    if os.path.isfile(filename):
+      os.remove(filename)
+    _link(blob, filename)
+    return True
+
+  # @param url(str)  url of the resource
+  # @param filename(str)  freshly retrieved copy of the resource
+  # @param seconds=0(float)  how long the retrieval took
+  def store(self, url, filename, seconds=0):
+    '''
+    Add a retrieved file to the cache, sharing the blob if the content is
+    already known, then evict the least recently used entries if needed.
+    '''
+    sha1 = _hash_file(filename)
+    size = os.path.getsize(filename)
+    with self._lock:
+      if sha1 not in self.blobs:
+        blob = self._blob(sha1)
+        if not os.path.isdir(os.path.dirname(blob)):
+          os.makedirs(os.path.dirname(blob))
+        if not os.path.isfile(blob):
+          # copy rather than link, the page may rewrite its file later
+          tmp = temp_file(os.path.dirname(blob))
+          shutil.copyfile(filename, tmp)
+          os.rename(tmp, blob)
+        self.blobs[sha1] = size
+        self.size += size
+      self.entries[self._key(url)] = [sha1, size, time.time(), seconds]
+      self.stats['stores'] += 1
+      self.stats['bytes_fetched'] += size
+      self.evict()
+
+  # @param max_bytes=None(int)  size to shrink to, default to self.max_bytes
+  def evict(self, max_bytes=None):
+    '''
+    Drop least recently used entries (and unreferenced blobs) until the
+    blobs fit into max_bytes.
+    '''
+    if max_bytes is None:
+      max_bytes = self.max_bytes
+    with self._lock:
+      if self.size <= max_bytes:
+        return
+      refs = {}
+      for entry in self.entries.values():
+        refs[entry[0]] = refs.get(entry[0], 0) + 1
+      lru = sorted(self.entries.items(), key=lambda item: item[1][2])
+      for url, entry in lru:
+        if self.size <= max_bytes:
+          break
+        del self.entries[url]
+        self.stats['evictions'] += 1
+        refs[entry[0]] -= 1
+        if refs[entry[0]] == 0:
+          self.size -= self.blobs.pop(entry[0])
+          if os.path.isfile(self._blob(entry[0])):
+            os.remove(self._blob(entry[0]))
+
+  # @return (dict)  counters, plus the hit rate and current size
+  def report(self):
+    '''
+    Summarize how much the cache has saved so far.
+    '''
+    with self._lock:
+      report = dict(self.stats)
+      lookups = report['hits'] + report['misses']
+      report['hit_rate'] = float(report['hits']) / lookups if lookups else 0.0
+      report['entries'] = len(self.entries)
+      report['blobs'] = len(self.blobs)
+      report['size'] = self.size
+    return report
+
+  def save(self):
+    '''
+    Write the index back to disk (atomically).
+    '''
+    with self._lock:
+      tmp = temp_file(self.dir)
+      f = open(tmp, 'w')
+      json.dump({'entries': self.entries, 'stats': self.stats}, f)
+      f.close()
+      os.rename(tmp, os.path.join(self.dir, 'index.json'))
+
+  def close(self):
+    global _active
+    self.save()
+    if _active is self:
+      _active = None
+
+
+class GarbleCache(ResourceCache):
+  '''
+  Size-bounded LRU cache of garbled images, shared by all pages.
+  Entries are keyed by '<garble mode>/<SHA-1 of the original image>', see
+  FBParser.garble_image.garble, so a photo or sprite found on many pages is
+  garbled once and then hardlinked into place.
+  '''
+
+  def _key(self, key):
+    return key
+
+
+class SelectorCache(object):
+  '''
+  Persistent index of the id & class selectors of css files, keyed by the
+  SHA-1 of their content, see FBParser.css.selector_index.
+  Usage:
+    cache = SelectorCache('selectors.db')
+    selectors = cache.lookup(css)
+    if selectors is None:
+      cache.store(css, compute(css))
+    ...
+    cache.close()
+  Hit/miss counters are kept in the file too, accumulated over runs.
+  '''
+
+  # @param filename(str)  SQLite file of the cache, created if necessary
+  def __init__(self, filename):
+    self.filename = filename
+    self.db = sqlite3.connect(filename, timeout=60)  # shared by processes
+    self.db.execute('CREATE TABLE IF NOT EXISTS selectors '
+                    '(sha1 TEXT PRIMARY KEY, id TEXT, class TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS stats '
+                    '(name TEXT PRIMARY KEY, value INTEGER)')
+    self.db.commit()
+    self.stats = {'hits': 0, 'misses': 0}  # of this run, not saved yet
+
+  # @param css(str)  content of a css file
+  # @return (str)  its key
+  def _key(self, css):
+    if isinstance(css, unicode):
+      css = css.encode('utf-8')
+    return hashlib.sha1(css).hexdigest()
+
+  # @param css(str)  content of a css file
+  # @return (dict)  'id' & 'class' sets, None if the content is unknown
+  def lookup(self, css):
+    row = self.db.execute('SELECT id, class FROM selectors WHERE sha1 = ?',
+                          (self._key(css),)).fetchone()
+    if row is None:
+      self.stats['misses'] += 1
+      return None
+    self.stats['hits'] += 1
+    # selectors are \w+, so space separated names are unambiguous
+    return {'id': set(row[0].split()), 'class': set(row[1].split())}
+
+  # @param css(str)  content of a css file
+  # @param selectors(dict)  its 'id' & 'class' sets
+  def store(self, css, selectors):
+    self.db.execute('INSERT OR REPLACE INTO selectors VALUES (?, ?, ?)',
+                    (self._key(css), ' '.join(sorted(selectors['id'])),
+                     ' '.join(sorted(selectors['class']))))
+
+  # @return (dict)  counters over all runs, plus the hit rate and the
+  #                 number of entries
+  def report(self):
+    report = dict(self.db.execute('SELECT name, value FROM stats').fetchall())
+    for name, value in self.stats.items():
+      report[name] = report.get(name, 0) + value
+    lookups = report['hits'] + report['misses']
+    report['hit_rate'] = float(report['hits']) / lookups if lookups else 0.0
+    report['entries'] = \
+      self.db.execute('SELECT COUNT(*) FROM selectors').fetchone()[0]
+    return report
+
+  def save(self):
+    '''
+    Commit the new entries and counters.
+    '''
+    for name, value in self.stats.items():
+      self.db.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+      self.db.execute('UPDATE stats SET value = value + ? WHERE name = ?',
+                      (value, name))
+    self.stats = dict.fromkeys(self.stats, 0)
+    self.db.commit()
+
+  def close(self):
+    self.save()
+    self.db.close()
+
+
+# @param dir(str)  directory of the cache
+# @param max_bytes=DEFAULT_MAX_BYTES(int)  size bound of all blobs
+# @return (ResourceCache)  the cache now consulted by save_resource/Fetcher
+def use_cache(dir, max_bytes=DEFAULT_MAX_BYTES):
+  '''
+  Open a cache and make it the one used by all subsequent retrievals.
+  Its index is saved when the interpreter exits, even after an error.
+  '''
+  global _active
+  _active = ResourceCache(dir, max_bytes)
+  atexit.register(_active.save)
+  return _active
+
+
+# @return (ResourceCache)  the cache in use, None if there is none
+def active_cache():
+  return _active
+
+
+# @param dir(str)  directory of the file
+# @param prefix='tmp'(str)  start of its name
+# @return (str)  name of a new, empty file in dir
+def temp_file(dir, prefix='tmp'):
+  '''
+  Create a file to be written and then renamed into place, under a name no
+  other process can take meanwhile. Unlike with tempfile.mkstemp, it gets
+  the permissions of a file created by open().
+  '''
+  fd, tmp = tempfile.mkstemp(dir=dir, prefix=prefix)
+  os.close(fd)
+  os.chmod(tmp, 0666 & ~_umask)
+  return tmp
@@ -9,13 +9,16 @@ __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 __all__ = [
             'selector_index',
             'css_in_html', 'css_in_json',
+            'css_edits_in_html', 'css_edits_in_json',
           ]
 
 #
 # Imports
 #
 from FBParser import get_content, save_content, save_resource
-from FBParser import del_blockcomment, dejsonify, url_to_file
+from FBParser import del_blockcomment, dejsonify, url_to_file, splice
+from FBParser.fetch import Fetcher
+from FBParser.Constants import REF_CSS_HTML, REF_CSS_JSON
 from FBParser.regexp import re_json_css, re_html_css
 from FBParser.regexp import re_cssrule, re_css_id, re_css_class
 
@@ -25,11 +28,19 @@ from FBParser.regexp import re_cssrule, re_css_id, re_css_class
 
 
 # @param s(str)  css string
+# @param cache=None(SelectorCache)  selectors of css scanned before, on any
+#                                   page or run, see FBParser.cache
 # @return (dict)  two sets of indices, for 'id' & 'class' respectively
-def selector_index(s):
+def selector_index(s, cache=None):
   '''
   This function scans css to find distinctive selectors.
   '''
+  if cache is not None:
+    selectors = cache.lookup(s)
+    if selectors is None:
+      selectors = selector_index(s)
+      cache.store(s, selectors)
+    return selectors
   s = del_blockcomment(s)
   # build indices of selectors:
   # one for ids (#NAME), one for classes (.CLASS)
@@ -46,49 +57,101 @@ def selector_index(s):
 # @param localize(Boolean)  Wether these css files should be retrieved and saved
 # @param dir=''(str)  Directory where the files should be saved
 # @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
 # @return (dict)  source with js urls replaced by local files (if localize),
-#                 and a set of css files that are included
-def css_in_html(s, localize=True, dir='', prefix=''):
+#                 a set of css files that are included,
+#                 and the edits made to s (see splice)
+def css_in_html(s, localize=True, dir='', prefix='', fetcher=None):
   '''
   Retrieve css package information from the DOM/src and download them.
   '''
-  m_csses = re_html_css.finditer(s)
+  ret = css_edits_in_html({REF_CSS_HTML: re_html_css.finditer(s)},
+                          localize, dir, prefix, fetcher)
+  ret['source'] = splice(s, ret['edits'])
+  return ret
+
+
+# @param refs(dict)  references in a page, as found by
+#                    FBParser.scan.scan_resources
+# @param localize(Boolean)  Wether these css files should be retrieved and saved
+# @param dir=''(str)  Directory where the files should be saved
+# @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
+# @return (dict)  a set of css files that are included,
+#                 and the edits localizing them (see splice)
+def css_edits_in_html(refs, localize=True, dir='', prefix='', fetcher=None):
+  '''
+  Same as css_in_html, on references scanned beforehand.
+  '''
+  pool = Fetcher() if fetcher is None else fetcher
+  m_csses = refs[REF_CSS_HTML]
   csses = set()
+  edits = []
   for m_css in m_csses:
     if m_css.group(0).find('type="text/css"') < 0:  # avoid false positives
       continue
     url = m_css.group('url')
     if localize:
       file = url_to_file(url)
-      save_resource(url, dir, file)
-      s = s.replace(url, prefix + file, 1)
+      save_resource(url, dir, file, pool)
+      edits.append((m_css.start('url'), m_css.end('url'), prefix + file))
       csses.add(prefix + file)
     else:
       csses.add(url)
-  return {'source': s, 'csses': csses}
+  if fetcher is None:
+    pool.close()
+  return {'csses': csses, 'edits': edits}
 
 
 # @param s(str)  a string that may contain url of css files
 # @param localize(Boolean)  Wether these css files should be retrieved and saved
 # @param dir=''(str)  Directory where the files should be saved
 # @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
 # @return (dict)  source with js urls replaced by local files (if localize),
-#                 and a set of css files that are included
-def css_in_json(s, localize=True, dir='', prefix=''):
+#                 a set of css files that are included,
+#                 and the edits made to s (see splice)
+def css_in_json(s, localize=True, dir='', prefix='', fetcher=None):
   '''
   Retrieve css package information from the DOM/src and download them.
   NOTE: if prefix is a dir, remember to replace '/' with '\/'!
   '''
-  m_csses = re_json_css.finditer(s)
+  ret = css_edits_in_json({REF_CSS_JSON: re_json_css.finditer(s)},
+                          localize, dir, prefix, fetcher)
+  ret['source'] = splice(s, ret['edits'])
+  return ret
+
+
+# @param refs(dict)  references in a page, as found by
+#                    FBParser.scan.scan_resources
+# @param localize(Boolean)  Wether these css files should be retrieved and saved
+# @param dir=''(str)  Directory where the files should be saved
+# @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
+# @return (dict)  a set of css files that are included,
+#                 and the edits localizing them (see splice)
+def css_edits_in_json(refs, localize=True, dir='', prefix='', fetcher=None):
+  '''
+  Same as css_in_json, on references scanned beforehand.
+  '''
+  pool = Fetcher() if fetcher is None else fetcher
+  m_csses = refs[REF_CSS_JSON]
   csses = set()
+  edits = []
   for m_css in m_csses:
     url = m_css.group('url')
     download_url = dejsonify(url)
     if localize:
       file = url_to_file(url)
-      s = s.replace(url, prefix + file, 1)
-      save_resource(download_url, dir, file)
+      edits.append((m_css.start('url'), m_css.end('url'), prefix + file))
+      save_resource(download_url, dir, file, pool)
       csses.add(prefix + file)
     else:
       csses.add(url)
-  return {'source': s, 'csses': csses}
+  if fetcher is None:
+    pool.close()
+  return {'csses': csses, 'edits': edits}
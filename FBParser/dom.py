@@ -7,7 +7,10 @@ Image related functionalities when parsing a Facebook DOM/html page.
 __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 
 __all__ = [
-    'prettify', 'anonym_dom', 'unload_pagelets',
+    'tokenize', 'ElementIndex', 'AnonymPlan',
+    'stream_tokens', 'stream_untokenize', 'stream_prettify', 'stream_anonym',
+    'stream_descript_html', 'stream_descript_onclick',
+    'prettify', 'anonym_dom', 'unload_pagelets', 'pagelet_ids',
     'descript_pipeonly', 'descript_onclick',
     'descript_html', 'descript_injected',
     'unload_css', 'decss_injected', 'decss_all',
@@ -18,50 +21,31 @@ __all__ = [
 #
 from FBParser.Constants import *
 from FBParser.regexp import *
-from FBParser import url_to_file, jsonify, del_blockcomment
+from FBParser import url_to_file, stream_jsonify, del_blockcomment, splice
+from FBParser import EditBuffer
+from FBParser import stream_sub, stream_del_blockcomment, Memo
+from FBParser.bigpipe import parse_pipe, pipe_id, build_pipe
 # external imports
 import re
+from array import array
 import sys
 import codecs
 import random
+import itertools
+from binascii import unhexlify
 from urllib import unquote
 import time
 
-# @param s(str)  string to be worked on
-# @param pos(int)  position of the leading quote marking
-# @param char_quote='"'(str)  whether the quote mark is a "'" or a '"'
-# @return (int) position after the trailing quote mark
-def skip_quote(s, pos, char_quote='"'):
-  '''
-  Get the end of the quote given the position of the first quote mark.
-  '''
-  pos += 1
-  while s[pos] != char_quote:
-    if s[pos] == '\\':
-      pos += 2  # skip escape characters
-    else:
-      pos += 1
-  return pos + 1
-
-
 # @param s(str)  string to be worked on
 # @param start(int)  starting position
-# @return (int)  start of the next tag
-def skip_content(s, start):
+# @param end(int)  end of the string (exclusive)
+# @return (int)  start of the next tag, end if there is none, or the start
+#                of an unterminated quoted string/escape sequence
+def skip_content(s, start, end):
   '''
-  Skip content between tags.
+  Skip content between tags, without being trapped by escape chars or quotes.
   '''
-  current = start
-  while (current < len(s) and
-         (s[current] != '<' or s[current:current + 2] == '<!')):
-    # jump to next tag and avoid trapped by escape chars or quotes
-    if s[current] == '\\':
-      current += 2
-    elif s[current] == '"':
-      current = skip_quote(s, current, '"')
-    else:
-      current += 1
-  return current
+  return re_content.match(s, start, end).end()
 
 
 # @param s(str)  string that needs to be indented
@@ -91,31 +75,80 @@ def cut_dom_node(s, rootid):
   else:
     start = re.search("<.*?{id}>".format(id=rootid), s).end()
   depth = 0
-  current = start
-  maxpos = len(s)
-  while depth >= 0:
-    while (current < maxpos and \
-           (s[current] != '<' or re_tag.match(s[current:]) == None)):
-      if s[current] == '\\':
-        current += 2
-      elif s[current] == '"':
-        current = skip_quote(s, current, '"')
-      else:
-        current += 1
-    if current >= maxpos:  # reached EOF w/o a match, DOM probably corrupted
-      return {'node': '', 'dom': s}
-    tag = re_tag.match(s[current:]).group(0)
-    tag_label = re_tag_label.match(tag).group('label')
-    if tag_label in EMPTY_ELEMENTS:
-      current += len(tag)
-    elif tag[1] == '/':  # closing tags, not empty elements
-      depth -= 1
-      if depth >= 0:  # not paired with root
-        current += len(tag)
-    else:  # opening tag that needs to be paired later
+  for kind, current, end, label in tokenize(s, start):
+    if kind == TOKEN_OPEN:
       depth += 1
-      current += len(tag)
-  return {'node': s[start:current], 'dom': s[:start] + s[current:]}
+    elif kind == TOKEN_CLOSE:
+      depth -= 1
+      if depth < 0:  # paired with root
+        return {'node': s[start:current], 'dom': s[:start] + s[current:]}
+  # reached EOF w/o a match, DOM probably corrupted
+  return {'node': '', 'dom': s}
+
+
+# letters MODE_BABBLE draws from, see _babble
+LETTER_POOL_SIZE = 1 << 16
+# strings anonymized so far, kept per mode
+ANONYM_MEMO_SIZE = 1 << 14
+ANONYM_MEMO_MAX_LEN = 256  # longer strings hardly ever repeat
+# plans of anonym_tag, kept per (selectors, mode)
+ANONYM_PLANS_SIZE = 16
+
+# byte -> letter, and byte -> '?' for all but whitespace chars
+_LETTERS = ''.join(chr(97 + i % 26) for i in range(256))
+_MONO = ''.join(c if re_spaces.match(c) else '?' for c in map(chr, range(256)))
+
+_letter_pool = None
+
+
+# @param size=LETTER_POOL_SIZE(int)  number of letters
+# @return (str)  random letters 'a'-'z'
+def _new_letter_pool(size=LETTER_POOL_SIZE):
+  bits = random.getrandbits(8 * size)
+  return unhexlify('%0*x' % (2 * size, bits)).translate(_LETTERS)
+
+
+# @param s(str)  the original string
+# @return (str)  s with all non whitespace chars replaced by '?'
+def _mono(s):
+  if isinstance(s, unicode):  # whitespace chars are all ascii
+    return s.encode('ascii', 'replace').translate(_MONO).decode('ascii')
+  return s.translate(_MONO)
+
+
+# @param word(str)  the original string, without whitespace chars
+# @return (str)  as many random letters
+def _babble(word):
+  '''
+  Replace a word with a slice of the letter pool. Where the slice starts
+  depends on the word only, so that a word is always replaced the same way.
+  '''
+  global _letter_pool
+  if _letter_pool is None:
+    _letter_pool = _new_letter_pool()
+  n = len(word)
+  if n >= LETTER_POOL_SIZE:
+    return (_letter_pool * (n // LETTER_POOL_SIZE + 1))[:n]
+  start = hash(word) % (LETTER_POOL_SIZE - n)
+  return _letter_pool[start:start + n]
+
+
+class _BabbledWords(dict):
+  '''
+  word -> babble, filled as words are looked up, so that known words are
+  replaced with a plain dict lookup.
+  '''
+
+  def __missing__(self, word):
+    if len(self) >= ANONYM_MEMO_SIZE:
+      self.clear()  # babble is a function of the word, nothing is lost
+    babble = self[word] = _babble(word)
+    return babble
+
+_babbled_words = _BabbledWords()
+_anonym_memo = {MODE_MONO: Memo(ANONYM_MEMO_SIZE),
+                MODE_BABBLE: Memo(ANONYM_MEMO_SIZE)}
+_anonym_plans = Memo(ANONYM_PLANS_SIZE)
 
 
 # @param s(str)  the original string
@@ -125,12 +158,23 @@ def anonym_str(s, mode=MODE_MONO):
   '''
   Anonymize a string. All whitespace chars are kept to maintain formatting.
   MODE_MONO replaces chars with '?';
-  MODE_BABBLE replaces each with 'a'-'z' randomly.
-  '''
-  if mode == MODE_MONO:  # use one char to replace all non whitespace chars
-    return re.sub("[^\s]", "?", s)
-  if mode == MODE_BABBLE:
-    return re.sub("[^\s]{1}", chr(random.randint(97, 122)), s)
+  MODE_BABBLE replaces each with 'a'-'z' randomly, the same word always
+  getting the same letters.
+  '''
+  memo = _anonym_memo.get(mode)
+  if memo is None:
+    return None
+  anon = memo.get(s)
+  if anon is None:
+    if mode == MODE_MONO:  # use one char to replace all non whitespace chars
+      anon = _mono(s)
+    else:  # words and whitespace alternate
+      parts = re_spaces.split(s)
+      parts[::2] = map(_babbled_words.__getitem__, parts[::2])
+      anon = ''.join(parts)
+    if len(s) <= ANONYM_MEMO_MAX_LEN:
+      memo[s] = anon
+  return anon
 
 
 # @param v(str)  the original value string
@@ -141,21 +185,80 @@ def anonym_val(v, selectors, mode):
   '''
   Keep values that match some css selector and anonymize the rest.
   '''
-  items = v.split()
-  new_v = ''
-  for item in items:
-    new_v += ' '
+  items = []
+  for item in v.split():
     if item in selectors:  # css selector
-      new_v += item
+      items.append(item)
     elif '-' in item:  # composed value
       [key, suffix] = item.split('-', 1)
       if key in selectors:  # part of the value is a css selector
-        new_v += key + '-' + anonym_str(suffix, mode)
+        items.append(key + '-' + anonym_str(suffix, mode))
       else:
-        new_v += anonym_str(key, mode) + '-' + anonym_str(suffix, mode)
+        items.append(anonym_str(key, mode) + '-' + anonym_str(suffix, mode))
     else:  # not important to rendering
-      new_v += anonym_str(item, mode)
-  return new_v[1:]
+      items.append(anonym_str(item, mode))
+  return ' '.join(items)
+
+
+class AnonymPlan(object):
+  '''
+  How to anonymize the tags of a page, compiled once from its selectors:
+  which tags are exempted, which attributes are kept as they are, and the
+  selectors to keep in id/class values, as frozensets. Anonymized values are
+  memoized by (attribute name, value), class lists repeating a lot.
+  '''
+
+  # @param selectors(dict)  a dictionary of css selectors (id & class)
+  # @param mode(str)  How to replace a string with meaningless chars
+  def __init__(self, selectors, mode):
+    self.mode = mode
+    self.selectors = dict((name, frozenset(values))
+                          for name, values in selectors.items())
+    self.exempted = frozenset(EXEMPTED_TAGS)
+    # attributes useful for styling, unless they are id or class
+    self.kept = frozenset(name for name in HTML_ELEMENTS
+                          if name not in self.selectors)
+    self.memo = Memo(ANONYM_MEMO_SIZE)
+
+  # @param name(str)  name of an attribute, that is not kept
+  # @param value(str)  its value
+  # @return (str)  the anonymized value
+  def value(self, name, value):
+    key = (name, value)
+    anon = self.memo.get(key)
+    if anon is None:
+      if name in self.selectors:  # id or class
+        anon = anonym_val(value, self.selectors[name], self.mode)
+      else:  # attributes not useful for styling
+        anon = anonym_str(value, self.mode)
+      if len(value) <= ANONYM_MEMO_MAX_LEN:
+        self.memo[key] = anon
+    return anon
+
+  # @param t(str)  a tag, looking like <name attr="val">, to be anonymized
+  # @param label=None(str)  name of the tag, if known already
+  # @return (str) Anonymized tag
+  def tag(self, t, label=None):
+    '''
+    Anonymize a tag in one pass over its attributes, see anonym_tag.
+    '''
+    if label is None:
+      label = re_tag_label.match(t).group('label')
+    if label in self.exempted:
+      return t
+    edits = []
+    for m_attr in re_attr.finditer(t):
+      name = m_attr.group('name')
+      if name in self.kept:
+        continue
+      value = m_attr.group('dq')
+      if value is None:
+        value = m_attr.group('sq')
+      edits.append((m_attr.start(), m_attr.end(),
+                    ' ' + name + '="' + self.value(name, value) + '"'))
+    if not edits:
+      return t
+    return splice(t, edits)
 
 
 # @param t(str)  a tag, looking like <name attr="val">, to be anonymized
@@ -165,38 +268,310 @@ def anonym_val(v, selectors, mode):
 def anonym_tag(t, selectors, mode):
   '''
   Anonymize a tag, any attribute that doesn't involve styling is anonymized.
+  The AnonymPlan is made once per selectors (the same dict, not changed in
+  between) and mode, and reused by the next calls.
   '''
-  tag_label = re_tag_label.match(t).group('label')
-  if tag_label in EXEMPTED_TAGS:
-    return t
-  new_t = t
-  m_attrs = []
-  for match in re_attr_sq.finditer(t):
-    m_attrs.append(match)
-  for match in re_attr_dq.finditer(t):
-    m_attrs.append(match)
-  for m_attr in m_attrs:
-    name = m_attr.group('name')
-    value = m_attr.group('value')
-    if name in selectors.keys():  # id or class
-      anon_value = anonym_val(value, selectors[name], mode)
-      new_t = new_t.replace(
-        m_attr.group(0),
-        ' {name}="{value}"'.format(name=name, value=anon_value),
-        1)
-    elif name not in HTML_ELEMENTS:  # attributes not useful for styling
-      anon_value = anonym_str(value, mode)
-      new_t = new_t.replace(
-        m_attr.group(0),
-        ' {name}="{value}"'.format(name=name, value=anon_value),
-        1)
-  return new_t
+  key = (id(selectors), mode)
+  cached = _anonym_plans.get(key)
+  if cached is None or cached[0] is not selectors:  # id of a freed dict
+    cached = _anonym_plans[key] = (selectors, AnonymPlan(selectors, mode))
+  return cached[1].tag(t)
 
 #
 # APIs
 #
 
 
+# @param s(str)  markup being tokenized
+# @param state(list)  [start of the pending content, scan position, where
+#                     the scan of a quoted string or tag starting at the
+#                     scan position resumes (None if there is none)],
+#                     updated when the scan stops
+# @param end(int)  end of the markup available so far (exclusive)
+# @param eof(Boolean)  whether the markup ends at end, or more may follow
+# @return (generator)  tokens, as tokenize() yields them, except for the
+#                      content after the last tag, which is left pending
+def _scan(s, state, end, eof):
+  '''
+  Tokenize as far as the available markup allows. Unless at eof, the scan
+  stops wherever more markup could change the outcome (e.g. a tag or a quoted
+  string cut by the end), and can be resumed from state, without scanning
+  again what it has scanned already.
+  '''
+  text, current, resume = state  # text: start of the pending content
+  while current < end:
+    if resume is None:
+      stop = skip_content(s, current, end)
+      if stop < end and s[stop] == '"':  # a string, cut by the end
+        current, resume = stop, stop + 1
+        continue
+      current = stop
+      if (stop < end and s[stop] != '<') or (stop == end - 1 and not eof):
+        break  # unterminated escape, or a '<' which may start '<!'
+      if current >= end:
+        break
+      m_head = re_tag_head.match(s, current, end)
+      if not m_head:
+        current += 1  # a lone '<'
+        continue
+      stop = m_head.end()
+    elif s[current] == '"':
+      stop = re_string_rest.match(s, resume, end).end()
+      if stop >= end or s[stop] != '"':  # the end, or an escape cut by it
+        resume = stop
+        break
+      current, resume = stop + 1, None
+      continue
+    else:
+      stop = re_tag_rest.match(s, resume, end).end()
+    resume = None
+    if stop == end and not eof:
+      resume = stop  # tag cut by the end
+      break
+    if stop == end or s[stop] == '<':
+      current += 1  # a lone '<'
+      continue
+    if current > text:
+      yield (TOKEN_TEXT, text, current, None)
+    label = re_tag_label.match(s, current, stop + 1).group('label')
+    if label in EMPTY_ELEMENTS:
+      kind = TOKEN_EMPTY
+    elif label[0] == '/':
+      kind = TOKEN_CLOSE
+      label = label[1:]
+    else:
+      kind = TOKEN_OPEN
+    yield (kind, current, stop + 1, label)
+    text = current = stop + 1
+  state[:] = [text, current, resume]
+
+
+# @param s(str)  markup to be tokenized
+# @param start=0(int)  where to start
+# @param end=None(int)  where to stop (exclusive), default to the end of s
+# @return (generator)  (kind, start, end, label) tuples, kind being one of
+#                      TOKEN_TEXT, TOKEN_OPEN, TOKEN_CLOSE or TOKEN_EMPTY,
+#                      label the tag name ('/' stripped), None for text
+def tokenize(s, start=0, end=None):
+  '''
+  Split markup into tags and the content between them in one linear pass.
+  Content is skipped the way the browser-facing rules need it: escaped
+  chars and double quoted strings are jumped over (so '<' inside them does
+  not start a tag), and a '<' that does not start a tag is content.
+  '''
+  if end is None:
+    end = len(s)
+  state = [start, start, None]
+  for token in _scan(s, state, end, True):
+    yield token
+  if end > state[0]:
+    yield (TOKEN_TEXT, state[0], end, None)
+
+
+# @param chunks(iterable)  markup, in chunks of any size
+# @return (generator)  (kind, text, label) tuples, see tokenize
+def stream_tokens(chunks):
+  '''
+  Tokenize markup as it comes: only the token being scanned is buffered, so
+  memory depends on the chunk and token sizes, not on the document's.
+  Tokens spanning many chunks are kept in pieces, joined once complete, and
+  every char is scanned once.
+  '''
+  s = ''  # markup being scanned
+  state = [0, 0, None]  # see _scan
+  held = []  # content scanned already, from chunks before s
+  pieces = []  # chunks after s, which can't end the string/tag pending in s
+  carry = ''  # end of the pieces, to be scanned again with the next chunk
+
+  def scan(eof):
+    for kind, start, end, label in _scan(s, state, len(s), eof):
+      if held:
+        content = ''.join(held)
+        del held[:]
+        if kind == TOKEN_TEXT:  # it starts where the held content ends
+          yield (kind, content + s[start:end], label)
+          continue
+        yield (TOKEN_TEXT, content, None)
+      yield (kind, s[start:end], label)
+
+  for chunk in itertools.chain(chunks, [None]):
+    eof = chunk is None  # the pieces are joined and scanned to the end
+    if state[2] is not None and not pieces:
+      carry = s[state[2]:]
+    if eof:
+      chunk = ''
+    elif state[2] is not None:
+      probe = carry + chunk
+      rest = re_string_rest if s[state[1]] == '"' else re_tag_rest
+      stop = rest.match(probe).end()
+      if stop == len(probe) or probe[stop] == '\\':  # still pending
+        pieces.append(chunk)
+        carry = probe[stop:]
+        continue
+    # drop what has been tokenized already, and hold what has been scanned
+    text, current, resume = state
+    if current > text:
+      held.append(s[text:current])
+    if resume is not None:
+      resume = len(s) + sum(map(len, pieces)) - len(carry) - current
+    s = s[current:] + ''.join(pieces) + chunk
+    state[:] = [0, 0, resume]
+    pieces = []
+    for token in scan(eof):
+      yield token
+  if len(s) > state[0] or held:
+    yield (TOKEN_TEXT, ''.join(held) + s[state[0]:], None)
+
+
+# @param tokens(iterable)  (kind, text, label) tuples
+# @return (generator)  markup chunks
+def stream_untokenize(tokens):
+  for kind, text, label in tokens:
+    yield text
+
+
+# @param tokens(iterable)  (kind, text, label) tuples
+# @return (generator)  chunks of the prettified markup
+def stream_prettify(tokens):
+  '''
+  Add indentation to tokens, see prettify.
+  '''
+  depth = -1
+  tagged = False  # what's in front of the first tag is probably comments
+  for kind, text, label in tokens:
+    if kind == TOKEN_TEXT:
+      # start a new line for content after a tag
+      if not tagged:
+        yield text
+      elif not re_empty.match(text):
+        yield indent(text, depth + 1)
+      continue
+    tagged = True
+    # indent tag
+    if kind == TOKEN_EMPTY:  # still need to indent by one unit more
+      yield indent(text, depth + 1)
+    else:  # has effect on depth
+      if kind == TOKEN_CLOSE:
+        depth -= 1
+      else:
+        depth += 1
+      yield indent(text, depth)
+
+
+# @param tokens(iterable)  (kind, text, label) tuples
+# @param selectors(dict)  contains id & class list
+# @param mode(str)  How to replace a string with meaningless chars
+# @return (generator)  anonymized (kind, text, label) tuples
+def stream_anonym(tokens, selectors, mode):
+  '''
+  Anonymize tokens, see anonym_dom.
+  '''
+  plan = AnonymPlan(selectors, mode)
+  tag = None  # last tag
+  for kind, text, label in tokens:
+    if kind != TOKEN_TEXT:
+      tag = text
+      if tag[1] != '/':  # closing tags are harmless
+        text = plan.tag(tag, label)
+    elif tag is not None and\
+      not re_empty.match(text) and\
+      tag[1:7] != 'script':
+      text = anonym_str(text, mode)
+    # before the first tag, whitespaces and scripts are kept
+    yield (kind, text, label)
+
+
+# @param chunks(iterable)  markup, in chunks of any size
+# @return (generator)  chunks without script content, see descript_html
+def stream_descript_html(chunks):
+  return stream_sub(
+    chunks, re_html_js, '<script></script>', '<script', '</script>')
+
+
+# @param chunks(iterable)  markup, in chunks of any size
+# @return (generator)  chunks without onclick attributes, see descript_onclick
+def stream_descript_onclick(chunks):
+  chunks = stream_sub(chunks, re_onclick_sq, '', " onclick='", "'")
+  return stream_sub(chunks, re_onclick_dq, '', ' onclick="', '"')
+
+
+class ElementIndex(object):
+  '''
+  Compact index of the elements of a DOM, built in one pass over its tokens.
+  Element i (numbered in document order of the opening tags) is described
+  by parallel integer arrays:
+    open_start[i], open_end[i]    span of the opening tag
+    close_start[i], close_end[i]  span of the closing tag, -1 if unclosed
+    parent[i]                     enclosing element, -1 for the top level
+    depth[i]                      number of enclosing elements
+  and ids maps the value of an id attribute to the first element having it.
+  Only elements with an opening/closing pair are indexed (not EMPTY_ELEMENTS),
+  and closing tags are paired the same way cut_dom_node does, by nesting
+  only, regardless of their labels.
+  '''
+
+  # @param dom(str)  the DOM to be indexed
+  def __init__(self, dom):
+    self.dom = dom
+    self.open_start = array('l')
+    self.open_end = array('l')
+    self.close_start = array('l')
+    self.close_end = array('l')
+    self.parent = array('l')
+    self.depth = array('l')
+    self.ids = {}
+    stack = []
+    for kind, start, end, label in tokenize(dom):
+      if kind == TOKEN_OPEN:
+        i = len(self.open_start)
+        self.open_start.append(start)
+        self.open_end.append(end)
+        self.close_start.append(-1)
+        self.close_end.append(-1)
+        self.parent.append(stack[-1] if stack else -1)
+        self.depth.append(len(stack))
+        m_id = re_attr_id.search(dom, start, end)
+        if m_id and m_id.group('id') not in self.ids:
+          self.ids[m_id.group('id')] = i
+        stack.append(i)
+      elif kind == TOKEN_CLOSE and stack:
+        i = stack.pop()
+        self.close_start[i] = start
+        self.close_end[i] = end
+
+  def __len__(self):
+    return len(self.open_start)
+
+  # @param id(str)  value of the id attribute
+  # @return (int)  the element with this id, -1 if there is none
+  def find(self, id):
+    return self.ids.get(id, -1)
+
+  # @param i(int)  an element
+  # @return (tuple)  (start, end) of the content between its tags,
+  #                  None if the element is not closed
+  def content(self, i):
+    if self.close_start[i] < 0:
+      return None
+    return (self.open_end[i], self.close_start[i])
+
+  # @param i(int)  an element
+  # @return (tuple)  (start, end) of the element including its tags,
+  #                  None if the element is not closed
+  def subtree(self, i):
+    if self.close_end[i] < 0:
+      return None
+    return (self.open_start[i], self.close_end[i])
+
+  # @param i(int)  an element
+  # @return (generator)  enclosing elements, innermost first
+  def ancestors(self, i):
+    i = self.parent[i]
+    while i >= 0:
+      yield i
+      i = self.parent[i]
+
+
 # @param dom(str)  the content to be prettified.
 # @return (str)  containing prettified content.
 def prettify(dom):
@@ -204,36 +579,7 @@ def prettify(dom):
   Add indentation to a DOM file so that it is easier to read.
   '''
   # delete commenting
-  dom = del_blockcomment(dom)
-  start = 0
-  depth = -1
-  new_dom = ''
-  m_tag = re_tag.search(dom)
-  while m_tag:  # more tags
-    tag = m_tag.group(0)
-    label = re_tag_label.match(tag).group('label')
-    # jump to the start of the tag, what's in front is probably comments
-    current = dom.find(tag, start)
-    if current > 0:
-      new_dom += dom[start:current]
-      start = current
-    # indent tag
-    if label not in EMPTY_ELEMENTS:  # has effect on depth
-      if tag[1] == '/':  # closing tag
-        depth -= 1
-      else:  # opening tag
-        depth += 1
-      new_dom += indent(tag, depth)
-    else:  # still need to indent by one unit more
-      new_dom += indent(tag, depth + 1)
-    # start a new line for content after a tag
-    start += len(tag)
-    current = skip_content(dom, start)
-    if current > start and not re_empty.match(dom[start:current]):
-      new_dom += indent(dom[start:current], depth + 1)
-    start = current
-    m_tag = re_tag.search(dom[start:])
-  return new_dom
+  return ''.join(stream_prettify(stream_tokens(stream_del_blockcomment([dom]))))
 
 
 # @param dom(str)  source file content to be anonymized
@@ -245,34 +591,8 @@ def anonym_dom(dom, selectors, mode):
   Anonymize the script by removing scripts that disclose user info,
   garble contents in the DOM tree, and stuff them back into big pipes.
   '''
-  dom = del_blockcomment(dom)
-  start = 0
-  m_tag = re_tag.search(dom, start)
-  new_dom = ''
-  while m_tag:  # more tags
-    tag = m_tag.group(0)
-    # skipping content before the tag
-    current = m_tag.start()
-    if current > 0:
-      new_dom += dom[start:current]
-      start = current
-    # handle tag
-    if tag[1] == '/':  # closing tags are harmless
-      new_dom += tag
-    else:  # opening tag
-      new_dom += anonym_tag(tag, selectors, mode)
-    # getting none tag part after the tag
-    start = m_tag.end()
-    current = skip_content(dom, start)
-    if current > start and\
-      not re_empty.match(dom[start:current]) and\
-      tag[1:7] != 'script':
-      new_dom += anonym_str(dom[start:current], mode)
-    else:
-      new_dom += dom[start:current]
-    start = current
-    m_tag = re_tag.search(dom, start)
-  return new_dom
+  tokens = stream_tokens(stream_del_blockcomment([dom]))
+  return ''.join(stream_untokenize(stream_anonym(tokens, selectors, mode)))
 
 
 # @param dom(str)  source file content to be anonymized
@@ -283,53 +603,84 @@ def unload_pagelets(dom, pipe_exclude=[]):
   Only remove pagelets from DOM and stuff them back into the big pipes.
   We need to do this because otherwise the pipe content is not localized.
   '''
-  m_pipes = []
-  m_scripts = re_html_js.finditer(dom)
-  for m_script in m_scripts:
-    if re_html_bigpipe.match(m_script.group(0)):
-      m_pipes.append(re_html_bigpipe.match(m_script.group(0)))
-  # to handle pagelet embedding
-  # we scan both the dom and already cut out nodes for
-  pagelets = []
-  nodes = {}   # with which we replace the "content" field of the pipe
-  idx = 0
+  pipes = []  # (start, end, fields) of the big pipe scripts
+  for m_script in re_html_js.finditer(dom):
+    fields = parse_pipe(dom, m_script.start(), m_script.end())
+    if fields is not None and pipe_id(dom, fields) is not None:
+      pipes.append((m_script.start(), m_script.end(), fields))
+  # locate every pagelet in one index of the dom; an embedded pagelet is cut
+  # out of the pagelet that encloses it, whichever comes first in the pipes
+  index = ElementIndex(dom)
+  elements = []  # pagelet elements, -1 if not found (or already taken)
+  taken = set()
   ids = []
-  for m_pipe in m_pipes:
-    id = m_pipe.group('id')[6:-2]
+  for start, end, fields in pipes:
+    id = pipe_id(dom, fields)
     ids.append(id)
-    pagelets.append(m_pipe.groupdict())
-    pagelets[idx]['orig'] = m_pipe.group(0)
-    # try cutting the content from dom tree first
-    rootid = 'id="{id}"'.format(id=id)
-    ret = cut_dom_node(dom, rootid)
-    dom = ret['dom']
-    nodes[idx] = ret['node']
+    element = index.find(id)
+    if element < 0 or element in taken or not index.content(element):
+      element = -1
+    else:
+      taken.add(element)
+    elements.append(element)
+  embedded = {-1: []}  # pagelet element -> pagelets directly embedded in it
+  for element in sorted(taken):
+    outer = -1
+    for ancestor in index.ancestors(element):
+      if ancestor in taken:
+        outer = ancestor
+        break
+    embedded.setdefault(outer, []).append(element)
+    embedded.setdefault(element, [])
+  # with which we replace the "content" field of the pipe: the spans of the
+  # pagelet, around the pagelets embedded in it
+  nodes = {}
+  for idx, element in enumerate(elements):
     # empty pipes: last pagelet & pagelets that are not visible
     # (e.g. pagelet_nav_lite/pagelet_nav_full)
-    # if not found (probably embedded in another node), get it from nodes
-    # NOTE: the orig dom is not affected because the content is cut out already
-    if nodes[idx] == '':
-      for i in range(idx - 1):
-        ret = cut_dom_node(nodes[i], rootid)
-        if ret['node'] != '':
-          nodes[idx] = ret['node']
-          nodes[i] = ret['dom']
-          break
-    idx += 1
-  # assemble the pipes with new content and replace the original pipes
-  for idx in range(len(pagelets)):
+    nodes[idx] = []
+    if element >= 0:
+      pos, end = index.content(element)
+      for inner in embedded[element]:
+        inner_start, inner_end = index.content(inner)
+        nodes[idx].append((pos, inner_start))
+        pos = inner_end
+      nodes[idx].append((pos, end))
+      nodes[idx] = [span for span in nodes[idx] if span[0] < span[1]]
+  edits = EditBuffer(dom)
+  for outer in embedded[-1]:
+    edits.delete(*index.content(outer))
+  # assemble the pipes with new content, in place of the original pipes
+  keep = lambda field: field in PIPE_FIELDS and field not in pipe_exclude
+  for idx, (start, end, fields) in enumerate(pipes):
+    if edits.overlaps(start, end):
+      continue  # a pipe inside a pagelet is gone with the rest of it
     if nodes[idx]:
-      pagelets[idx]['content'] = '"content":{' + pagelets[idx]['id'][5:-1] +\
-      ':"' + jsonify(nodes[idx]) + '"},'
+      # escaped span by span, straight into the pipe
+      pieces = ['"content":{', dom[fields['id'][1]:fields['id'][2]], ':"']
+      pieces.extend(stream_jsonify(dom[span_start:span_end]
+                                   for span_start, span_end in nodes[idx]))
+      pieces.append('"}')
+      content = ''.join(pieces)
     else:
-      pagelets[idx]['content'] = '"content":[],'
-    pipe = '<script>big_pipe.onPageletArrive({'
-    for field in PIPE_FIELDS:
-      if pagelets[idx][field] and field not in pipe_exclude:
-        pipe += pagelets[idx][field]
-    pipe += '});</script>'
-    dom = dom.replace(pagelets[idx]['orig'], pipe, 1)
-  return {'html': dom, 'pagelets': ids}
+      content = '"content":[]'
+    edits.replace(start, end,
+                  build_pipe(dom, fields, keep, {'content': content}))
+  return {'html': edits.apply(), 'pagelets': ids}
+
+
+# @param dom(str)  dom content
+# @return (list)  ids of the pagelets of all big pipes, in order
+def pagelet_ids(dom):
+  '''
+  Same as unload_pagelets(dom)['pagelets'], without unloading anything.
+  '''
+  ids = []
+  for m_script in re_html_js.finditer(dom):
+    fields = parse_pipe(dom, m_script.start(), m_script.end())
+    if fields is not None and pipe_id(dom, fields) is not None:
+      ids.append(pipe_id(dom, fields))
+  return ids
 
 
 # @param dom(str)  source file content to be de-javascripted
@@ -338,7 +689,7 @@ def descript_html(dom):
   '''
   Set all scripts enclosed by a pair of script tags to null.
   '''
-  return re_html_js.sub('<script></script>', dom)
+  return ''.join(stream_descript_html([dom]))
 
 
 # @param dom(str)  source file content to be de-javascripted
@@ -347,11 +698,7 @@ def descript_onclick(dom):
   '''
   Set all onclicks to null.
   '''
-  dom = re_onclick_sq.sub('', dom)
-  dom = re_onclick_dq.sub('', dom)
-  # dom = re_onclick_sq.sub(' onclick=""', dom)
-  # dom = re_onclick_dq.sub(' onclick=""', dom)
-  return dom
+  return ''.join(stream_descript_onclick([dom]))
 
 
 # @param dom(str)  dom content
@@ -360,8 +707,8 @@ def descript_pipeonly(dom):
   '''
   Delete all embedded scripts unless it is related to big pipe.
   '''
-  m_scripts = re_html_js.finditer(dom)
-  for m_script in m_scripts:
+  edits = EditBuffer(dom)
+  for m_script in re_html_js.finditer(dom):
     content = m_script.group('content')
     if content and \
       content[:25] != 'Bootloader.setResourceMap' and\
@@ -372,10 +719,10 @@ def descript_pipeonly(dom):
         if line.find('Bootloader.done') >= 0 or\
           line.find('Bootloader.configurePage') >= 0:
           newlines.append(line)
-      dom = dom.replace(
-        m_script.group(0),
-        '<script>{script}</script>'.format(script='\n'.join(newlines)), 1)
-  return dom
+      edits.replace(
+        m_script.start(), m_script.end(),
+        '<script>{script}</script>'.format(script='\n'.join(newlines)))
+  return edits.apply()
 
 # @param dom(str)  dom content
 # @return (str)  dom content without injected js reference
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/fetch.py
+
+Concurrent retrieval of external resources.
+A Fetcher keeps a bounded pool of worker threads, each of them holding one
+keep-alive connection per host, so that hundreds of small rsrc.php requests
+don't each pay for a new TCP handshake. Callers submit (url, file) pairs and
+wait for all of them before touching the files.
+
+If a resource cache is in use (see FBParser.cache), it is consulted before
+going to the network and fed with whatever gets retrieved.
+If a resource archive is in use (see FBParser.archive), it is consulted
+first; when replaying, it is the only source of resources.
+
+Run this module directly to compare serial and pooled retrieval against a
+local HTTP stand-in that serves fixture files with injected latency.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'Fetcher', 'retrieve', 'retrieve_cached', 'fetch_stats',
+          ]
+
+#
+# Imports
+#
+import sys
+import os
+import time
+import shutil
+import tempfile
+import threading
+import httplib
+from Queue import Queue
+from urllib import urlretrieve
+from urlparse import urlsplit, urljoin
+from FBParser.cache import active_cache
+from FBParser.archive import active_archive
+try:
+  from argparse import ArgumentParser, RawDescriptionHelpFormatter
+except ImportError:
+  ArgumentParser = None
+
+#
+# Internal functions
+#
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 30  # seconds, per connection
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+CONNECTIONS = {'http': httplib.HTTPConnection,
+               'https': httplib.HTTPSConnection}
+
+_stats = {'fetches': 0, 'bytes': 0}  # of this process, see fetch_stats
+_stats_lock = threading.Lock()
+
+
+# @param size(int)  number of bytes retrieved
+def _count(size):
+  with _stats_lock:
+    _stats['fetches'] += 1
+    _stats['bytes'] += size
+
+
+# @param pool(dict)  (scheme, host) -> connection, owned by a single thread
+# @param scheme(str)  'http' or 'https'
+# @param host(str)  host[:port]
+# @param timeout(int)  socket timeout in seconds
+# @return (HTTPConnection)  a connection to the host, reused if possible
+def _get_conn(pool, scheme, host, timeout):
+  '''
+  Get a keep-alive connection to the host from the pool.
+  '''
+  key = (scheme, host)
+  if key not in pool:
+    pool[key] = CONNECTIONS[scheme](host, timeout=timeout)
+  return pool[key]
+
+
+# @param pool(dict)  (scheme, host) -> connection
+# @param scheme(str)  'http' or 'https'
+# @param host(str)  host[:port]
+def _drop_conn(pool, scheme, host):
+  '''
+  Close and forget a connection that can no longer be reused.
+  '''
+  conn = pool.pop((scheme, host), None)
+  if conn:
+    conn.close()
+
+
+# @param url(str)  complete url of the resource
+# @param filename(str)  file to keep the resource
+# @param pool={}(dict)  keep-alive connections of the calling thread
+# @param timeout=DEFAULT_TIMEOUT(int)  socket timeout in seconds
+# @return (int)  number of bytes retrieved
+def retrieve(url, filename, pool=None, timeout=DEFAULT_TIMEOUT):
+  '''
+  Retrieve a single resource and save it to file.
+  http(s) urls go through a (reused) persistent connection and follow
+  redirects like urlretrieve does; anything else (e.g. a local path) is
+  handed to urlretrieve. Raises IOError/ValueError on failure.
+  '''
+  if pool is None:
+    pool = {}
+  for redirect in range(MAX_REDIRECTS + 1):
+    parts = urlsplit(url)
+    if parts.scheme not in CONNECTIONS:
+      urlretrieve(url, filename)
+      if parts.scheme not in ('', 'file'):  # a local copy is no fetch
+        _count(os.path.getsize(filename))
+      return os.path.getsize(filename)
+    if not parts.netloc:
+      raise ValueError('invalid url: ' + url)
+    path = parts.path or '/'
+    if parts.query:
+      path += '?' + parts.query
+    # a kept-alive connection may have been closed by the server meanwhile,
+    # so give a stale connection one more chance with a fresh socket
+    for attempt in range(2):
+      conn = _get_conn(pool, parts.scheme, parts.netloc, timeout)
+      try:
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        break
+      except (httplib.HTTPException, IOError):
+        _drop_conn(pool, parts.scheme, parts.netloc)
+        if attempt:
+          raise
+    if resp.status in (301, 302, 303, 307) and resp.getheader('location'):
+      resp.read()
+      url = urljoin(url, resp.getheader('location'))
+      continue
+    if resp.status != 200:
+      resp.read()
+      raise IOError('HTTP {status} {reason}'.format(
+        status=resp.status, reason=resp.reason))
+    size = 0
+    f = open(filename, 'wb')
+    try:
+      chunk = resp.read(CHUNK_SIZE)
+      while chunk:
+        f.write(chunk)
+        size += len(chunk)
+        chunk = resp.read(CHUNK_SIZE)
+    finally:
+      f.close()
+    if resp.will_close:
+      _drop_conn(pool, parts.scheme, parts.netloc)
+    _count(size)
+    return size
+  raise IOError('too many redirects: ' + url)
+
+
+# @param url(str)  complete url of the resource
+# @param filename(str)  file to keep the resource
+# @param pool={}(dict)  keep-alive connections of the calling thread
+# @param timeout=DEFAULT_TIMEOUT(int)  socket timeout in seconds
+# @param cache=None(ResourceCache)  cache to consult, default to the active one
+# @return (int)  number of bytes retrieved, 0 if served by the cache or the
+#                archive
+def retrieve_cached(url, filename, pool=None, timeout=DEFAULT_TIMEOUT,
+                    cache=None):
+  '''
+  Same as retrieve, but go through the resource archive, if one is in use,
+  then the resource cache, for http(s) urls. A replayed archive is the only
+  source of those: urls it doesn't have raise IOError. Anything else (e.g.
+  a local path) is copied as is, as it is not the same resource in another
+  directory.
+  The file is written under a temporary name and renamed when complete.
+  '''
+  archive = None
+  if urlsplit(url).scheme not in CONNECTIONS:
+    cache = None
+  else:
+    archive = active_archive()
+    if cache is None:
+      cache = active_cache()
+  if archive is not None and archive.materialize(url, filename + '.part'):
+    os.rename(filename + '.part', filename)
+    return 0
+  if archive is not None and archive.mode == 'replay':
+    raise IOError('not in the archive: ' + url)
+  if cache is not None and cache.materialize(url, filename):
+    size = 0
+  else:
+    start = time.time()
+    try:
+      size = retrieve(url, filename + '.part', pool, timeout)
+    except:
+      if os.path.isfile(filename + '.part'):
+        os.remove(filename + '.part')
+      raise
+    os.rename(filename + '.part', filename)
+    if cache is not None:
+      cache.store(url, filename, time.time() - start)
+  if archive is not None:  # recording
+    archive.record(url, filename)
+  return size
+
+#
+# APIs
+#
+
+
+# @return (dict)  number of resources and bytes retrieved so far, by any
+#                 fetcher of this process (cache hits are not retrievals)
+def fetch_stats():
+  with _stats_lock:
+    return dict(_stats)
+
+
+class Fetcher(object):
+  '''
+  A bounded pool of worker threads retrieving resources concurrently.
+  Usage:
+    fetcher = Fetcher()
+    fetcher.submit(url, dir, file)
+    ...
+    failures = fetcher.wait()  # blocks until every submitted url is done
+  Files that already exist are skipped, and urls that cannot be retrieved
+  are appended to missing_files.log in the target directory, just like
+  FBParser.save_resource does.
+  '''
+
+  # @param workers=DEFAULT_WORKERS(int)  maximum number of concurrent fetches
+  # @param timeout=DEFAULT_TIMEOUT(int)  socket timeout in seconds
+  # @param cache=None(ResourceCache)  cache to go through, default to the
+  #                                   active one
+  def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT,
+               cache=None):
+    self.workers = max(1, workers)
+    self.timeout = timeout
+    self.cache = cache if cache is not None else active_cache()
+    self.fetched = 0  # number of resources actually retrieved
+    self.bytes = 0  # number of bytes retrieved
+    self._queue = Queue()
+    self._lock = threading.Lock()
+    self._pending = set()  # target files submitted but not written yet
+    self._failures = []
+    self._threads = []
+
+  def _start(self):
+    while len(self._threads) < self.workers:
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _work(self):
+    pool = {}  # keep-alive connections of this worker, one per host
+    while True:
+      job = self._queue.get()
+      if job is None:
+        break
+      url, dir, file = job
+      target = os.path.join(dir, file)
+      try:
+        size = retrieve_cached(url, target, pool, self.timeout, self.cache)
+      except Exception, err:  # one bad resource must not stop the worker
+        print >> sys.stderr, "Cannot retrieve {url}: {err}".format(
+          url=url, err=err)
+        with self._lock:
+          self._failures.append(url)
+          try:
+            f = open(os.path.join(dir, 'missing_files.log'), 'a')
+            f.write(url + ' ' + file + '\n')
+            f.close()
+          except IOError, err:
+            print >> sys.stderr, err
+      else:
+        with self._lock:
+          if size:
+            self.fetched += 1
+            self.bytes += size
+      finally:
+        with self._lock:
+          self._pending.discard(target)
+        self._queue.task_done()
+    for conn in pool.values():
+      conn.close()
+
+  # @param url(str)  complete url of the external resource
+  # @param dir(str)  Directory where the file should be saved
+  # @param file(str)  Name of the file to be saved
+  # @return (Boolean)  whether a retrieval has been scheduled
+  def submit(self, url, dir, file):
+    '''
+    Schedule a resource to be retrieved, unless the file is already there
+    or is being retrieved.
+    '''
+    target = os.path.join(dir, file)
+    with self._lock:
+      if target in self._pending or os.path.isfile(target):
+        return False
+      self._pending.add(target)
+    self._start()
+    self._queue.put((url, dir, file))
+    return True
+
+  # @return (list)  urls that failed since the last wait
+  def wait(self):
+    '''
+    Block until all submitted resources are retrieved (or given up on).
+    '''
+    self._queue.join()
+    with self._lock:
+      failures = self._failures
+      self._failures = []
+    return failures
+
+  def close(self):
+    '''
+    Wait for outstanding work and stop the workers.
+    '''
+    self.wait()
+    for thread in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+#
+# Default
+#
+
+
+# @param dir(str)  directory whose files are served
+# @param latency(float)  seconds to sleep before answering each request
+# @return (HTTPServer)  a running server on a free localhost port
+def _serve_fixtures(dir, latency):
+  '''
+  A local stand-in for the CDN, serving the files under dir with latency.
+  '''
+  from BaseHTTPServer import HTTPServer
+  from SimpleHTTPServer import SimpleHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+
+  class Handler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def translate_path(self, path):
+      return os.path.join(dir, path.split('?', 1)[0].lstrip('/'))
+
+    def do_GET(self):
+      time.sleep(latency)
+      SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, format, *args):
+      pass
+
+  class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+  server = Server(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def main():
+  parser = ArgumentParser(
+    formatter_class=RawDescriptionHelpFormatter,
+    description=__doc__)
+  parser.add_argument('dir', help='directory of fixture files to serve')
+  parser.add_argument('-l', '--latency', type=float, default=0.05,
+                      help='seconds of latency injected into each request')
+  parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS)
+  args = parser.parse_args()
+  files = [entry for entry in sorted(os.listdir(args.dir))
+           if os.path.isfile(os.path.join(args.dir, entry))]
+  server = _serve_fixtures(args.dir, args.latency)
+  site = 'http://127.0.0.1:{port}/'.format(port=server.server_address[1])
+  for workers in (1, args.workers):
+    out = tempfile.mkdtemp()
+    fetcher = Fetcher(workers)
+    start = time.time()
+    for file in files:
+      fetcher.submit(site + file, out, file)
+    failures = fetcher.wait()
+    elapsed = time.time() - start
+    fetcher.close()
+    for file in files:
+      if open(os.path.join(args.dir, file), 'rb').read() != \
+         open(os.path.join(out, file), 'rb').read():
+        failures.append(file)
+    print "{workers} worker(s): {n} files, {bytes} bytes in {t:.2f}s, " \
+          "{f} failure(s)".format(workers=workers, n=fetcher.fetched,
+                                  bytes=fetcher.bytes, t=elapsed,
+                                  f=len(failures))
+    shutil.rmtree(out)
+  server.shutdown()
+
+if __name__ == '__main__':
+  main()
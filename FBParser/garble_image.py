@@ -4,13 +4,14 @@ FBParser/garble_image.py
 
 Convert a JPEG image to blurred noise (most photos, thumnails).
 Replace a PNG image by white rectangle (some ads pictures).
-GIF images are left untouched, for now.
+Replace a GIF image by noise over its own palette (sprites, spacers).
 All images retain their original height and width.
+PNG and GIF images are not even decoded, their headers tell all we need.
 '''
 __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 
 __all__ = [
-            'garble',
+            'garble', 'placehold',
           ]
 
 #
@@ -18,11 +19,20 @@ __all__ = [
 #
 import sys
 import os
+import time
 import struct
+import hashlib
 import Image
-import random
+from cStringIO import StringIO
+import signal
+import multiprocessing
+from FBParser.cache import temp_file
 from Crypto.Cipher import Blowfish
 from Crypto.Util.randpool import RandomPool
+try:
+  from Crypto.Random import atfork
+except ImportError:  # pycrypto < 2.1 has no RNG state to reseed
+  atfork = lambda: None
 try:
   from argparse import ArgumentParser, RawDescriptionHelpFormatter
 except ImportError:
@@ -39,6 +49,21 @@ except ImportError:
 # Constants used by encryption and padding
 KEY_LEN = 8  # key length
 BLK_LEN = 8  # block size
+DEFAULT_TIMEOUT = 60  # seconds, per image in parallel mode
+# to be bumped whenever garbling changes, so that cached images are not reused
+GARBLE_MODE = 'garble-1'
+
+# headers read by the PNG/GIF fast paths
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+GIF_SIGNATURES = ('GIF87a', 'GIF89a')
+HEADER_LEN = 13 + 256 * 3  # GIF screen descriptor and global color table
+MAX_PIXELS = 1 << 26  # larger headers are more likely corrupted than real
+PLACEHOLDER_CACHE_SIZE = 1024  # encoded placeholders, by size and format
+PLACEHOLDER_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.gif': 'GIF'}
+TEMP_SUFFIX = '.garble.'  # image + TEMP_SUFFIX + random: being written
+
+_placeholders = {}  # (width, height, format) -> placeholder, encoded
+_color_tables = {}  # number of colors -> byte -> palette index
 
 
 # @return (dict)  Arguments in a dictionary
@@ -75,50 +100,227 @@ def _get_args():
       ''',
     nargs='?',
     default='.')
+  parser.add_argument(
+    '-j', '--jobs',
+    help='''
+      Number of images garbled in parallel, default to one per core.
+      ''',
+    type=int,
+    default=0)
+  parser.add_argument(
+    '--timeout',
+    help='''
+      Seconds allowed to each image when garbling in parallel, default to
+      {timeout}.
+      '''.format(timeout=DEFAULT_TIMEOUT),
+    type=int,
+    default=DEFAULT_TIMEOUT)
   return parser.parse_args()
 
 
-# @param data(Image data)  a list like object containing pixel information
-# @param mode(Image mode)  (color) mode of the image
-# @return (list)  A string (gif) or list of encrypted pixels
-def _encrypt(data, mode='RGB'):
+# raw pixel buffers: tobytes/frombytes in Pillow, tostring/fromstring in PIL
+if hasattr(Image, 'frombytes'):
+  _tobytes = Image.Image.tobytes
+  _frombytes = Image.frombytes
+else:
+  _tobytes = Image.Image.tostring
+  _frombytes = Image.fromstring
+
+
+# @param img(Image)  image whose pixels are to be encrypted
+# @return (Image)  A new image of the same mode and size, or the original one
+#                  if its mode is not supported
+def _encrypt(img):
   '''
-  Encrypt the pixels (as a concatinated string).
+  Encrypt the pixels, as one contiguous buffer of raw bytes.
   '''
-  # unit: how many bytes does the smallest component have
-  # size: how many components does each pixel have
-  if mode == '1' or mode == 'I' or mode == 'F':
-    print "Mode {mode} is not supported at the moment!".format(mode=mode)
-    return []
-  else:
-    unit = 1
-    format = 'B'
-  cleartext = ''
-  if type(data[0]) == int:
-    pixel_size = 1
-    for pixel in data:
-      cleartext += chr(pixel)
-  else:
-    pixel_size = len(data[0])  # get the vector size based on the last pixel
-    for pixel in data:
-      for val in pixel:
-        cleartext += chr(val)
-  num_pixels = len(data)
+  if img.mode == '1' or img.mode == 'I' or img.mode == 'F':
+    print "Mode {mode} is not supported at the moment!".format(mode=img.mode)
+    return img
+  cleartext = _tobytes(img)
   # encrypt the data string, pay attention to the length
-  key = RandomPool().get_bytes(KEY_LEN)
-  blowfish = Blowfish.new(key, mode=2)
+  pool = RandomPool()
+  key = pool.get_bytes(KEY_LEN)
+  # recent pycrypto insists on an explicit IV in CBC mode
+  blowfish = Blowfish.new(key, Blowfish.MODE_CBC, pool.get_bytes(BLK_LEN))
   padding = '\x00' * (BLK_LEN - (len(cleartext) - 1) % BLK_LEN - 1)
-  cleartext += padding
-  ciphered = blowfish.encrypt(cleartext)
+  ciphered = blowfish.encrypt(cleartext + padding)
   ciphered = ciphered[len(padding):]  # don't really care if data is messed...
-  ret = []
-  chunk_size = unit * pixel_size
-  for i in range(num_pixels):
-    pixel = struct.unpack(
-      format * pixel_size,
-      ciphered[chunk_size * i: chunk_size * (1 + i)])
-    ret.append(pixel)
-  return ret
+  return _frombytes(img.mode, img.size, ciphered)
+
+
+# @param size(tuple)  (width, height)
+# @param format='PNG'(str)  format of the file, as named by PIL
+# @return (str)  content of an image file, a solid rectangle of the size
+def _placeholder(size, format='PNG'):
+  content = _placeholders.get((size, format))
+  if content is None:
+    buf = StringIO()
+    Image.new("RGB", size, "orange").save(buf, format)
+    content = buf.getvalue()
+    if len(_placeholders) >= PLACEHOLDER_CACHE_SIZE:
+      _placeholders.clear()
+    _placeholders[(size, format)] = content
+  return content
+
+
+# @param size(tuple)  (width, height)
+# @param palette(str)  RGB triplets
+# @return (str)  content of a GIF file, random pixels of the palette
+def _gif_noise(size, palette):
+  colors = max(1, len(palette) // 3)
+  if colors not in _color_tables:
+    _color_tables[colors] = ''.join(chr(i % colors) for i in range(256))
+  noise = os.urandom(size[0] * size[1]).translate(_color_tables[colors])
+  img = _frombytes('P', size, noise)
+  img.putpalette(palette)
+  buf = StringIO()
+  img.save(buf, 'GIF')
+  return buf.getvalue()
+
+
+# @param head(str)  first HEADER_LEN bytes of an image file
+# @return (str)  content of the garbled PNG/GIF file, None if the header
+#                alone is not enough
+def _garble_header(head):
+  '''
+  Garble a PNG or GIF image from its header, without decoding it.
+  '''
+  if head[:8] == PNG_SIGNATURE and head[12:16] == 'IHDR':
+    width, height = struct.unpack('>II', head[16:24])
+    if 0 < width * height <= MAX_PIXELS:
+      return _placeholder((width, height))
+  elif head[:6] in GIF_SIGNATURES and len(head) >= 13:
+    width, height, flags = struct.unpack('<HHB', head[6:11])
+    if flags & 0x80 and 0 < width * height <= MAX_PIXELS:
+      # global color table
+      palette = head[13:13 + 3 * (2 << (flags & 7))]
+      if len(palette) == 3 * (2 << (flags & 7)):
+        return _gif_noise((width, height), palette)
+  return None
+
+
+# @param filename(str)  file to be hashed
+# @return (str)  hex SHA-1 digest of the content
+def _hash_file(filename):
+  f = open(filename, 'rb')
+  sha1 = hashlib.sha1(f.read())
+  f.close()
+  return sha1.hexdigest()
+
+
+# @param image(str)  image file name (with full path)
+# @param content(str)  new content of the image
+def _replace(image, content):
+  '''
+  Replace an image by a new file, written under a temporary name first, so
+  that an image is never left half written, and a hardlinked one (e.g. from
+  a GarbleCache) is left alone.
+  '''
+  dir, name = os.path.split(image)
+  tmp = temp_file(dir or '.', name + TEMP_SUFFIX)
+  try:
+    f = open(tmp, 'wb')
+    try:
+      f.write(content)
+    finally:
+      f.close()
+    os.rename(tmp, image)
+  except:
+    os.remove(tmp)
+    raise
+
+
+# @param images(list)  image file names (with full path)
+def _remove_temp_files(images):
+  '''
+  Remove what was being written for the images by workers that were
+  terminated.
+  '''
+  for dir, name in set(os.path.split(image) for image in images):
+    for entry in os.listdir(dir or '.'):
+      if entry.startswith(name + TEMP_SUFFIX):
+        os.remove(os.path.join(dir, entry))
+
+
+# @param image(str)  image file name (with full path)
+# @return (Boolean)  whether the image is garbled
+def _garble_one(image):
+  '''
+  Garble a single image, in place. Images of another format are left as
+  they are, and not garbled.
+  '''
+  f = open(image, 'rb')
+  garbled = _garble_header(f.read(HEADER_LEN))
+  if garbled is None:
+    f.seek(0)
+    try:
+      img = Image.open(f)
+      img.load()
+    except StandardError:
+      f.close()
+      return False
+    if img.format == 'JPEG':
+      buf = StringIO()
+      _encrypt(img).save(buf, 'JPEG')
+      garbled = buf.getvalue()
+    elif img.format == 'PNG':
+      garbled = _placeholder(img.size)
+    elif img.format == 'GIF':  # e.g. local color tables only
+      palette = img.getpalette() or [v for v in range(256) for c in 'rgb']
+      garbled = _gif_noise(img.size, ''.join(map(chr, palette)))
+  f.close()
+  if garbled is None:
+    return False
+  _replace(image, garbled)
+  return True
+
+
+# @param image(str)  image file name (with full path)
+# @return (str)  'garbled' or 'failed'
+def _garble_status(image):
+  '''
+  Garble a single image, reporting the errors rather than raising them:
+  one bad image must not stop the others.
+  '''
+  try:
+    return 'garbled' if _garble_one(image) else 'failed'
+  except Exception, err:
+    print >> sys.stderr, "Cannot garble {image}: {err}".format(
+      image=image, err=err)
+    return 'failed'
+
+
+class _Timeout(BaseException):  # not one of the errors of an image
+  pass
+
+
+def _on_alarm(signum, frame):
+  raise _Timeout()
+
+
+def _init_worker():
+  atfork()  # the forked RNG state must not be shared
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles ^C
+  signal.signal(signal.SIGALRM, _on_alarm)
+
+
+# @param job(tuple)  (image file name, timeout in seconds)
+# @return (tuple)  (image, 'garbled', 'failed' or 'timed out')
+def _garble_job(job):
+  '''
+  Garble an image in a worker process, giving up after the timeout.
+  '''
+  image, timeout = job
+  signal.alarm(int(timeout))
+  try:
+    try:
+      status = _garble_status(image)
+    finally:
+      signal.alarm(0)
+  except _Timeout:
+    status = 'timed out'
+  return image, status
 
 #
 # APIs
@@ -126,40 +328,88 @@ def _encrypt(data, mode='RGB'):
 
 
 # @param images(list)  A list of image file names (with full path).
+# @param workers=1(int)  number of processes, 0 for one per core
+# @param timeout=DEFAULT_TIMEOUT(int)  seconds allowed to each image when
+#                                      garbling in parallel
+# @param progress=None(file)  where to report each image as it is done
+# @param cache=None(GarbleCache)  images garbled before, see FBParser.cache
 # @return (list)  A list of images that are successfully garbled.
-def garble(images):
-  '''ig.
-  convert a list of images.
+def garble(images, workers=1, timeout=DEFAULT_TIMEOUT, progress=None,
+           cache=None):
+  '''
+  Convert a list of images.
+  An image that cannot be garbled is left as it is, and not returned: it is
+  up to the caller to placehold (or drop) it.
+  With more than one worker, images are garbled by a pool of processes,
+  and an image taking longer than the timeout is given up on.
+  With a cache, an image whose content has been garbled before (on any
+  page) is replaced by the cached result, and new results are cached.
+  '''
+  done = {}
+  keys = {}  # image -> cache key, from the content of the original image
+  todo = []
+  for image in images:
+    if cache is not None:
+      keys[image] = GARBLE_MODE + '/' + _hash_file(image)
+      if cache.materialize(keys[image], image):
+        done[image] = True
+        if progress:
+          print >> progress, "[{count}/{total}] {image} cached".format(
+            count=len(done), total=len(images), image=image)
+        continue
+    todo.append(image)
+  if workers <= 0:
+    workers = multiprocessing.cpu_count()
+  workers = min(workers, len(todo))
+  if workers <= 1:
+    results = ((image, _garble_status(image)) for image in todo)
+  else:
+    pool = multiprocessing.Pool(workers, _init_worker)
+    results = pool.imap_unordered(
+      _garble_job, [(image, timeout) for image in todo])
+  start = time.time()
+  try:
+    for count in range(len(todo)):
+      if workers <= 1:
+        image, status = next(results)
+      else:
+        # every busy worker gives up within the timeout, unless it died
+        image, status = results.next(2 * timeout)
+      done[image] = status == 'garbled'
+      if progress:
+        print >> progress, "[{count}/{total}] {image} {status}".format(
+          count=len(done), total=len(images), image=image, status=status)
+  except multiprocessing.TimeoutError:
+    print >> sys.stderr, "Garbling stalled, {n} image(s) left as they are"\
+      .format(n=len(images) - len(done))
+  finally:
+    if workers > 1:
+      pool.terminate()
+      pool.join()
+      _remove_temp_files([image for image in todo if image not in done])
+  if cache is not None and todo:
+    seconds = (time.time() - start) / len(todo)
+    for image in todo:
+      if done.get(image):
+        cache.store(keys[image], image, seconds)
+  return [image for image in images if done.get(image)]
+
+
+# @param images(list)  A list of image file names (with full path).
+def placehold(images):
+  '''
+  Replace images by solid rectangles of the same size (1x1 if it cannot be
+  told), in the format of their extension, e.g. those garble could not
+  garble. Missing images are created.
   '''
-  success = []
   for image in images:
-    f = open(image, 'rb')
-    img_mapping = {}
     try:
-      img = Image.open(f)
-      img.load()
+      size = Image.open(image).size  # only reads the header
     except StandardError:
-      f.close()
-    else:
-      f.close()
-      if img.format == 'JPEG':
-        data = img.getdata()
-        if img.mode != 'RGB' and img.mode != 'RGBA':
-          img = img.convert('RGBA')
-        img.putdata(_encrypt(data), 1, 0)
-        img.save(image, 'JPEG')
-      elif img.format == 'PNG':
-        size = img.size
-        img = Image.new("RGB", size, "orange")
-        img.save(image, 'PNG')
-      elif img.format == 'GIF':
-        pixels = []
-        for pixel in range(img.size[0] * img.size[1]):
-          pixels.append(random.uniform(0, 255))
-        img.putdata(pixels, 1, 0)
-        img.save(image, 'GIF')
-      success.append(image)
-  return success
+      size = (1, 1)
+    format = PLACEHOLDER_FORMATS.get(
+      os.path.splitext(image)[1].lower(), 'PNG')
+    _replace(image, _placeholder(size, format))
 
 #
 # Default
@@ -174,7 +424,7 @@ def main():
     if type[0] != '.':
       type = '.' + type
   if args.file:
-    args.file = os.path.realpath(os.path.expanduser(args.path))
+    args.file = os.path.realpath(os.path.expanduser(args.file))
     if not os.path.isfile(args.file):
       print >> sys.stderr, "{file} is not a file".format(file=args.file)
       sys.exit(1)
@@ -192,7 +442,7 @@ def main():
         if os.path.splitext(entry)[1] in args.type:
           images.append(os.path.join(args.dir, entry))
   print images
-  garble(images)
+  garble(images, args.jobs, args.timeout, sys.stdout)
 
 if __name__ == '__main__':
   main()
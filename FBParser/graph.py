@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/graph.py
+
+A dependency graph of transforms, to build several variants of a page that
+share intermediate results.
+Every node is a named value computed by a transform from the values of the
+nodes it depends on. Building a set of targets computes each node they need
+exactly once, and nothing else; with more than one worker, transforms that
+don't depend on each other run in parallel processes.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'TransformGraph',
+          ]
+
+#
+# Imports
+#
+import sys
+import signal
+import traceback
+import multiprocessing
+from Queue import Queue, Empty
+
+#
+# Internal functions
+#
+
+WAIT = 1  # seconds between checks for ^C while waiting for a worker
+
+_graph = None  # the graph being built, inherited by the forked workers
+
+
+def _init_worker():
+  signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles ^C
+
+
+# @param job(tuple)  (name of the node, values of its dependencies)
+# @return (tuple)  (name, success, value or traceback)
+def _run_job(job):
+  name, inputs = job
+  try:
+    return name, True, _graph.nodes[name]['func'](*inputs)
+  except Exception:  # reported, and raised, by the parent
+    return name, False, traceback.format_exc()
+
+#
+# APIs
+#
+
+
+class TransformGraph(object):
+  '''
+  Named values and the transforms deriving them from one another.
+  Usage:
+    graph = TransformGraph()
+    graph.add('dom', lambda: localize(get_content(file)), local=True)
+    graph.add('dom_12', FBParser.dom.descript_onclick, ['dom'])
+    graph.add('css1js0', FBParser.dom.descript_html, ['dom_12'])
+    values = graph.build(['css1js0'], workers=4)
+  Nodes must be added after the nodes they depend on. Transforms run in
+  worker processes unless they are local, i.e. they have side effects on
+  the parent process or are too cheap to be worth shipping their input to
+  a worker; values going to or coming from workers must be picklable.
+  Workers are forked, so transforms need not be picklable themselves.
+  '''
+
+  def __init__(self):
+    self.nodes = {}
+    self.order = []  # names, in the order they were added
+
+  # @param name(str)  name of the node
+  # @param func(function)  transform, taking the values of deps in order
+  # @param deps=()(list)  names of the nodes the value is computed from
+  # @param local=False(Boolean)  whether to always run func in this process
+  def add(self, name, func, deps=(), local=False):
+    if name in self.nodes:
+      raise ValueError('duplicate node: ' + name)
+    for dep in deps:
+      if dep not in self.nodes:
+        raise ValueError('unknown node: ' + dep)
+    self.nodes[name] = {'func': func, 'deps': list(deps), 'local': local}
+    self.order.append(name)
+
+  # @param targets(list)  names of nodes
+  # @return (list)  the targets and every node they depend on, in the order
+  #                 they were added
+  def needed(self, targets):
+    needed = set()
+    stack = list(targets)
+    while stack:
+      name = stack.pop()
+      if name not in self.nodes:
+        raise ValueError('unknown node: ' + name)
+      if name not in needed:
+        needed.add(name)
+        stack.extend(self.nodes[name]['deps'])
+    return [name for name in self.order if name in needed]
+
+  # @param targets(list)  names of the nodes to be built
+  # @param workers=1(int)  number of processes, 0 for one per core
+  # @return (dict)  name -> value, of the targets
+  def build(self, targets, workers=1):
+    '''
+    Compute the targets, and the intermediate values they need only once.
+    An intermediate value is dropped as soon as every node using it is
+    done, so that only the live branches are held in memory.
+    '''
+    global _graph
+    pending = self.needed(targets)
+    users = dict((name, 0) for name in pending)
+    for name in pending:
+      for dep in self.nodes[name]['deps']:
+        users[dep] += 1
+    values = {}
+    if workers <= 0:
+      workers = multiprocessing.cpu_count()
+    pool = None
+    if workers > 1 and \
+       len([name for name in pending if not self.nodes[name]['local']]) > 1:
+      _graph = self
+      pool = multiprocessing.Pool(workers, _init_worker)
+    results = Queue()  # filled by the result thread of the pool
+    running = set()
+
+    def store(name, value):
+      values[name] = value
+      for dep in self.nodes[name]['deps']:
+        users[dep] -= 1
+        if not users[dep] and dep not in targets:
+          del values[dep]
+
+    try:
+      while pending or running:
+        ready = [name for name in pending
+                 if all(dep in values for dep in self.nodes[name]['deps'])]
+        local = None
+        for name in ready:
+          if pool is None or self.nodes[name]['local']:
+            local = local or name
+            continue
+          pending.remove(name)
+          running.add(name)
+          pool.apply_async(
+            _run_job,
+            ((name, [values[dep] for dep in self.nodes[name]['deps']]),),
+            callback=results.put)
+        if local is not None:  # workers keep going meanwhile
+          pending.remove(local)
+          node = self.nodes[local]
+          store(local, node['func'](*[values[dep] for dep in node['deps']]))
+          continue
+        try:
+          name, ok, value = results.get(True, WAIT)
+        except Empty:
+          continue
+        running.remove(name)
+        if not ok:
+          print >> sys.stderr, value
+          raise RuntimeError('transform failed: ' + name)
+        store(name, value)
+    except:
+      if pool is not None:
+        pool.terminate()
+        pool = None
+      raise
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+      _graph = None
+    return dict((name, values[name]) for name in targets)
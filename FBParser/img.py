@@ -8,15 +8,17 @@ __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 
 
 __all__ = [
-            'img_in_html', 'img_in_css',
+            'img_in_html', 'img_in_css', 'img_edits_in_html',
           ]
 
 #
 # Imports
 #
+from FBParser.Constants import REF_IMG_HTML
 from FBParser.regexp import re_css_img, re_html_img
 from FBParser import garble_image
-from FBParser import save_content, url_to_file, save_resource
+from FBParser import save_content, url_to_file, save_resource, splice
+from FBParser.fetch import Fetcher
 # external imports
 from urllib import unquote
 
@@ -30,46 +32,83 @@ from urllib import unquote
 # @param site='http://www.facebook.com'(str)  Domain prefix of the image urls
 # @param dir=''(str)  Directory where the file should be saved
 # @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
 # @return (dict) string with url replaced by local file,
 #                and a set of images that are included
 def img_in_css(s,
                localize=True,
                site='http://static.ak.fbcdn.net',
                dir='',
-               prefix=''):
+               prefix='',
+               fetcher=None):
   '''
   Retrieve image information from the CSS and download them.
   '''
+  pool = Fetcher() if fetcher is None else fetcher
   images = set()
+  edits = []
   m_images = re_css_img.finditer(s)
   for m_image in m_images:
     url = m_image.group('url')
     file = url_to_file(url)
     if localize and url[0:9] == '/rsrc.php':
       images.add(prefix + file)
-      s = s.replace(url, prefix + file, 1)
-      save_resource(site + url, dir, file)
+      edits.append((m_image.start('url'), m_image.end('url'), prefix + file))
+      save_resource(site + url, dir, file, pool)
     else:  # just form the set, don't need to be or already localized
       images.add(url)
-  return {'source': s, 'images': images}
+  if fetcher is None:
+    pool.close()
+  return {'source': splice(s, edits), 'images': images}
 
 
 # @param s(str)  a string that may contain url of image files
 # @param localize(Boolean)  Wether these images should be fetched and saved
 # @param dir=''(str)  Directory where the file should be saved
 # @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
 # @return (dict)  html with image url replaced by new names,
-#                 and a dictionary mapping original filenames to new names
+#                 a dictionary mapping original filenames to new names,
+#                 and the edits made to s (see splice)
 def img_in_html(s,
                 localize=True,
                 site='http://static.ak.fbcdn.net',
                 dir='',
-                prefix=''):
+                prefix='',
+                fetcher=None):
   '''
   Retrieve image information from the DOM/src and download them.
   '''
-  m_images = re_html_img.finditer(s)
+  ret = img_edits_in_html({REF_IMG_HTML: re_html_img.finditer(s)},
+                          localize, site, dir, prefix, fetcher)
+  ret['source'] = splice(s, ret['edits'])
+  return ret
+
+
+# @param refs(dict)  references in a page, as found by
+#                    FBParser.scan.scan_resources
+# @param localize(Boolean)  Wether these images should be fetched and saved
+# @param dir=''(str)  Directory where the file should be saved
+# @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
+# @return (dict)  a set of images that are included,
+#                 and the edits localizing them (see splice)
+def img_edits_in_html(refs,
+                      localize=True,
+                      site='http://static.ak.fbcdn.net',
+                      dir='',
+                      prefix='',
+                      fetcher=None):
+  '''
+  Same as img_in_html, on references scanned beforehand.
+  '''
+  pool = Fetcher() if fetcher is None else fetcher
+  m_images = refs[REF_IMG_HTML]
   images = set()
+  edits = []
   for m_image in m_images:
     url = m_image.group('url')
     if url[0] == '/':
@@ -77,9 +116,11 @@ def img_in_html(s,
     if localize:
       file = url_to_file(url)
       download_url = unquote(url).replace('&amp;', '&')
-      save_resource(download_url, dir, file)
+      save_resource(download_url, dir, file, pool)
       images.add(prefix + file)
-      s = s.replace(url, prefix + file, 1)
+      edits.append((m_image.start('url'), m_image.end('url'), prefix + file))
     else:  # only getting a list of urls
       images.add(url)
-  return {'source': s, 'images': images}
+  if fetcher is None:
+    pool.close()
+  return {'images': images, 'edits': edits}
@@ -8,13 +8,16 @@ __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 
 __all__ = [
             'js_in_html', 'js_in_json', 'remove_cavalry',
+            'js_edits_in_html', 'js_edits_in_json',
           ]
 
 #
 # Imports
 #
+from FBParser.Constants import REF_JS_HTML, REF_JS_JSON
 from FBParser.regexp import re_json_js, re_html_js
-from FBParser import dejsonify, url_to_file, save_resource
+from FBParser import dejsonify, url_to_file, save_resource, splice
+from FBParser.fetch import Fetcher
 
 #
 # APIs
@@ -25,53 +28,107 @@ from FBParser import dejsonify, url_to_file, save_resource
 # @param localize(Boolean)  Wether these js files should be retrieved and saved
 # @param dir=''(str)  Directory where the files should be saved
 # @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
 # @return (dict)  source with js urls replaced by local files (if localize),
-#                 and a set of javascript files that are included
-def js_in_html(s, localize=True, dir='', prefix=''):
+#                 a set of javascript files that are included,
+#                 and the edits made to s (see splice)
+def js_in_html(s, localize=True, dir='', prefix='', fetcher=None):
   '''
   Retrieve js information from the html/DOM and download them by default.
   At the mean time replace all js url references by refs to local file.
   '''
-  m_javascripts = re_html_js.finditer(s)
+  ret = js_edits_in_html({REF_JS_HTML: re_html_js.finditer(s)},
+                         localize, dir, prefix, fetcher)
+  ret['source'] = splice(s, ret['edits'])
+  return ret
+
+
+# @param refs(dict)  references in a page, as found by
+#                    FBParser.scan.scan_resources
+# @param localize(Boolean)  Wether these js files should be retrieved and saved
+# @param dir=''(str)  Directory where the files should be saved
+# @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
+# @return (dict)  a set of javascript files that are included,
+#                 and the edits localizing them (see splice)
+def js_edits_in_html(refs, localize=True, dir='', prefix='', fetcher=None):
+  '''
+  Same as js_in_html, on references scanned beforehand.
+  '''
+  pool = Fetcher() if fetcher is None else fetcher
+  m_javascripts = refs[REF_JS_HTML]
   javascripts = set()
+  edits = []
   for m_javascript in m_javascripts:
     url = m_javascript.group('url')
     if url:
       if localize:
         file = url_to_file(url)
-        s = s.replace(url, prefix + file, 1)
-        save_resource(url, dir, file)
+        edits.append((m_javascript.start('url'), m_javascript.end('url'),
+                      prefix + file))
+        save_resource(url, dir, file, pool)
         javascripts.add(prefix + file)
       else:
         javascripts.add(url)
-  return {'source': s, 'javascripts': javascripts}
+  if fetcher is None:
+    pool.close()
+  return {'javascripts': javascripts, 'edits': edits}
 
 
 # @param s(str)  html source that may contain urls of javascript
 # @param localize(Boolean)  Wether these js files should be retrieved and saved
 # @param dir=''(str)  Directory where the files should be saved
 # @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
 # @return (dict)  source with js urls replaced by local files (if localize),
-#                 and a set of javascript files that are included
-def js_in_json(s, localize=True, dir='', prefix=''):
+#                 a set of javascript files that are included,
+#                 and the edits made to s (see splice)
+def js_in_json(s, localize=True, dir='', prefix='', fetcher=None):
   '''
   Retrieve js information from json strings and download them by default.
   At the mean time replace all js url references by refs to local file.
   NOTE: if prefix is a dir, remember to replace '/' with '\/'!
   '''
-  m_jssources = re_json_js.finditer(s)
+  ret = js_edits_in_json({REF_JS_JSON: re_json_js.finditer(s)},
+                         localize, dir, prefix, fetcher)
+  ret['source'] = splice(s, ret['edits'])
+  return ret
+
+
+# @param refs(dict)  references in a page, as found by
+#                    FBParser.scan.scan_resources
+# @param localize(Boolean)  Wether these js files should be retrieved and saved
+# @param dir=''(str)  Directory where the files should be saved
+# @param prefix=''(str) a prefix to the replaced filename (e.g. relative path)
+# @param fetcher=None(Fetcher)  shared fetcher, waited on by the caller;
+#                              by default one is made and waited on here
+# @return (dict)  a set of javascript files that are included,
+#                 and the edits localizing them (see splice)
+def js_edits_in_json(refs, localize=True, dir='', prefix='', fetcher=None):
+  '''
+  Same as js_in_json, on references scanned beforehand.
+  '''
+  pool = Fetcher() if fetcher is None else fetcher
+  m_jssources = refs[REF_JS_JSON]
   javascripts = set()
+  edits = []
   for m_jssource in m_jssources:
     url = m_jssource.group('url')
     download_url = dejsonify(url)
     if localize:
       file = url_to_file(url)
-      s = s.replace(url, prefix + file, 1)
-      save_resource(download_url, dir, file)
+      edits.append((m_jssource.start('url'), m_jssource.end('url'),
+                    prefix + file))
+      save_resource(download_url, dir, file, pool)
       javascripts.add(prefix + file)
     else:
       javascripts.add(url)
-  return {'source': s, 'javascripts': javascripts}
+  if fetcher is None:
+    pool.close()
+  return {'javascripts': javascripts, 'edits': edits}
 
 
 # @param dom(str)  html source that may contain logging-related scripts
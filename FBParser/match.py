@@ -0,0 +1,783 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/match.py
+
+Matching of css rules against the elements of a page, the way browsers do
+it: selectors are read from right to left, and they are bucketed by the
+id, class or tag of their rightmost compound, so that an element is only
+tested against the selectors that may match it. A selector that needs an
+id, class or tag the page doesn't have at all is never tested.
+Matching is conservative: whatever depends on the state of the page
+(:hover, :checked...) or is not understood (unknown pseudo-classes,
+namespaces, escapes) is taken to match, and attribute values are compared
+regardless of case, so that pruning a style sheet down to the rules that
+match (see prune_sheet) keeps the rules a browser applies to the page.
+The tree follows the tree construction of HTML for what is common in pages
+(implied html/head/body/tbody, optional end tags); the rest of it (e.g.
+misnested formatting tags, content moved out of tables) is not replayed.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'ElementTree', 'SelectorMatcher',
+            'parse_sheet', 'parse_selector', 'split_selectors',
+            'sheet_selectors', 'prune_sheet',
+          ]
+
+#
+# Imports
+#
+from FBParser import EditBuffer
+from FBParser.dom import tokenize
+from FBParser.Constants import TOKEN_OPEN, TOKEN_CLOSE, TOKEN_TEXT
+# external imports
+import re
+
+#
+# Internal functions
+#
+
+# style sheets: runs of plain text, strings, comments and escapes
+re_css_run = re.compile(
+  r'''(?s)[^"'/{};\\]+|"(?:[^"\\]|\\.)*"?|'(?:[^'\\]|\\.)*'?|'''
+  r'''/\*.*?(?:\*/|\Z)|\\.?|/''')
+re_css_space = re.compile(r'(?s)(?:\s+|/\*.*?(?:\*/|\Z))*')
+re_at_name = re.compile(r'@(-?[-\w]+)')
+GROUPING_RULES = ('media', 'supports', 'document', '-moz-document')
+
+# selectors, anything else (escapes, non-ascii names...) is not understood
+re_sel_combinator = re.compile(r'\s*([>+~])\s*|\s+')
+re_sel_tag = re.compile(r'\*|[a-zA-Z][-\w]*')
+re_sel_id = re.compile(r'#(-?[-\w]+)')
+re_sel_class = re.compile(r'\.(-?[_a-zA-Z][-\w]*)')
+re_sel_attr = re.compile(
+  r'''\[\s*(?P<name>[-\w]+)\s*(?:(?P<op>[~|^$*]?=)\s*'''
+  r'''(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[-\w]+))\s*[iIsS]?\s*)?\]''')
+re_sel_pseudo = re.compile(r'(::?)(-?[_a-zA-Z][-\w]*)(\()?')
+re_nth = re.compile(r'''(?i)\s*(?:(?P<odd>odd)|(?P<even>even)|'''
+                    r'''(?P<a>[-+]?\d*)n\s*(?:(?P<sign>[-+])\s*(?P<b>\d+))?|'''
+                    r'''(?P<n>[-+]?\d+))\s*$''')
+PSEUDO_ELEMENTS = ('before', 'after', 'first-line', 'first-letter')
+STRUCTURAL = ('first-child', 'last-child', 'only-child', 'root')
+
+# markup
+re_tag_name = re.compile(r'</?([a-zA-Z][^\s/>]*)')
+re_tag_attr = re.compile(
+  r'''(?s)\s+(?P<name>[^\s"'<>/=]+)(?:\s*=\s*'''
+  r'''(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[^\s"'=<>`]+)))?''')
+RAW_TEXT = ('script', 'style')  # their content is no markup
+FILTER_BITS = 1023  # of the ancestor filters, see _bloom
+
+# the tree construction of HTML, as far as parents and siblings go: the
+# elements of the head and body are put in them even if their tags are
+# missing, and opening some elements ends others, whose end tag is optional
+HEAD_CONTENT = frozenset(('base', 'basefont', 'bgsound', 'link', 'meta',
+                          'noframes', 'noscript', 'script', 'style',
+                          'template', 'title'))
+HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+SPECIAL = frozenset((
+  'address', 'applet', 'area', 'article', 'aside', 'base', 'basefont',
+  'bgsound', 'blockquote', 'body', 'br', 'button', 'caption', 'center',
+  'col', 'colgroup', 'dd', 'details', 'dir', 'div', 'dl', 'dt', 'embed',
+  'fieldset', 'figcaption', 'figure', 'footer', 'form', 'frame',
+  'frameset', 'head', 'header', 'hgroup', 'hr', 'html', 'iframe', 'img',
+  'input', 'keygen', 'li', 'link', 'listing', 'main', 'marquee', 'menu',
+  'meta', 'nav', 'noembed', 'noframes', 'noscript', 'object', 'ol', 'p',
+  'param', 'plaintext', 'pre', 'script', 'section', 'select', 'source',
+  'style', 'summary', 'table', 'tbody', 'td', 'template', 'textarea',
+  'tfoot', 'th', 'thead', 'title', 'tr', 'track', 'ul', 'wbr',
+  'xmp') + HEADINGS)
+LIST_SCOPE = SPECIAL - frozenset(('address', 'div', 'p'))
+BUTTON_SCOPE = frozenset(('applet', 'button', 'caption', 'html', 'marquee',
+                          'object', 'table', 'td', 'template', 'th'))
+TABLE_SCOPE = frozenset(('html', 'table', 'template'))
+CLOSING_P = ('address', 'article', 'aside', 'blockquote', 'center', 'dd',
+             'details', 'dialog', 'dir', 'div', 'dl', 'dt', 'fieldset',
+             'figcaption', 'figure', 'footer', 'form', 'header', 'hgroup',
+             'hr', 'li', 'listing', 'main', 'menu', 'nav', 'ol', 'p',
+             'plaintext', 'pre', 'section', 'summary', 'table', 'ul',
+             'xmp') + HEADINGS
+# tag -> what opening it ends, in order: (tags ended, tags they are not
+# looked for beyond, None to look at the current element only)
+IMPLIED_ENDS = {
+  'li': [(('li',), LIST_SCOPE)],
+  'dd': [(('dd', 'dt'), LIST_SCOPE)],
+  'dt': [(('dd', 'dt'), LIST_SCOPE)],
+  'td': [(('td', 'th'), TABLE_SCOPE)],
+  'th': [(('td', 'th'), TABLE_SCOPE)],
+  'tr': [(('tr',), TABLE_SCOPE)],
+  'tbody': [(('tbody', 'thead', 'tfoot'), TABLE_SCOPE)],
+  'thead': [(('tbody', 'thead', 'tfoot'), TABLE_SCOPE)],
+  'tfoot': [(('tbody', 'thead', 'tfoot'), TABLE_SCOPE)],
+  'option': [(('option',), None)],
+  'optgroup': [(('option', 'optgroup'), None)],
+}
+for tag in CLOSING_P:
+  IMPLIED_ENDS.setdefault(tag, []).append((('p',), BUTTON_SCOPE))
+for tag in HEADINGS:
+  IMPLIED_ENDS[tag].append((HEADINGS, None))
+
+
+# @param tag(str)  tag, None for any
+# @param id(str)  id, None for any
+# @param classes(iterable)  classes
+# @return (int)  bloom filter of them, as bits of an int
+def _bloom(tag, id, classes):
+  bits = 0
+  if tag is not None:
+    bits |= 1 << (hash(tag) & FILTER_BITS)
+  if id is not None:
+    bits |= 1 << (hash('#' + id) & FILTER_BITS)
+  for name in classes:
+    bits |= 1 << (hash('.' + name) & FILTER_BITS)
+  return bits
+
+
+# @param stack(list)  open elements, the document first
+# @param tag(str)  tag of the element being opened
+def _end_implied(stack, tag):
+  '''
+  End the open elements that opening one of the tag ends in HTML.
+  '''
+  for ended, scope in IMPLIED_ENDS.get(tag, ()):
+    if scope is None:
+      while stack[-1].tag in ended:
+        del stack[-1]
+      continue
+    for depth in range(len(stack) - 1, 0, -1):
+      if stack[depth].tag in ended:
+        del stack[depth:]
+        break
+      if stack[depth].tag in scope:
+        break
+
+
+# @param css(str)  style sheet
+# @param pos(int)  where to start
+# @param end(int)  end of the sheet to be considered
+# @return (int)  position of the next '{', '}' or ';' that is not in a
+#                string or comment, end if there is none
+def _next(css, pos, end):
+  while pos < end:
+    if css[pos] in '{};':
+      return pos
+    pos = re_css_run.match(css, pos, end).end()
+  return end
+
+
+# @param css(str)  style sheet
+# @param pos(int)  just after an opening '{'
+# @param end(int)  end of the sheet to be considered
+# @return (int)  position of the matching '}', end if there is none
+def _close(css, pos, end):
+  depth = 1
+  while pos < end:
+    pos = _next(css, pos, end)
+    if pos >= end:
+      break
+    if css[pos] == '{':
+      depth += 1
+    elif css[pos] == '}':
+      depth -= 1
+      if not depth:
+        return pos
+    pos += 1
+  return end
+
+
+# @param s(str)  text
+# @param pos(int)  just after an opening '('
+# @return (int)  position of the matching ')', -1 if there is none
+def _paren(s, pos):
+  depth = 1
+  while pos < len(s):
+    c = s[pos]
+    if c in '"\'':
+      pos = s.find(c, pos + 1)
+      if pos < 0:
+        return -1
+    elif c == '(':
+      depth += 1
+    elif c == ')':
+      depth -= 1
+      if not depth:
+        return pos
+    pos += 1
+  return -1
+
+
+# @param arg(str)  argument of :nth-child(), e.g. '2n+1'
+# @return (tuple)  (a, b) for an+b, None if it is not understood
+def _nth(arg):
+  m = re_nth.match(arg)
+  if not m:
+    return None
+  if m.group('odd'):
+    return 2, 1
+  if m.group('even'):
+    return 2, 0
+  if m.group('n') is not None:
+    return 0, int(m.group('n'))
+  a = m.group('a')
+  a = int(a + '1') if a in ('', '+', '-') else int(a)
+  b = int(m.group('b') or 0)
+  return a, -b if m.group('sign') == '-' else b
+
+
+# @param a(int)  step
+# @param b(int)  offset
+# @param i(int)  position of an element among its siblings, from 1
+# @return (Boolean)  whether i is an+b for some n >= 0
+def _nth_matches(a, b, i):
+  if not a:
+    return i == b
+  return (i - b) % a == 0 and (i - b) / a >= 0
+
+
+class _Element(object):
+  '''
+  An element of the page, as far as selectors are concerned.
+  '''
+  __slots__ = ('tag', 'id', 'classes', 'attrs', 'parent', 'prev', 'index',
+               'count', 'last', 'siblings', 'bits', 'ancestors')
+
+  def __init__(self, tag, attrs, parent, prev, index):
+    self.tag = tag
+    self.attrs = attrs
+    self.id = attrs.get('id')
+    self.classes = set(attrs.get('class', '').split())
+    self.parent = parent
+    self.prev = prev  # previous sibling element
+    self.index = index  # among the sibling elements, from 1
+    self.count = 0  # number of child elements
+    self.last = None  # last child element, so far
+    self.siblings = 0  # number of elements among its siblings, itself too
+    self.bits = _bloom(tag, self.id, self.classes)
+    # bloom filter of the tags, ids and classes of its ancestors, set once
+    # the tree is built
+    self.ancestors = 0
+
+  # @param attrs(dict)  attributes of another tag of the element
+  def merge(self, attrs):
+    '''
+    Add the attributes it doesn't have yet, as browsers do for a second
+    html or body tag.
+    '''
+    for name, value in attrs.items():
+      self.attrs.setdefault(name, value)
+    self.id = self.attrs.get('id')
+    self.classes = set(self.attrs.get('class', '').split())
+    self.bits = _bloom(self.tag, self.id, self.classes)
+
+
+class _Compound(object):
+  '''
+  A compound selector, e.g. div.uiList[role]:first-child
+  '''
+  __slots__ = ('tag', 'id', 'classes', 'attrs', 'pseudos', 'maybe', 'never')
+
+  def __init__(self):
+    self.tag = None
+    self.id = None
+    self.classes = []
+    self.attrs = []  # (name, operator or None, lowered value)
+    self.pseudos = []  # (name, argument)
+    self.maybe = False  # whether it has parts taken to match
+    self.never = False  # whether it can't match anything (e.g. two ids)
+
+  # @param el(_Element)  an element
+  # @return (Boolean)  whether the compound matches it
+  def matches(self, el):
+    if self.tag is not None and self.tag != el.tag:
+      return False
+    if self.id is not None and self.id != el.id:
+      return False
+    for name in self.classes:
+      if name not in el.classes:
+        return False
+    for name, op, value in self.attrs:
+      actual = el.attrs.get(name)
+      if actual is None:
+        return False
+      if op is None:
+        continue
+      actual = actual.lower()
+      if op == '=' and actual != value or \
+         op == '~=' and value not in actual.split() or \
+         op == '|=' and actual != value and \
+           not actual.startswith(value + '-') or \
+         op == '^=' and not (value and actual.startswith(value)) or \
+         op == '$=' and not (value and actual.endswith(value)) or \
+         op == '*=' and not (value and value in actual):
+        return False
+    for name, arg in self.pseudos:
+      if name == 'first-child' and el.index != 1 or \
+         name == 'last-child' and el.index != el.siblings or \
+         name == 'only-child' and el.siblings != 1 or \
+         name == 'root' and el.parent is not None or \
+         name == 'nth-child' and not _nth_matches(arg[0], arg[1], el.index) or \
+         name == 'nth-last-child' and \
+           not _nth_matches(arg[0], arg[1], el.siblings - el.index + 1) or \
+         name == 'not' and any(inner.matches(el) for inner in arg):
+        return False
+    return True
+
+
+# @param s(str)  selector text
+# @param pos(int)  where the compound starts
+# @return (tuple)  (_Compound, end of it), (None, pos) if it is not
+#                  understood
+def _parse_compound(s, pos):
+  c = _Compound()
+  start = pos
+  m = re_sel_tag.match(s, pos)
+  if m:
+    if s.startswith('|', m.end()):  # namespace
+      return None, start
+    if m.group(0) != '*':
+      c.tag = m.group(0).lower()
+    pos = m.end()
+  while pos < len(s):
+    char = s[pos]
+    if char == '#':
+      m = re_sel_id.match(s, pos)
+      if not m:
+        return None, start
+      if c.id is not None and c.id != m.group(1):
+        c.never = True
+      c.id = m.group(1)
+    elif char == '.':
+      m = re_sel_class.match(s, pos)
+      if not m:
+        return None, start
+      c.classes.append(m.group(1))
+    elif char == '[':
+      m = re_sel_attr.match(s, pos)
+      if not m:
+        return None, start
+      value = m.group('dq')
+      if value is None:
+        value = m.group('sq')
+      if value is None:
+        value = m.group('uq')
+      c.attrs.append((m.group('name').lower(), m.group('op'),
+                      value.lower() if value is not None else None))
+    elif char == ':':
+      m = re_sel_pseudo.match(s, pos)
+      if not m:
+        return None, start
+      name = m.group(2).lower()
+      arg = None
+      if m.group(3):
+        close = _paren(s, m.end())
+        if close < 0:
+          return None, start
+        arg = s[m.end():close]
+        pos = close + 1
+      else:
+        pos = m.end()
+      if m.group(1) == '::' or name in PSEUDO_ELEMENTS:
+        continue  # styles a part of the element, which is there
+      if name in STRUCTURAL and arg is None:
+        c.pseudos.append((name, None))
+      elif name in ('nth-child', 'nth-last-child') and _nth(arg or ''):
+        c.pseudos.append((name, _nth(arg)))
+      elif name == 'not' and arg is not None:
+        inner = [_parse_compound(text, 0) for text in split_selectors(arg)]
+        if all(compound is not None and end == len(text) and
+               not compound.maybe
+               for (compound, end), text in zip(inner, split_selectors(arg))):
+          c.pseudos.append(('not', [compound for compound, end in inner]))
+        else:
+          c.maybe = True
+      else:
+        c.maybe = True  # state of the page, or unknown
+      continue
+    else:
+      break
+    pos = m.end()
+  if pos == start:
+    return None, start
+  return c, pos
+
+
+class _Selector(object):
+  '''
+  A complex selector, its compounds from right to left.
+  '''
+
+  # @param compounds(list)  _Compound's, from left to right
+  # @param combinators(list)  ' ', '>', '+' or '~' between them
+  def __init__(self, compounds, combinators):
+    self.parts = zip(reversed(compounds),
+                     list(reversed(combinators)) + [None])
+    key = self.parts[0][0]
+    if key.id is not None:
+      self.key = ('id', key.id)
+    elif key.classes:
+      self.key = ('class', key.classes[0])
+    elif key.tag is not None:
+      self.key = ('tag', key.tag)
+    else:
+      self.key = None  # to be tested against every element
+    # bloom filter of what the ancestors of a matching element must have,
+    # i.e. of the compounds reached through a descendant or child combinator
+    self.ancestors = 0
+    for (compound, combinator), (before, ignored) in zip(self.parts[:-1],
+                                                         self.parts[1:]):
+      if combinator in ' >':
+        self.ancestors |= _bloom(before.tag, before.id, before.classes)
+
+  # @param el(_Element)  an element
+  # @param k=0(int)  part of the selector to be matched by el
+  # @return (Boolean)  whether the selector matches el, from part k on
+  def matches(self, el, k=0):
+    compound, combinator = self.parts[k]
+    if not compound.matches(el):
+      return False
+    if combinator is None:
+      return True
+    if combinator == '>':
+      return el.parent is not None and self.matches(el.parent, k + 1)
+    if combinator == '+':
+      return el.prev is not None and self.matches(el.prev, k + 1)
+    other = el.parent if combinator == ' ' else el.prev
+    while other is not None:
+      if self.matches(other, k + 1):
+        return True
+      other = other.parent if combinator == ' ' else other.prev
+    return False
+
+#
+# APIs
+#
+
+
+class ElementTree(object):
+  '''
+  Elements of a page, with what selectors look at: tag, id, classes and
+  other attributes, parent and siblings.
+  The tree is built the way browsers build it, as far as selectors can
+  tell: there always are html, head and body elements, opening an element
+  ends those whose end tag is optional and left out (e.g. a li the open
+  li, a div the open p), rows are in a tbody even without its tags, and
+  closing tags close the innermost element with the same tag, along with
+  the elements opened within it and left open.
+  The content of script and style elements is not parsed.
+  '''
+
+  # @param dom(str)  the page
+  def __init__(self, dom):
+    self.elements = []
+    self.tags = set()
+    self.ids = set()
+    self.classes = set()
+    top = _Element(None, {}, None, None, 0)  # stands for the document
+    stack = [top]
+    opened = {}  # html, head, body -> the element, once opened
+    self._open(stack, 'html', {}, opened)
+    raw = None  # tag of the script/style element we are in
+    for kind, start, end, label in tokenize(dom):
+      if kind == TOKEN_TEXT:
+        continue
+      m_name = re_tag_name.match(dom, start, end)
+      if not m_name:
+        continue
+      tag = m_name.group(1).lower()
+      if raw is not None and (kind != TOKEN_CLOSE or tag != raw):
+        continue
+      if kind == TOKEN_CLOSE:
+        raw = None
+        if tag in ('html', 'body'):  # what follows is in the body still
+          continue
+        for depth in range(len(stack) - 1, 0, -1):
+          if stack[depth].tag == tag:
+            del stack[depth:]
+            break
+        continue
+      attrs = {}
+      for m_attr in re_tag_attr.finditer(dom, m_name.end(), end - 1):
+        name = m_attr.group('name').lower()
+        if name not in attrs:
+          value = m_attr.group('dq')
+          if value is None:
+            value = m_attr.group('sq')
+          if value is None:
+            value = m_attr.group('uq') or ''
+          attrs[name] = value
+      if tag in ('html', 'body') and tag in opened:
+        opened[tag].merge(attrs)
+        continue
+      if tag == 'head' and ('head' in opened or 'body' in opened):
+        continue  # ignored, as by browsers
+      if stack[-1].tag == 'html' and tag != 'head' and 'head' not in opened:
+        self._open(stack, 'head', {}, opened)  # there always is one
+      if stack[-1].tag == 'head' and tag not in HEAD_CONTENT:
+        del stack[-1]
+      if stack[-1].tag == 'html' and tag not in HEAD_CONTENT and \
+         tag not in ('head', 'body'):
+        self._open(stack, 'body', {}, opened)
+      _end_implied(stack, tag)
+      # rows are in a row group, cells in a row
+      if tag in ('tr', 'td', 'th') and stack[-1].tag == 'table':
+        self._open(stack, 'tbody', {}, opened)
+      if tag in ('td', 'th') and stack[-1].tag in ('tbody', 'thead', 'tfoot'):
+        self._open(stack, 'tr', {}, opened)
+      self._open(stack, tag, attrs, opened)
+      if kind != TOKEN_OPEN or dom.startswith('/>', end - 2):
+        del stack[-1]
+      elif tag in RAW_TEXT:
+        raw = tag
+    for el in self.elements:
+      el.siblings = (el.parent or top).count
+      if el.parent is not None:
+        el.ancestors = el.parent.ancestors | el.parent.bits
+    for el in opened.values():  # their attributes may have been merged
+      if el.id is not None:
+        self.ids.add(el.id)
+      self.classes.update(el.classes)
+
+  # @param stack(list)  open elements, the document first
+  # @param tag(str)  tag of the element
+  # @param attrs(dict)  its attributes
+  # @param opened(dict)  html, head and body elements opened so far
+  # @return (_Element)  the element, opened within the current one
+  def _open(self, stack, tag, attrs, opened):
+    parent = stack[-1]
+    parent.count += 1
+    el = _Element(tag, attrs, parent if len(stack) > 1 else None,
+                  parent.last, parent.count)
+    parent.last = el
+    stack.append(el)
+    if tag in ('html', 'head', 'body'):
+      opened[tag] = el
+    self.elements.append(el)
+    self.tags.add(tag)
+    if el.id is not None:
+      self.ids.add(el.id)
+    self.classes.update(el.classes)
+    return el
+
+  def __len__(self):
+    return len(self.elements)
+
+
+class SelectorMatcher(object):
+  '''
+  Tell which selectors match at least one element of a page.
+  Usage:
+    matcher = SelectorMatcher(ElementTree(dom))
+    matched = matcher.match(['.uiList li', '#pagelet_nav a:hover'])
+  Selectors that are not understood are taken to match.
+  '''
+
+  # @param tree(ElementTree)  elements of the page
+  def __init__(self, tree):
+    self.tree = tree
+    self.selectors = {}  # text -> _Selector, None if not understood
+
+  # @param text(str)  a complex selector, e.g. '#nav > li.selected a'
+  # @return (_Selector)  None if the selector is not understood
+  def parse(self, text):
+    if text not in self.selectors:
+      self.selectors[text] = parse_selector(text)
+    return self.selectors[text]
+
+  # @param selector(_Selector)  a parsed selector
+  # @return (Boolean)  whether the page has every id, class and tag it needs
+  def possible(self, selector):
+    tree = self.tree
+    for compound, combinator in selector.parts:
+      if compound.never or \
+         compound.tag is not None and compound.tag not in tree.tags or \
+         compound.id is not None and compound.id not in tree.ids:
+        return False
+      for name in compound.classes:
+        if name not in tree.classes:
+          return False
+    return True
+
+  # @param texts(iterable)  complex selectors
+  # @return (set)  those matching at least one element
+  def match(self, texts):
+    '''
+    Test every element against the selectors bucketed under its id, its
+    classes and its tag (and the universal ones), dropping selectors from
+    their bucket as soon as they match. Like in browsers, selectors whose
+    ancestors can't be among those of the element, as told by bloom
+    filters, are not matched any further.
+    '''
+    matched = set()
+    buckets = {}  # key of the rightmost compound -> [(text, _Selector)]
+    for text in set(texts):
+      selector = self.parse(text)
+      if selector is None:
+        matched.add(text)
+      elif self.possible(selector):
+        buckets.setdefault(selector.key, []).append((text, selector))
+    left = sum(len(bucket) for bucket in buckets.values())
+    universal = buckets.get(None)
+    for el in self.tree.elements:
+      if not left:
+        break
+      keys = [('tag', el.tag)] + [('class', name) for name in el.classes]
+      if el.id is not None:
+        keys.append(('id', el.id))
+      candidates = [buckets.get(key) for key in keys] + [universal]
+      for bucket in candidates:
+        if not bucket:
+          continue
+        hits = [text for text, selector in bucket
+                if selector.ancestors & el.ancestors == selector.ancestors and
+                selector.matches(el)]
+        if hits:
+          matched.update(hits)
+          bucket[:] = [item for item in bucket if item[0] not in matched]
+          left -= len(hits)
+    return matched
+
+
+# @param css(str)  style sheet
+# @param start=0(int)  where to start
+# @param end=None(int)  where to stop, default to the end of css
+# @return (list)  (kind, start, end, block, children) of each rule, kind
+#                 being 'rule', 'at' (@font-face...) or 'group' (@media...),
+#                 block the position of its '{', children the rules of a
+#                 group (None otherwise); statements (@import...) are left
+#                 out, as they are to be kept anyway
+def parse_sheet(css, start=0, end=None):
+  '''
+  Split a style sheet into its rules, in one pass.
+  '''
+  if end is None:
+    end = len(css)
+  items = []
+  pos = re_css_space.match(css, start, end).end()
+  while pos < end:
+    block = _next(css, pos, end)
+    if block >= end:
+      break
+    if css[block] != '{':  # end of a statement, or a stray '}'
+      pos = re_css_space.match(css, block + 1, end).end()
+      continue
+    close = _close(css, block + 1, end)
+    m_at = re_at_name.match(css, pos, block)
+    if m_at is None:
+      items.append(('rule', pos, min(close + 1, end), block, None))
+    elif m_at.group(1).lower() in GROUPING_RULES:
+      items.append(('group', pos, min(close + 1, end), block,
+                    parse_sheet(css, block + 1, close)))
+    else:
+      items.append(('at', pos, min(close + 1, end), block, None))
+    pos = re_css_space.match(css, close + 1, end).end()
+  return items
+
+
+# @param text(str)  selector list, e.g. 'h1, .title > a'
+# @return (list)  the complex selectors in it, stripped
+def split_selectors(text):
+  if '(' not in text and '[' not in text:
+    return [selector.strip() for selector in text.split(',')]
+  selectors = []
+  depth = 0
+  start = 0
+  quote = None
+  for pos, char in enumerate(text):
+    if quote:
+      if char == quote:
+        quote = None
+    elif char in '"\'':
+      quote = char
+    elif char in '([':
+      depth += 1
+    elif char in ')]':
+      depth -= 1
+    elif char == ',' and not depth:
+      selectors.append(text[start:pos].strip())
+      start = pos + 1
+  selectors.append(text[start:].strip())
+  return selectors
+
+
+# @param text(str)  a complex selector
+# @return (_Selector)  None if the selector is not understood
+def parse_selector(text):
+  compounds = []
+  combinators = []
+  pos = 0
+  while True:
+    compound, pos = _parse_compound(text, pos)
+    if compound is None:
+      return None
+    compounds.append(compound)
+    if pos >= len(text):
+      break
+    m = re_sel_combinator.match(text, pos)
+    if not m or m.end() >= len(text):
+      return None
+    combinators.append(m.group(1) or ' ')
+    pos = m.end()
+  return _Selector(compounds, combinators)
+
+
+# @param css(str)  style sheet
+# @param items(list)  its rules, as returned by parse_sheet
+# @return (generator)  complex selectors of the rules, groups included
+def sheet_selectors(css, items):
+  for kind, start, end, block, children in items:
+    if kind == 'rule':
+      for text in split_selectors(css[start:block]):
+        yield text
+    elif kind == 'group':
+      for text in sheet_selectors(css, children):
+        yield text
+
+
+# @param css(str)  style sheet
+# @param items(list)  its rules, as returned by parse_sheet
+# @param matched(set)  selectors to be kept, see SelectorMatcher.match
+# @return (dict)  the sheet ('css') with only the rules, and the selectors
+#                 of rules, that are matched, and counts of 'rules',
+#                 'rules_kept', 'selectors', 'selectors_kept', 'bytes' and
+#                 'bytes_kept'
+def prune_sheet(css, items, matched):
+  '''
+  Drop the rules none of whose selectors match, and the selectors that
+  don't match from the rules that are kept; groups (@media...) left empty
+  go too. Other at-rules (@font-face, @keyframes...) and statements are
+  kept, as is everything about the rules kept but their selectors.
+  '''
+  ret = {'rules': 0, 'rules_kept': 0, 'selectors': 0, 'selectors_kept': 0}
+
+  def prune(items, limit):
+    edits = []
+    kept = 0
+    for kind, start, end, block, children in items:
+      drop = (start, re_css_space.match(css, end, limit).end())
+      if kind == 'rule':
+        texts = split_selectors(css[start:block])
+        keep = [text for text in texts if text in matched]
+        ret['rules'] += 1
+        ret['selectors'] += len(texts)
+        ret['selectors_kept'] += len(keep)
+        if not keep:
+          edits.append(drop + ('',))
+          continue
+        ret['rules_kept'] += 1
+        if len(keep) < len(texts):
+          edits.append((start, start + len(css[start:block].rstrip()),
+                         ','.join(keep)))
+      elif kind == 'group' and children:
+        inner, inner_kept = prune(children, end - 1)
+        if not inner_kept:
+          edits.append(drop + ('',))
+          continue
+        edits.extend(inner)
+      kept += 1
+    return edits, kept
+  edits = EditBuffer(css)
+  edits.extend(prune(items, len(css))[0])
+  ret['css'] = edits.apply()
+  ret['bytes'] = len(css)
+  ret['bytes_kept'] = len(ret['css'])
+  return ret
@@ -13,8 +13,13 @@ __all__ = [
             're_html_css', 're_json_css',
             're_cssrule', 're_css_id', 're_css_class',
             're_blockcomment', 're_empty', 're_doctype', 're_iframe',
-            're_tag', 're_tag_label',
-            're_attr_sq', 're_attr_dq',
+            're_json_escape',
+            're_spaces',
+            're_tag', 're_tag_head', 're_tag_label', 're_content',
+            're_tag_rest', 're_string_rest',
+            're_attr_sq', 're_attr_dq', 're_attr', 're_attr_id',
+            're_html_search', 're_html_icon', 're_html_iframe',
+            're_html_noscript', 're_href_http', 're_resource_anchor',
           ]
 
 #
@@ -25,6 +30,8 @@ import re
 # general
 re_doctype = re.compile('<!DOCTYPE.*?>')
 re_blockcomment = re.compile("(?s)/\*.*?\*/")
+# escape sequence of FBParser.jsonify, split() keeps the escaped char
+re_json_escape = re.compile(r'''\\([\\/'"rn])''')
 
 # css related
 # of src/href, NOTE: we ignore embedded css (<style></style> or style="")
@@ -70,11 +77,41 @@ re_html_bigpipe = re.compile(
 (?P<cache>"page_cache":\w+?)\}\);</script>')
 
 re_tag = re.compile("(?s)<[\w/][^<>]*>")  # this matches both tag start and end
+re_tag_head = re.compile("(?s)<[\w/][^<>]*")  # a tag that may not be complete
 re_tag_label = re.compile("(?s)(?:<|</)(?P<label>[^\s]+).*?>")
+# content between tags: stops at a '<' (but not '<!'), skips escaped chars
+# and double quoted strings, which may contain '<'
+re_content = re.compile(
+  r'(?s)(?:[^\\"<]+|\\.|"[^"\\]*(?:\\.[^"\\]*)*"|<!)*')
+# what follows the start of a tag and of a double quoted string (in content)
+# up to their end, so that scanning them can be resumed
+re_tag_rest = re.compile('[^<>]*')
+re_string_rest = re.compile(r'(?s)[^"\\]*(?:\\.[^"\\]*)*')
 # double quoted attr
 re_attr_dq = re.compile('(?s)[\s]+(?:(?P<name>[^\s]+?)="(?P<value>[^"]*?)")')
 # single quoted attr
 re_attr_sq = re.compile("(?s)[\s]+(?:(?P<name>[^\s]+?)='(?P<value>[^']*?)')")
+# attr quoted either way, the value in the dq or the sq group
+re_attr = re.compile(
+  '(?s)[\s]+(?:(?P<name>[^\s]+?)=(?:"(?P<dq>[^"]*?)"|\'(?P<sq>[^\']*?)\'))')
+# id attr (within a tag)
+re_attr_id = re.compile('[\s]id="(?P<id>[^"]*)"')
 
 re_empty = re.compile("[\s]+$")
+re_spaces = re.compile("([\s]+)")  # split() keeps the whitespace
 re_iframe = re.compile("(?s)<iframe(.*?)>(.*?)</iframe>")
+
+# standalone resources of the page, see localize_misc
+re_html_search = re.compile(
+'<link rel="search" type="application/opensearchdescription\+xml" \
+href="(?P<url>http://.*?\.xml)" title="Facebook">')
+re_html_icon = re.compile(
+'<link rel="shortcut icon" href="(?P<url>http://.*?\.ico)">')
+re_html_iframe = re.compile('<iframe src="(?P<url>http://.*?\.html)"')
+re_html_noscript = re.compile(
+  '(?s)<noscript>.+?content="(?P<url>.+?)".+?</noscript>')
+re_href_http = re.compile('href="http://.+?"')
+# where a match of any of the resource patterns above may start, see
+# FBParser.scan
+re_resource_anchor = re.compile(
+  '<(?:link|script|img|iframe|noscript)|"src":"|href="http://')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/scan.py
+
+One pass over a page for all the resources it references.
+Every resource pattern (see FBParser.regexp) starts with one of a few
+literal anchors. The page is traversed once, from anchor to anchor, and at
+each anchor only the patterns starting with it are tried, each resuming
+where its own previous match ended: every kind of reference is found
+exactly where a separate finditer of its pattern would find it, including
+references within the content of scripts.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'scan_resources', 'first_ref',
+          ]
+
+#
+# Imports
+#
+from FBParser.Constants import *
+from FBParser.regexp import *
+
+#
+# Internal functions
+#
+
+# anchor -> (kind, pattern) of the references starting with it
+PATTERNS = {
+  '<link': [(REF_CSS_HTML, re_html_css), (REF_SEARCH, re_html_search),
+            (REF_ICON, re_html_icon)],
+  '<script': [(REF_JS_HTML, re_html_js)],
+  '<img': [(REF_IMG_HTML, re_html_img)],
+  '<iframe': [(REF_IFRAME, re_html_iframe)],
+  '<noscript': [(REF_NOSCRIPT, re_html_noscript)],
+  '"src":"': [(REF_CSS_JSON, re_json_css), (REF_JS_JSON, re_json_js)],
+  'href="http://': [(REF_HREF, re_href_http)],
+}
+
+#
+# APIs
+#
+
+
+# @param s(str)  page source
+# @return (dict)  kind (see REF_KINDS) -> matches of the kind's pattern, in
+#                 the order of the page; a match of REF_JS_HTML is any
+#                 script, its 'url' group is None if it has no src
+def scan_resources(s):
+  '''
+  Find every resource reference of the page in a single traversal.
+  The matches are those of re_html_css.finditer(s), re_json_css.finditer(s)
+  and so on, kind by kind, so that localizers may use them instead of
+  matching the page again; their spans are offsets in s.
+  '''
+  refs = [[] for kind in REF_KINDS]
+  resume = [0 for kind in REF_KINDS]  # end of the last match of each kind
+  for m_anchor in re_resource_anchor.finditer(s):
+    pos = m_anchor.start()
+    for kind, pattern in PATTERNS[m_anchor.group()]:
+      if pos >= resume[kind]:
+        m = pattern.match(s, pos)
+        if m:
+          refs[kind].append(m)
+          resume[kind] = m.end()
+  return dict(zip(REF_KINDS, refs))
+
+
+# @param refs(dict)  as returned by scan_resources
+# @param kind(int)  one of REF_KINDS
+# @return (MatchObject)  first reference of the kind, None if there is none
+def first_ref(refs, kind):
+  return refs[kind][0] if refs[kind] else None
@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/serve.py
+
+Static server for the converted sample directories (home_dynamic.html,
+home_static.html and their css/, js/, img/ and misc/ resources), meant to
+stay out of the page-load times measured against it.
+One process, one event loop (asyncore over poll), HTTP/1.1 with keep-alive
+and pipelining. Small files are kept in memory, least recently used dropped
+first; large files go out with sendfile(2) where available, from a memory
+map otherwise. A request accepting gzip gets the precompressed sibling
+file.gz when there is an up-to-date one, nothing is compressed on the fly:
+precompress() (--gzip) creates the siblings ahead of time.
+
+Run this module directly to serve a directory of samples, e.g.
+  python FBParser/serve.py --gzip -p 8000 samples/
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'StaticServer', 'precompress',
+          ]
+
+#
+# Imports
+#
+import sys
+import os
+import time
+import mmap
+import gzip
+import errno
+import socket
+import asyncore
+import mimetypes
+from collections import deque, OrderedDict
+from email.utils import formatdate
+from urllib import unquote
+from FBParser.cache import temp_file
+try:
+  from argparse import ArgumentParser, RawDescriptionHelpFormatter
+except ImportError:
+  ArgumentParser = None
+try:
+  from os import sendfile as _sendfile  # Python 3.3+
+except ImportError:
+  try:
+    from sendfile import sendfile as _sendfile  # pysendfile
+  except ImportError:
+    _sendfile = None
+
+#
+# Internal functions
+#
+
+DEFAULT_PORT = 8000
+DEFAULT_CACHE_BYTES = 64 << 20
+DEFAULT_SENDFILE_MIN = 256 << 10  # smaller files are served from memory
+MAX_HEADERS = 64 << 10  # bytes of request line and headers
+RECV_SIZE = 1 << 16
+SEND_SIZE = 1 << 20  # bytes handed to the kernel at a time
+WAIT = 1  # seconds between checks for a shutdown
+GZIP_MIN = 1024  # smaller files are not worth a .gz sibling
+GZIP_TYPES = ('text/html', 'text/css', 'text/plain', 'text/javascript',
+              'application/javascript', 'application/x-javascript',
+              'application/json', 'image/svg+xml')
+# resources saved by url_to_file may have no (or a bogus) extension
+DIR_TYPES = {'css': 'text/css', 'js': 'application/javascript'}
+STATUS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+          403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+if _sendfile is None and sys.platform.startswith('linux'):
+  try:
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_size_t]
+    _libc.sendfile64.restype = ctypes.c_ssize_t
+
+    # same as os.sendfile of Python 3
+    def _sendfile(out_fd, in_fd, offset, count):
+      offset = ctypes.c_int64(offset)
+      sent = _libc.sendfile64(out_fd, in_fd, ctypes.byref(offset), count)
+      if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+      return sent
+  except (ImportError, OSError, AttributeError):
+    _sendfile = None
+
+
+# @param filename(str)  a file
+# @return (str)  its MIME type, for the Content-Type header
+def _content_type(filename):
+  type = mimetypes.guess_type(filename)[0]
+  if type is None:
+    dir = os.path.basename(os.path.dirname(filename))
+    type = DIR_TYPES.get(dir, 'application/octet-stream')
+  if type == 'text/html':
+    type += '; charset=utf-8'  # as written by save_content
+  return type
+
+
+class _FileCache(object):
+  '''
+  Content of small files by name, valid as long as their (mtime, size)
+  stamp is; the least recently used are dropped first beyond max_bytes.
+  '''
+
+  # @param max_bytes(int)  total size of the content kept
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.entries = OrderedDict()  # filename -> (stamp, content)
+
+  # @param filename(str)  a file
+  # @param stamp(tuple)  its current (mtime, size)
+  # @return (str)  its content, None if it is not cached or is stale
+  def get(self, filename, stamp):
+    entry = self.entries.pop(filename, None)
+    if entry is None:
+      return None
+    if entry[0] != stamp:
+      self.bytes -= len(entry[1])
+      return None
+    self.entries[filename] = entry  # most recently used
+    return entry[1]
+
+  # @param filename(str)  a file
+  # @param stamp(tuple)  its (mtime, size)
+  # @param content(str)  its content
+  def put(self, filename, stamp, content):
+    if len(content) > self.max_bytes:
+      return
+    entry = self.entries.pop(filename, None)
+    if entry is not None:
+      self.bytes -= len(entry[1])
+    self.entries[filename] = (stamp, content)
+    self.bytes += len(content)
+    while self.bytes > self.max_bytes:
+      self.bytes -= len(self.entries.popitem(last=False)[1][1])
+
+
+class _FileBody(object):
+  '''
+  A large file on its way out, with sendfile or from a memory map.
+  '''
+
+  # @param filename(str)  the file
+  # @param size(int)  its size
+  def __init__(self, filename, size):
+    self.f = open(filename, 'rb')
+    self.offset = 0
+    self.size = size
+    self.map = None
+    if _sendfile is None:
+      self.map = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ)
+
+  # @param sock(socket)  non-blocking socket to send to
+  # @return (Boolean)  whether the whole file is sent
+  def send(self, sock):
+    count = min(SEND_SIZE, self.size - self.offset)
+    if self.map is None:
+      self.offset += _sendfile(sock.fileno(), self.f.fileno(), self.offset,
+                               count)
+    else:
+      self.offset += sock.send(buffer(self.map, self.offset, count))
+    return self.offset >= self.size
+
+  def close(self):
+    if self.map is not None:
+      self.map.close()
+    self.f.close()
+
+
+class _Connection(asyncore.dispatcher):
+  '''
+  One client connection, answering its requests in the order they came.
+  '''
+
+  def __init__(self, server, sock):
+    asyncore.dispatcher.__init__(self, sock, map=server.map)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.server = server
+    self.received = ''
+    self.out = deque()  # strings and _FileBody's
+    self.closing = False  # once what is queued is sent
+
+  def readable(self):
+    return not self.closing
+
+  def writable(self):
+    return bool(self.out)
+
+  def handle_read(self):
+    data = self.recv(RECV_SIZE)
+    if not data:
+      return
+    self.received += data
+    while not self.closing:
+      end = self.received.find('\r\n\r\n')
+      if end < 0:
+        if len(self.received) > MAX_HEADERS:
+          self.respond_error(400, 'HTTP/1.1')
+        break
+      head = self.received[:end]
+      self.received = self.received[end + 4:]
+      self.respond(head)
+    self.handle_write()  # most responses fit in the socket buffer
+
+  def handle_write(self):
+    try:
+      while self.out:
+        piece = self.out[0]
+        if isinstance(piece, _FileBody):
+          if not piece.send(self.socket):
+            return
+          piece.close()
+        else:
+          sent = self.socket.send(piece)
+          if sent < len(piece):
+            self.out[0] = buffer(piece, sent)
+            return
+        self.out.popleft()
+    except (socket.error, OSError), e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self.close()
+      return
+    if self.closing:
+      self.close()
+
+  def handle_close(self):
+    self.close()
+
+  def handle_error(self):
+    print >> sys.stderr, 'error serving', self.addr, sys.exc_info()[1]
+    self.close()
+
+  def close(self):
+    for piece in self.out:
+      if isinstance(piece, _FileBody):
+        piece.close()
+    self.out.clear()
+    asyncore.dispatcher.close(self)
+
+  # @param head(str)  request line and headers
+  def respond(self, head):
+    lines = head.split('\r\n')
+    request = lines[0].split()
+    if len(request) != 3 or not request[2].startswith('HTTP/'):
+      return self.respond_error(400, 'HTTP/1.1')
+    method, target, version = request
+    headers = {}
+    for line in lines[1:]:
+      name, colon, value = line.partition(':')
+      headers[name.strip().lower()] = value.strip()
+    if method not in ('GET', 'HEAD') or 'content-length' in headers or \
+       'transfer-encoding' in headers:
+      # a body we don't read would be taken for the next request
+      return self.respond_error(405, version)
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+      keep_alive = 'close' not in connection
+    else:
+      keep_alive = 'keep-alive' in connection
+    found = self.server.resolve(target,
+                                'gzip' in headers.get('accept-encoding', ''))
+    if isinstance(found, int):
+      return self.respond_error(found, version)
+    filename, st, type, encoding = found
+    extra = []
+    if encoding:
+      extra.append('Content-Encoding: ' + encoding)
+    if type.split(';')[0] in GZIP_TYPES:
+      extra.append('Vary: Accept-Encoding')
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    extra.append('Last-Modified: ' + last_modified)
+    if headers.get('if-modified-since') == last_modified:
+      self.out.append(self.response_head(304, version, keep_alive, None, 0,
+                                         extra))
+    else:
+      head = self.response_head(200, version, keep_alive, type, st.st_size,
+                                extra)
+      if method == 'HEAD':
+        self.out.append(head)
+      elif st.st_size < self.server.sendfile_min:
+        self.out.append(head + self.server.read(filename, st))
+      else:
+        self.out.append(head)
+        self.out.append(_FileBody(filename, st.st_size))
+        self.server.stats['large'] += 1
+      if method == 'GET':
+        self.server.stats['bytes'] += st.st_size
+    self.server.stats['requests'] += 1
+    if not keep_alive:
+      self.closing = True
+
+  # @param status(int)  HTTP status code
+  # @param version(str)  HTTP version of the request
+  # @param keep_alive(Boolean)  whether the connection is kept open
+  # @param type(str)  Content-Type, None for no body
+  # @param length(int)  Content-Length
+  # @param extra=()(list)  other header lines
+  # @return (str)  status line and headers
+  def response_head(self, status, version, keep_alive, type, length,
+                    extra=()):
+    lines = ['HTTP/1.1 {status} {reason}'.format(status=status,
+                                                 reason=STATUS[status]),
+             'Date: ' + self.server.date(),
+             'Server: FBParser']
+    if type is not None:
+      lines.append('Content-Type: ' + type)
+    if status != 304:
+      lines.append('Content-Length: {n}'.format(n=length))
+    if not keep_alive:
+      lines.append('Connection: close')
+    elif version == 'HTTP/1.0':
+      lines.append('Connection: keep-alive')
+    lines.extend(extra)
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+  # @param status(int)  HTTP status code
+  # @param version(str)  HTTP version of the request
+  def respond_error(self, status, version):
+    body = '{status} {reason}\n'.format(status=status, reason=STATUS[status])
+    keep_alive = status in (403, 404)  # the request was read whole
+    self.out.append(self.response_head(status, version, keep_alive,
+                                       'text/plain', len(body)) + body)
+    self.server.stats['errors'] += 1
+    if not keep_alive:
+      self.closing = True
+
+#
+# APIs
+#
+
+
+class StaticServer(asyncore.dispatcher):
+  '''
+  HTTP server of the files under a directory.
+  Usage:
+    server = StaticServer('samples', port=8000)
+    server.serve_forever()  # until server.shutdown(), from another thread
+  '''
+
+  # @param root(str)  directory whose files are served
+  # @param host='127.0.0.1'(str)  address to listen on
+  # @param port=DEFAULT_PORT(int)  port to listen on, 0 for a free one
+  # @param cache_bytes=DEFAULT_CACHE_BYTES(int)  size of the in-memory cache
+  # @param sendfile_min=DEFAULT_SENDFILE_MIN(int)  size from which files are
+  #                                                not read into memory
+  def __init__(self, root, host='127.0.0.1', port=DEFAULT_PORT,
+               cache_bytes=DEFAULT_CACHE_BYTES,
+               sendfile_min=DEFAULT_SENDFILE_MIN):
+    self.map = {}
+    asyncore.dispatcher.__init__(self, map=self.map)
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(socket.SOMAXCONN)
+    self.root = os.path.realpath(root)
+    self.cache = _FileCache(cache_bytes)
+    self.sendfile_min = sendfile_min
+    self.types = {}  # filename -> Content-Type
+    self.stopped = False
+    self.stats = dict.fromkeys(
+      ('requests', 'bytes', 'errors', 'hits', 'misses', 'large', 'gzip'), 0)
+    self._date = (None, None)
+
+  # @return (tuple)  (host, port) the server listens on
+  @property
+  def address(self):
+    return self.socket.getsockname()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is not None:
+      _Connection(self, pair[0])
+
+  # @return (str)  the current time, for the Date header
+  def date(self):
+    now = int(time.time())
+    if self._date[0] != now:
+      self._date = (now, formatdate(now, usegmt=True))
+    return self._date[1]
+
+  # @param target(str)  path of a request, as sent
+  # @param gzip(Boolean)  whether the client accepts gzip
+  # @return (tuple)  (filename, os.stat of it, Content-Type, Content-Encoding
+  #                  or None) of the file to send, or the HTTP status code
+  #                  of the error
+  def resolve(self, target, gzip):
+    path = unquote(target.split('#', 1)[0]).lstrip('/')
+    filename = os.path.normpath(os.path.join(self.root, path))
+    if not os.path.isfile(filename):  # some resources keep their query
+      filename = os.path.normpath(os.path.join(self.root,
+                                               path.split('?', 1)[0]))
+    if filename != self.root and \
+       not filename.startswith(self.root + os.sep):
+      return 403
+    try:
+      st = os.stat(filename)
+    except OSError:
+      return 404
+    if not os.path.isfile(filename):
+      filename = os.path.join(filename, 'index.html')
+      try:
+        st = os.stat(filename)
+      except OSError:
+        return 404
+    type = self.types.get(filename)
+    if type is None:
+      type = self.types[filename] = _content_type(filename)
+    if gzip and type.split(';')[0] in GZIP_TYPES:
+      try:
+        gz_st = os.stat(filename + '.gz')
+        if gz_st.st_mtime >= st.st_mtime:
+          self.stats['gzip'] += 1
+          return filename + '.gz', gz_st, type, 'gzip'
+      except OSError:
+        pass
+    return filename, st, type, None
+
+  # @param filename(str)  a small file
+  # @param st(os.stat_result)  its stat
+  # @return (str)  its content, from the cache if it is there
+  def read(self, filename, st):
+    stamp = (st.st_mtime, st.st_size)
+    content = self.cache.get(filename, stamp)
+    if content is not None:
+      self.stats['hits'] += 1
+      return content
+    self.stats['misses'] += 1
+    f = open(filename, 'rb')
+    content = f.read()
+    f.close()
+    if len(content) == st.st_size:  # not caught being rewritten
+      self.cache.put(filename, stamp, content)
+    return content
+
+  def serve_forever(self):
+    '''
+    Run the event loop until shutdown() is called.
+    '''
+    while not self.stopped:
+      asyncore.poll2(WAIT, self.map)
+    asyncore.close_all(self.map)
+
+  def shutdown(self):
+    self.stopped = True
+
+
+# @param root(str)  directory to be walked
+# @param min_size=GZIP_MIN(int)  smaller files are left alone
+# @return (int)  number of .gz files written
+def precompress(root, min_size=GZIP_MIN):
+  '''
+  Write file.gz next to every compressible file under root that lacks an
+  up-to-date one, if compression makes it any smaller.
+  '''
+  count = 0
+  for dir, dirs, files in os.walk(root):
+    for name in files:
+      filename = os.path.join(dir, name)
+      if name.endswith('.gz') or \
+         _content_type(filename).split(';')[0] not in GZIP_TYPES:
+        continue
+      st = os.stat(filename)
+      gz = filename + '.gz'
+      if st.st_size < min_size or \
+         (os.path.isfile(gz) and os.path.getmtime(gz) >= st.st_mtime):
+        continue
+      tmp = temp_file(dir)
+      try:
+        f = open(filename, 'rb')
+        out = gzip.GzipFile(tmp, 'wb', 9, mtime=st.st_mtime)
+        out.write(f.read())
+        out.close()
+        f.close()
+        if os.path.getsize(tmp) < st.st_size:
+          os.rename(tmp, gz)
+          count += 1
+      finally:
+        if os.path.exists(tmp):
+          os.remove(tmp)
+  return count
+
+
+def main():
+  if ArgumentParser is None:
+    print >> sys.stderr, 'This module uses the argparse module.'
+    sys.exit(1)
+  parser = ArgumentParser(
+    formatter_class=RawDescriptionHelpFormatter,
+    description=__doc__)
+  parser.add_argument('dir', help='directory of samples to serve')
+  parser.add_argument('-b', '--bind', default='127.0.0.1',
+                      help='address to listen on')
+  parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                      help='port to listen on')
+  parser.add_argument('-c', '--cache-mb', type=int,
+                      default=DEFAULT_CACHE_BYTES >> 20,
+                      help='MB of small files kept in memory')
+  parser.add_argument('-s', '--sendfile-kb', type=int,
+                      default=DEFAULT_SENDFILE_MIN >> 10,
+                      help='KB from which files are sent, not cached')
+  parser.add_argument('--gzip', action='store_true',
+                      help='precompress the compressible files first')
+  args = parser.parse_args()
+  if args.gzip:
+    print >> sys.stderr, '{n} file(s) precompressed'.format(
+      n=precompress(args.dir))
+  server = StaticServer(args.dir, args.bind, args.port, args.cache_mb << 20,
+                        args.sendfile_kb << 10)
+  print >> sys.stderr, 'serving {dir} on http://{host}:{port}/'.format(
+    dir=server.root, host=server.address[0], port=server.address[1])
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  for key, val in sorted(server.stats.items()):
+    print >> sys.stderr, '{key}: {val}'.format(key=key, val=val)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/stages.py
+
+Checkpointed stages of a page conversion.
+Every completed stage leaves its output behind as an artifact, recorded in a
+manifest along with a hash of the stage's input. When the conversion is run
+again (e.g. after a failure late in the chain), stages whose input hasn't
+changed are not run, their output is read back from the artifact instead;
+the first stage with a new input, or without a (sound) artifact, is where
+the work resumes.
+
+Layout, in the directory of the page:
+  stages/<name>.manifest  stage -> {input: SHA-1 of the input,
+                                    kind: text or json,
+                                    sha1: SHA-1 of the artifact}
+  stages/<name>.<stage>   artifacts
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'StageManifest',
+          ]
+
+#
+# Imports
+#
+import os
+import json
+import codecs
+import shutil
+import hashlib
+from FBParser.cache import temp_file
+
+#
+# Internal functions
+#
+
+STAGE_DIR = 'stages'
+TEXT = 'text'  # kinds of artifacts
+JSON = 'json'
+
+
+# @param value  input of a stage, a string or anything JSON can take
+# @return (str)  bytes the value is hashed from
+def _to_bytes(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if isinstance(value, str):
+    return value
+  return json.dumps(value, sort_keys=True, default=sorted)
+
+
+# @param filename(str)  file to be hashed
+# @return (str)  hex SHA-1 digest of the content
+def _hash_file(filename):
+  f = open(filename, 'rb')
+  sha1 = hashlib.sha1(f.read())
+  f.close()
+  return sha1.hexdigest()
+
+#
+# APIs
+#
+
+
+class StageManifest(object):
+  '''
+  Run the stages of a conversion, skipping those already done.
+  Usage:
+    stages = StageManifest(path, 'convert')
+    dom = stages.run('decavalry', decavalry, dom)
+    dom = stages.run('localize_css', localize_css, dom, path)
+    ...
+    stages.clear()  # all done, drop the artifacts
+  A stage is a function of its inputs, which must be strings or JSON-able
+  (sets are taken as sorted lists); anything else it needs is better bound
+  in a lambda, so that it is not part of the hash. Its output must be a
+  string or JSON-able too. Side effects of a stage (e.g. files downloaded)
+  are assumed to be still there when it is skipped.
+  '''
+
+  # @param dir(str)  directory of the page
+  # @param name=convert(str)  name of the conversion, several may coexist
+  # @param fresh=False(Boolean)  ignore what previous runs have done
+  # @param profile=None(StageProfile)  where to record what each stage took,
+  #                                    see FBParser.timing
+  def __init__(self, dir, name='convert', fresh=False, profile=None):
+    self.dir = os.path.join(dir, STAGE_DIR)
+    self.name = name
+    self.profile = profile
+    self.manifest = os.path.join(self.dir, name + '.manifest')
+    self.stages = {}
+    self.skipped = []  # stages found done by a previous run
+    if not os.path.isdir(self.dir):
+      os.makedirs(self.dir)
+    if not fresh and os.path.isfile(self.manifest):
+      try:
+        f = open(self.manifest, 'r')
+        self.stages = json.load(f)
+        f.close()
+      except (IOError, ValueError):
+        self.stages = {}  # corrupted manifest, start over
+
+  # @param stage(str)  name of the stage
+  # @return (str)  where the output of the stage is kept
+  def _artifact(self, stage):
+    return os.path.join(self.dir, self.name + '.' + stage)
+
+  # @param stage(str)  name of the stage
+  # @param digest(str)  hash of the current input of the stage
+  # @return (tuple)  (Boolean, output), whether the stage is done already
+  def _load(self, stage, digest):
+    entry = self.stages.get(stage)
+    artifact = self._artifact(stage)
+    if entry is None or entry['input'] != digest or \
+       not os.path.isfile(artifact) or _hash_file(artifact) != entry['sha1']:
+      return False, None
+    f = codecs.open(artifact, 'r', 'utf-8')
+    content = f.read()
+    f.close()
+    if entry['kind'] == JSON:
+      content = json.loads(content)
+    return True, content
+
+  # @param stage(str)  name of the stage
+  # @param digest(str)  hash of the input of the stage
+  # @param output  what the stage returned
+  def _save(self, stage, digest, output):
+    artifact = self._artifact(stage)
+    kind = TEXT if isinstance(output, basestring) else JSON
+    tmp = temp_file(self.dir, self.name + '.')
+    f = codecs.open(tmp, 'w', 'utf-8')
+    f.write(output if kind == TEXT else json.dumps(output, default=sorted))
+    f.close()
+    os.rename(tmp, artifact)
+    self.stages[stage] = {'input': digest, 'kind': kind,
+                          'sha1': _hash_file(artifact)}
+    # write the manifest back at once, the next stage may be the one failing
+    tmp = temp_file(self.dir, self.name + '.')
+    f = open(tmp, 'w')
+    json.dump(self.stages, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, self.manifest)
+
+  # @param stage(str)  name of the stage
+  # @param func(function)  the stage itself
+  # @param inputs  arguments of func
+  # @return  output of the stage, computed now or by a previous run
+  def run(self, stage, func, *inputs):
+    '''
+    Run a stage unless a previous run has done it with the same inputs.
+    '''
+    sha1 = hashlib.sha1(stage)
+    for value in inputs:
+      sha1.update(_to_bytes(value))
+      sha1.update('\0')
+    digest = sha1.hexdigest()
+    done, output = self._load(stage, digest)
+    if done:
+      self.skipped.append(stage)
+      if self.profile is not None:
+        self.profile.skip(stage)
+      return output
+    if self.profile is not None:
+      output = self.profile.run(stage, func, *inputs)
+    else:
+      output = func(*inputs)
+    self._save(stage, digest, output)
+    return output
+
+  def clear(self):
+    '''
+    Drop the manifest and all the artifacts, once the conversion is over.
+    '''
+    for entry in os.listdir(self.dir):  # also those of previous runs
+      if entry.startswith(self.name + '.'):
+        os.remove(os.path.join(self.dir, entry))
+    self.stages = {}
+    if not os.listdir(self.dir):
+      shutil.rmtree(self.dir)
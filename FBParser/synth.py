@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/synth.py
+
+Synthetic Facebook-like pages, for benchmarks and regression checks at
+controlled sizes (real crawls are private).
+A page has what the parser expects of a crawled home page: CavalryLogger
+first, the noscript/search/icon resources of localize_misc, css & js
+references both as tags and in Bootloader resource maps, nested pagelet
+divs of stories (text, images, onclicks) and one big_pipe.onPageletArrive
+script per pagelet, all fields included, plus one for a pagelet that is not
+on the page. Matching CSS files use the classes and ids of the page and
+refer to images of their own.
+
+Run this module directly to write a page (and its CSS files) to a directory.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'synth_page', 'write_page',
+          ]
+
+#
+# Imports
+#
+from FBParser import jsonify, save_content
+# external imports
+import os
+import random
+try:
+  from argparse import ArgumentParser, RawDescriptionHelpFormatter
+except ImportError:
+  ArgumentParser = None
+
+#
+# Internal functions
+#
+
+STATIC = 'http://static.ak.fbcdn.net'
+PHOTOS = 'http://photos-a.ak.fbcdn.net/hphotos-ak-snc4'
+WORDS_PER_STORY = 40
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua '
+         u'caf\xe9 na\xefve \u2014 "quoted" 1&lt;2 &amp;').split()
+CLASSES = ('clearfix', 'uiStreamStory', 'actorName', 'messageBody', 'uiList',
+           'fsm', 'fwn', 'fcg', 'uiStreamFooter', 'hidden_elem', 'img',
+           'lfloat', 'rfloat', 'pagelet', 'uiBoxGray', 'uiHeader')
+
+
+# @param i(int)  number of the resource
+# @param ext(str)  css or js
+# @return (str)  url of a static resource
+def _rsrc(i, ext):
+  return '{site}/rsrc.php/v1/y{d}/r/{ext}{i:05d}.{ext}'.format(
+    site=STATIC, d=i % 64, ext=ext, i=i)
+
+
+# @param url(str)  url of a static resource
+# @return (str)  name of the resource in resource maps
+def _rsrc_name(url):
+  return url[url.rfind('/') + 1:url.rfind('.')]
+
+
+# @param url(str)  url of a static resource
+# @param kind(str)  css or js
+# @return (str)  entry of a resource map, as in Bootloader and pipes
+def _rsrc_entry(url, kind):
+  return '"{name}":{{"type":"{kind}","src":"{url}"}}'.format(
+    name=_rsrc_name(url), kind=kind, url=jsonify(url))
+
+
+# @param rand(Random)  random generator
+# @param n(int)  number of words
+# @return (unicode)  text
+def _text(rand, n):
+  return u' '.join(rand.choice(WORDS) for i in range(n))
+
+
+# @param rand(Random)  random generator
+# @param story(int)  number of the story on the page
+# @param words(int)  number of words of its text
+# @param images(list)  urls of the images in the story
+# @return (unicode)  a stream story
+def _story(rand, story, words, images):
+  pieces = [
+    u'<div class="{cls} uiStreamStory-{n}" id="stream_story_{n}" '
+    u'data-ft="{{&quot;qid&quot;:{n}}}">'
+    u'<a class="actorName" href="http://www.facebook.com/profile.php?id={n}"'
+    u' onclick="return wait_for_load(this, event);">{name}</a>'
+    u'<span class="messageBody">{text}</span>'.format(
+      cls=' '.join(rand.sample(CLASSES, 2)), n=story,
+      name=_text(rand, 2), text=_text(rand, words))]
+  for url in images:
+    pieces.append(u'<img class="img" src="{url}" alt="" />'.format(url=url))
+  pieces.append(
+    u"<ul class='uiList'><li><a href=\"#\" onclick='UFI.like({n});'>Like"
+    u"</a></li></ul><input type=\"hidden\" name=\"fb_dtsg\" value=\"AQ{n}\" />"
+    u'<br /></div>\n'.format(n=story))
+  return u''.join(pieces)
+
+
+# @param id(str)  id of the pagelet
+# @param css(list)  urls of css files the pagelet needs
+# @param js(list)  urls of js files the pagelet needs
+# @param last(Boolean)  whether it is the last pagelet to arrive
+# @return (str)  the big pipe script of the pagelet
+def _pipe(id, css, js, last=False):
+  names = map(_rsrc_name, css + js)
+  return (
+    '<script>big_pipe.onPageletArrive({{"id":"{id}","phase":1,'
+    '"is_last":{last},"append":false,"display_dependency":["{id}"],'
+    '"bootloadable":{{"{id}":{{"resources":[{names}],"module":true}}}},'
+    '"css":[{css}],"js":[{js}],"resource_map":{{{map}}},'
+    '"requires":[["{id}","init",[]]],"provides":["pagelet:{id}"],'
+    '"onload":["Arbiter.inform(\\"{id}\\")"],"onafterload":[],'
+    '"onpagecache":[],"onafterpagecache":[],"refresh_pagelets":[],'
+    '"invalidate_cache":[],"content":{{"{id}":""}},"page_cache":true}});'
+    '</script>\n').format(
+      id=id, last='true' if last else 'false',
+      names=','.join('"{n}"'.format(n=name) for name in names),
+      css=','.join('"{n}"'.format(n=name) for name in names[:len(css)]),
+      js=','.join('"{n}"'.format(n=name) for name in names[len(css):]),
+      map=','.join([_rsrc_entry(url, 'css') for url in css] +
+                   [_rsrc_entry(url, 'js') for url in js]) or '"none":{}')
+
+
+# @param rand(Random)  random generator
+# @param classes(list)  classes used on the page
+# @param ids(list)  ids used on the page
+# @param images(list)  urls of the images of the file
+# @return (str)  a css file
+def _css(rand, classes, ids, images):
+  rules = ['/* synthetic style sheet */']
+  for cls in classes:
+    rules.append('.{a} .{b}{{margin:0;padding:{n}px}}'.format(
+      a=cls, b=rand.choice(CLASSES), n=rand.randint(0, 9)))
+  for id in ids:
+    rules.append('#{id} .uiHeader{{font-weight:bold}}'.format(id=id))
+  for url in images:
+    rules.append('.sprite_{n}{{background-image:url({url})}}'.format(
+      n=_rsrc_name(url), url=url))
+  return '\n'.join(rules) + '\n'
+
+#
+# APIs
+#
+
+
+# @param pagelets=10(int)  number of top level pagelets
+# @param depth=2(int)  nesting depth of pagelets, 1 for no embedded pagelet
+# @param words=200(int)  number of words of text in each pagelet
+# @param resources=10(int)  number of css files, of js files and of images
+# @param css=True(Boolean)  whether to make the css files too
+# @param seed=0(int)  seed of the random generator, same seed same page
+# @return (dict)  the page ('html'), its css files by name ('css') and the
+#                 ids of its pagelets, in the order of their pipes
+#                 ('pagelets')
+def synth_page(pagelets=10, depth=2, words=200, resources=10, css=True,
+               seed=0):
+  '''
+  Generate a Facebook-like page of the given size.
+  Half of the css/js files are referenced by tags in the head, the others
+  by resource maps in the pipes; images are spread over the stories.
+  '''
+  rand = random.Random(seed)
+  csses = [_rsrc(i, 'css') for i in range(resources)]
+  jses = [_rsrc(i, 'js') for i in range(resources)]
+  images = ['{site}/{i}_{n}_n.jpg'.format(site=PHOTOS, i=i, n=seed)
+            for i in range(resources)]
+  head = [
+    u'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+    u'"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n'
+    u'<html xmlns="http://www.w3.org/1999/xhtml" lang="en" id="facebook" '
+    u'class="no_js">\n<head>'
+    u'<meta http-equiv="Content-type" content="text/html; charset=utf-8" />'
+    u'<script>window.CavalryLogger={start:(new Date()).getTime()};'
+    u'</script>\n'
+    u'<noscript><meta http-equiv="refresh" content="0; '
+    u'URL=http://www.facebook.com/home.php?_fb_noscript=1" /></noscript>\n'
+    u'<title>Facebook</title>\n']
+  for url in csses[::2]:
+    head.append(u'<link type="text/css" rel="stylesheet" href="{url}" />\n'
+                .format(url=url))
+  for url in jses[::2]:
+    head.append(u'<script type="text/javascript" src="{url}"></script>\n'
+                .format(url=url))
+  head.append(
+    u'<script>Bootloader.setResourceMap({{{map}}});\n'
+    u'Bootloader.configurePage([]);\nBootloader.done([]);</script>\n'
+    u'<link rel="search" type="application/opensearchdescription+xml" '
+    u'href="{site}/opensearch_description.xml" title="Facebook">\n'
+    u'<link rel="shortcut icon" href="{site}/rsrc.php/yi/r/q9U99v3_saj.ico">'
+    u'\n</head>\n'.format(
+      site=STATIC,
+      map=','.join(_rsrc_entry(url, 'css') for url in csses[::2])))
+  body = [
+    u'<body class="home fbx">\n'
+    u'<div>Cavalry</div><a href="#" class="hidden_elem"></a>'
+    u'<div>Logger</div><a href="#" class="hidden_elem"></a>\n'
+    u'<div id="globalContainer"><div id="content" class="fb_content">\n']
+  ids = []
+  pipes = []
+  stories = max(1, -(-words // WORDS_PER_STORY))  # per pagelet
+  total = pagelets * depth * stories
+  story = 0
+  for i in range(pagelets):
+    # a chain of nested pagelets, the innermost one first to arrive or last
+    chain = ['pagelet_{i}'.format(i=i)]
+    for level in range(1, depth):
+      chain.append('{outer}_{level}'.format(outer=chain[-1], level=level))
+    for id in chain:
+      body.append(u'<div id="{id}" class="pagelet {cls}"><div class="{cls}">'
+                  .format(id=id, cls=rand.choice(CLASSES)))
+      for s in range(stories):
+        body.append(_story(rand, story, words // stories,
+                           images[story::total]))
+        story += 1
+    body.append(u'</div></div>' * len(chain) + u'\n')
+    if rand.random() < 0.5:
+      chain.reverse()
+    ids.extend(chain)
+  # pipes of resources not on the page otherwise
+  extra_css = csses[1::2]
+  extra_js = jses[1::2]
+  for n, id in enumerate(ids + ['pagelet_hidden']):
+    pipes.append(_pipe(id, extra_css[n::len(ids) + 1],
+                       extra_js[n::len(ids) + 1], n == len(ids)))
+  body.append(u'</div></div>\n')
+  body.extend(pipes)
+  body.append(u'<iframe src="{site}/common/redirectiframe.html" '
+              u'class="hidden_elem" name="uic"></iframe>\n</body>\n</html>\n'
+              .format(site=STATIC))
+  files = {}
+  if css:
+    classes = list(CLASSES) + \
+      ['uiStreamStory-{n}'.format(n=n) for n in range(0, story, 7)]
+    sprites = ['/rsrc.php/v1/yQ/r/s{i:05d}.png'.format(i=i)
+               for i in range(resources)]
+    for n, url in enumerate(csses):
+      files[url[url.rfind('/') + 1:]] = _css(
+        rand, classes[n::len(csses)], ids[n::len(csses)],
+        sprites[n::len(csses)])
+  return {'html': u''.join(head + body), 'css': files,
+          'pagelets': ids + ['pagelet_hidden']}
+
+
+# @param dir(str)  directory to write the page to
+# @param filename='dom.html'(str)  name of the page
+# @param knobs  arguments of synth_page
+# @return (dict)  as returned by synth_page
+def write_page(dir, filename='dom.html', **knobs):
+  '''
+  Generate a page and save it, its css files in the css/ sub-dir.
+  '''
+  page = synth_page(**knobs)
+  if not os.path.isdir(dir):
+    os.makedirs(dir)
+  save_content(page['html'], os.path.join(dir, filename))
+  if page['css']:
+    css_dir = os.path.join(dir, 'css')
+    if not os.path.isdir(css_dir):
+      os.mkdir(css_dir)
+    for file, content in page['css'].items():
+      save_content(content, os.path.join(css_dir, file), encoding='ascii')
+  return page
+
+#
+# Default
+#
+
+
+def main():
+  parser = ArgumentParser(
+    formatter_class=RawDescriptionHelpFormatter,
+    description=__doc__)
+  parser.add_argument('dir', help='directory to write the page to')
+  parser.add_argument('-f', '--filename', default='dom.html')
+  parser.add_argument('-p', '--pagelets', type=int, default=10,
+                      help='number of top level pagelets')
+  parser.add_argument('-d', '--depth', type=int, default=2,
+                      help='nesting depth of pagelets')
+  parser.add_argument('-w', '--words', type=int, default=200,
+                      help='number of words of text in each pagelet')
+  parser.add_argument('-r', '--resources', type=int, default=10,
+                      help='number of css files, of js files and of images')
+  parser.add_argument('--no-css', dest='css', action='store_false',
+                      help='do not write the css files')
+  parser.add_argument('-s', '--seed', type=int, default=0)
+  args = parser.parse_args()
+  page = write_page(args.dir, args.filename, pagelets=args.pagelets,
+                    depth=args.depth, words=args.words,
+                    resources=args.resources, css=args.css, seed=args.seed)
+  print "{size} chars, {n} pagelets, {c} css files".format(
+    size=len(page['html']), n=len(page['pagelets']), c=len(page['css']))
+
+if __name__ == '__main__':
+  main()
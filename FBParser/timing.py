@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+__doc__ = '''
+FBParser/timing.py
+
+Per-stage instrumentation of a page conversion: wall time, CPU time (child
+processes included, e.g. garbling workers), bytes in and out of each named
+stage, and the network retrievals it triggered.
+A StageProfile is saved as one JSON file per page; rollup() summarizes many
+of them into corpus-wide percentiles.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+__all__ = [
+            'StageProfile', 'rollup', 'print_rollup',
+          ]
+
+#
+# Imports
+#
+import os
+import json
+import math
+import time
+from collections import OrderedDict
+from FBParser.fetch import fetch_stats
+
+#
+# Internal functions
+#
+
+METRICS = ('wall', 'cpu', 'bytes_in', 'bytes_out', 'fetches', 'fetched_bytes')
+PERCENTILES = (50, 90, 99)
+
+
+# @return (float)  CPU seconds used by this process and its reaped children
+def _cpu():
+  times = os.times()
+  return times[0] + times[1] + times[2] + times[3]
+
+
+# @param value  input or output of a stage
+# @return (int)  its size in bytes, UTF-8 encoded if it is unicode, 0 if it
+#                is not a string (or a list of strings)
+def _size(value):
+  if isinstance(value, unicode):
+    return len(value.encode('utf-8'))
+  if isinstance(value, str):
+    return len(value)
+  if isinstance(value, dict):
+    return sum(_size(item) for item in value.values())
+  if isinstance(value, (list, tuple)):
+    return sum(_size(item) for item in value)
+  return 0
+
+
+# @param values(list)  numbers
+# @param percentile(int)  0-100
+# @return (float)  nearest-rank percentile of the values
+def _percentile(values, percentile):
+  values = sorted(values)
+  rank = int(math.ceil(percentile / 100.0 * len(values))) - 1
+  return values[min(max(rank, 0), len(values) - 1)]
+
+#
+# APIs
+#
+
+
+class StageProfile(object):
+  '''
+  Timings of the named stages of one conversion, in the order they ran.
+  Usage:
+    profile = StageProfile('some page')
+    dom = profile.run('decavalry', decavalry, dom)
+    ...
+    profile.save(os.path.join(path, 'profile.json'))
+  StageManifest(..., profile=profile) records the stages it runs (or skips).
+  A stage run from within another one is recorded right after it, 'within'
+  it, and left out of the totals.
+  '''
+
+  # @param page(str)  what is being converted
+  def __init__(self, page=''):
+    self.page = page
+    self.stages = []
+    self.start = time.time()
+    self.running = []  # names of the stages being run, outermost first
+
+  # @param stage(str)  name of the stage
+  # @param func(function)  the stage itself
+  # @param inputs  arguments of func, those that are strings are counted as
+  #                bytes in
+  # @return  output of func
+  def run(self, stage, func, *inputs):
+    '''
+    Run a stage and record what it took.
+    '''
+    index = len(self.stages)  # ahead of the stages it runs
+    within = self.running[-1] if self.running else None
+    fetched = fetch_stats()
+    wall, cpu = time.time(), _cpu()
+    self.running.append(stage)
+    try:
+      output = func(*inputs)
+    finally:
+      self.running.pop()
+    wall, cpu = time.time() - wall, _cpu() - cpu
+    now = fetch_stats()
+    entry = {
+      'stage': stage,
+      'wall': wall,
+      'cpu': cpu,
+      'bytes_in': sum(_size(value) for value in inputs),
+      'bytes_out': _size(output),
+      'fetches': now['fetches'] - fetched['fetches'],
+      'fetched_bytes': now['bytes'] - fetched['bytes'],
+      }
+    if within is not None:
+      entry['within'] = within
+    self.stages.insert(index, entry)
+    return output
+
+  # @param stage(str)  name of a stage that did not need to run
+  def skip(self, stage):
+    entry = dict.fromkeys(METRICS, 0)
+    entry.update(stage=stage, skipped=True)
+    self.stages.append(entry)
+
+  # @return (dict)  the profile, as saved
+  def report(self):
+    totals = dict.fromkeys(METRICS, 0)
+    for entry in self.stages:
+      if 'within' in entry:  # counted in the stage running it
+        continue
+      for metric in METRICS:
+        totals[metric] += entry[metric]
+    totals['wall'] = time.time() - self.start  # stages or not
+    return {'page': self.page, 'stages': self.stages, 'total': totals}
+
+  # @param filename(str)  JSON file to write the profile to
+  def save(self, filename):
+    f = open(filename, 'w')
+    json.dump(self.report(), f, indent=1, sort_keys=True)
+    f.close()
+
+
+# @param profiles(list)  profiles as saved by StageProfile.save, or their
+#                        file names
+# @return (OrderedDict)  stage -> metric -> {'p50', 'p90', 'p99', 'max',
+#                        'sum'}, plus the number of pages each stage ran for
+#                        ('pages'), stages in the order they ran
+def rollup(profiles):
+  '''
+  Summarize the profiles of many pages, stage by stage.
+  Stages skipped (by a resumed run) are left out.
+  '''
+  values = {}  # stage -> metric -> list
+  order = []
+  for profile in profiles:
+    if isinstance(profile, basestring):
+      f = open(profile, 'r')
+      profile = json.load(f)
+      f.close()
+    entries = profile['stages'] + [dict(profile['total'], stage='total')]
+    for entry in entries:
+      if entry.get('skipped'):
+        continue
+      if entry['stage'] not in values:
+        values[entry['stage']] = dict((metric, []) for metric in METRICS)
+        order.append(entry['stage'])
+      for metric in METRICS:
+        values[entry['stage']][metric].append(entry[metric])
+  summary = OrderedDict()
+  for stage in order:
+    summary[stage] = {'pages': len(values[stage]['wall'])}
+    for metric in METRICS:
+      stats = {'max': max(values[stage][metric]),
+               'sum': sum(values[stage][metric])}
+      for percentile in PERCENTILES:
+        stats['p{p}'.format(p=percentile)] = \
+          _percentile(values[stage][metric], percentile)
+      summary[stage][metric] = stats
+  return summary
+
+
+# @param summary(OrderedDict)  as returned by rollup
+# @param metrics=('wall', 'cpu', 'bytes_out')(tuple)  columns to print
+def print_rollup(summary, metrics=('wall', 'cpu', 'bytes_out')):
+  header = '{stage:<24} {pages:>5}'.format(stage='stage', pages='pages')
+  for metric in metrics:
+    for percentile in PERCENTILES:
+      header += ' {name:>12}'.format(
+        name='{metric}.p{p}'.format(metric=metric, p=percentile))
+  print header
+  for stage, stats in summary.items():
+    line = '{stage:<24} {pages:>5}'.format(stage=stage, pages=stats['pages'])
+    for metric in metrics:
+      for percentile in PERCENTILES:
+        line += ' {value:>12.3f}'.format(
+          value=stats[metric]['p{p}'.format(p=percentile)])
+    print line
@@ -1,19 +1,61 @@
 #!/usr/bin/env python
+'''Convert every sample directory under the given path.
+Options before the path (e.g. --cache DIR) are passed on to get_benchmark.py;
+with a resource, garble and/or selector cache, their hit/miss reports over
+the whole run are printed; with a resource archive (--record or --replay),
+its size.
+Directories that fail are kept: running the batch again resumes each of them
+from the stage that failed, and skips those already converted.
+With --profile, the per-page profiles are rolled up into corpus-wide
+percentiles of each stage, printed and saved as profile_rollup.json.'''
 
 import os
 import sys
+import json
 import subprocess
+import FBParser.cache
+import FBParser.archive
+import FBParser.timing
 
 path = sys.argv[-1]
+options = sys.argv[1:-1]
 dirs = os.listdir(path)
+failed = []
 for dir in dirs:
   real_path = os.path.join(path, dir)
-  if os.path.isdir(real_path):
+  # dom.html is removed once converted
+  if os.path.isfile(os.path.join(real_path, "dom.html")):
     ret = subprocess.call(
       ["python",
-       "get_benchmark.py",
-       "convert",
+       "get_benchmark.py"] + options +
+      ["convert",
        os.path.join(real_path, "dom.html")])
     if ret != 0:
       print >> sys.stderr, "error with", dir
-      subprocess.call(["rm", "-rf", real_path])
+      failed.append(dir)
+if failed:
+  print >> sys.stderr, "{n} failed, run again to resume: {dirs}".format(
+    n=len(failed), dirs=' '.join(failed))
+for option, cache_class in (('--cache', FBParser.cache.ResourceCache),
+                            ('--garble-cache', FBParser.cache.GarbleCache),
+                            ('--selector-cache', FBParser.cache.SelectorCache)):
+  if option in options:
+    cache = cache_class(options[options.index(option) + 1])
+    for key, val in sorted(cache.report().items()):
+      print "{cache} {key}: {val}".format(cache=option[2:], key=key, val=val)
+for option in ('--record', '--replay'):
+  if option in options:
+    archive = FBParser.archive.ResourceArchive(
+      options[options.index(option) + 1])
+    print "archive: {entries} resources, {size} bytes".format(
+      **archive.report())
+    archive.close()
+if '--profile' in options:
+  profiles = [os.path.join(path, dir, 'profile.json') for dir in dirs
+              if os.path.isfile(os.path.join(path, dir, 'profile.json'))]
+  if profiles:
+    summary = FBParser.timing.rollup(profiles)
+    FBParser.timing.print_rollup(summary)
+    f = open(os.path.join(path, 'profile_rollup.json'), 'w')
+    json.dump(summary, f, indent=1)
+    f.close()
@@ -0,0 +1,1299 @@
+#!/usr/bin/env python
+__doc__ = '''
+    Micro benchmarks of FBParser on generated pages.
+    Each benchmark times the current implementation against the one it
+    replaced (kept here as a reference) and checks that both give the same
+    output.
+    The scale suite instead times FBParser on synthetic pages of growing
+    size and reports how each operation grows with the page.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+import FBParser
+import FBParser.css
+import FBParser.img
+import FBParser.js
+import FBParser.dom
+import FBParser.synth
+import FBParser.bigpipe
+import FBParser.scan
+import FBParser.serve
+import FBParser.fetch
+import FBParser.archive
+import FBParser.match
+from FBParser.Constants import MODE_MONO, MODE_BABBLE, TOKEN_TEXT
+from FBParser.Constants import TOKEN_OPEN, TOKEN_EMPTY
+from FBParser.Constants import PIPE_FIELDS, PIPE_KEYS
+from FBParser.regexp import re_html_css, re_json_css, re_json_js, re_html_img
+from FBParser.regexp import re_html_js, re_css_img, re_html_bigpipe
+from FBParser.regexp import re_href_http
+from FBParser.Constants import REF_HREF
+# external imports
+import re
+import os
+import codecs
+import math
+import sys
+import time
+import struct
+import random
+import subprocess
+import threading
+import multiprocessing
+import httplib
+import gzip
+from cStringIO import StringIO
+import shutil
+import tempfile
+try:
+  from argparse import ArgumentParser
+  from argparse import RawDescriptionHelpFormatter
+except ImportError:
+  print '''This script uses the argparse module.
+           It is included by default for Python 2.7+.
+           You can download argparse.py online.
+        '''
+  sys.exit(1)
+
+
+# @return (dict)  Arguments in a dictionary
+def get_args():
+  '''
+  Parse command line options and return them in a dict.
+  '''
+  parser = ArgumentParser(
+    formatter_class=RawDescriptionHelpFormatter,
+    description=__doc__)
+  subparsers = parser.add_subparsers(dest='action')
+  parser_localize = subparsers.add_parser(
+    'localize',
+    help='''
+      Rewriting of resource urls by the css/js/img localizers.
+      ''')
+  parser_localize.add_argument(
+    '-n', '--refs',
+    help='number of references of each kind on the page',
+    type=int,
+    default=2000)
+  parser_anonym = subparsers.add_parser(
+    'anonym',
+    help='''
+      Anonymization of attribute values and text nodes by anonym_dom.
+      ''')
+  parser_anonym.add_argument(
+    '-n', '--paragraphs',
+    help='number of paragraphs on the page',
+    type=int,
+    default=2000)
+  parser_garble = subparsers.add_parser(
+    'garble',
+    help='''
+      Encryption of the pixels of a JPEG photo by garble_image.
+      ''')
+  parser_garble.add_argument(
+    '-s', '--size',
+    help='width and height of the photo',
+    type=int,
+    nargs=2,
+    default=[1024, 1024])
+  parser_garble.add_argument(
+    '-n', '--sprites',
+    help='number of small PNG and GIF images, each',
+    type=int,
+    default=500)
+  parser_scale = subparsers.add_parser(
+    'scale',
+    help='''
+      Empirical complexity of prettify, anonym_dom, unload_pagelets and the
+      localizers, on synthetic pages of growing size (see FBParser.synth).
+      ''')
+  parser_scale.add_argument(
+    '-k', '--knob',
+    help='''
+      What grows with the scale factor: the number of pagelets, their nesting
+      depth, the words of text in each, the number of resources, or pagelets
+      and resources together (all, the default).
+      ''',
+    choices=SCALE_KNOBS + ('all',),
+    default='all')
+  parser_scale.add_argument(
+    '-f', '--factors',
+    help='scale factors applied to the knob',
+    type=int,
+    nargs='+',
+    default=[1, 2, 4, 8])
+  for knob, default in zip(SCALE_KNOBS, (20, 1, 200, 20)):
+    parser_scale.add_argument(
+      '--' + knob,
+      help='{knob} of the smallest page, default to {n}'.format(
+        knob=knob, n=default),
+      type=int,
+      default=default)
+  parser_pipes = subparsers.add_parser(
+    'pipes',
+    help='''
+      Parsing of big pipes and unload_pagelets, on pagelets of several MB.
+      ''')
+  parser_pipes.add_argument(
+    '-n', '--pagelets',
+    help='number of pagelets on the page',
+    type=int,
+    default=4)
+  parser_pipes.add_argument(
+    '-w', '--words',
+    help='words of text in each pagelet',
+    type=int,
+    default=200000)
+  parser_io = subparsers.add_parser(
+    'io',
+    help='''
+      Reading of a page by get_content and writing by save_content.
+      ''')
+  parser_io.add_argument(
+    '-s', '--size',
+    help='size of the page, in MB',
+    type=int,
+    default=64)
+  parser_serve = subparsers.add_parser(
+    'serve',
+    help='''
+      Serving of a converted sample by FBParser.serve, against the ad-hoc
+      SimpleHTTPServer.
+      ''')
+  parser_serve.add_argument(
+    '-n', '--resources',
+    help='number of css files, of js files and of images',
+    type=int,
+    default=50)
+  parser_serve.add_argument(
+    '-c', '--clients',
+    help='number of concurrent clients, each loading the whole sample',
+    type=int,
+    default=6)
+  parser_archive = subparsers.add_parser(
+    'archive',
+    help='''
+      Retrieval of resources from a local server with latency, against
+      their replay from a resource archive.
+      ''')
+  parser_archive.add_argument(
+    '-n', '--resources',
+    help='number of resources',
+    type=int,
+    default=200)
+  parser_archive.add_argument(
+    '-l', '--latency',
+    help='seconds of latency of each request',
+    type=float,
+    default=0.05)
+  parser_match = subparsers.add_parser(
+    'match',
+    help='''
+      Matching of css rules against the elements of a page by
+      FBParser.match, against testing every selector on every element.
+      ''')
+  parser_match.add_argument(
+    '-r', '--rules',
+    help='number of css rules',
+    type=int,
+    default=2000)
+  parser_match.add_argument(
+    '-e', '--elements',
+    help='number of elements',
+    type=int,
+    default=20000)
+  parser_json = subparsers.add_parser(
+    'json',
+    help='''
+      Escaping of pagelets by FBParser.jsonify and unescaping by
+      FBParser.dejsonify, whole and streamed, with round trip checks.
+      ''')
+  parser_json.add_argument(
+    '-w', '--words',
+    help='number of words of each story of the page',
+    type=int,
+    default=2000)
+  parser_json.add_argument(
+    '-r', '--round-trips',
+    help='number of random strings checked for round trips',
+    type=int,
+    default=20000)
+  return parser.parse_args()
+
+
+# @param func(function)  function to be timed
+# @param args  arguments to the function
+# @return (tuple)  (seconds, return value) of the fastest of 3 runs
+def timeit(func, *args):
+  best = None
+  for run in range(3):
+    start = time.time()
+    ret = func(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, ret
+
+
+# @param name(str)  what is compared
+# @param old(float)  seconds taken by the reference implementation
+# @param new(float)  seconds taken by the current implementation
+# @param same(Boolean)  whether the outputs agree
+def report(name, old, new, same):
+  print "{name:<16} before {old:8.3f}s  after {new:8.3f}s  x{x:<8.1f} {ok}"\
+    .format(name=name, old=old, new=new, x=old / max(new, 1e-6),
+            ok='same output' if same else 'OUTPUT DIFFERS')
+
+
+#
+# localize
+#
+
+
+# @param n(int)  number of references of each kind
+# @return (str)  a page with css, js and img references, html and json alike
+def localize_page(n):
+  filler = '<div class="clearfix"><span>{text}</span></div>\n' \
+           .format(text='lorem ipsum ' * 20)
+  pieces = ['<html><head>']
+  for i in range(n):
+    pieces.append('<link type="text/css" rel="stylesheet" '
+                  'href="http://static.ak.fbcdn.net/rsrc.php/c{i}.css" />\n'
+                  .format(i=i))
+  pieces.append('</head><body>')
+  for i in range(n):
+    pieces.append(filler)
+    pieces.append('<img class="img" src="http://photos.ak.fbcdn.net/p{i}.jpg"'
+                  ' />\n'.format(i=i))
+    pieces.append('<script>big_pipe.onPageletArrive({{"css":[],"src":'
+                  '"http:\\/\\/static.ak.fbcdn.net\\/rsrc.php\\/j{i}.js",'
+                  '"src":"http:\\/\\/static.ak.fbcdn.net\\/rsrc.php\\/s{i}.css"'
+                  '}});</script>\n'.format(i=i))
+  pieces.append('</body></html>')
+  return ''.join(pieces)
+
+
+# @param s(str)  source
+# @param dir(str)  directory of the local resources
+# @param regexps(list)  patterns with a 'url' group
+def touch_resources(s, dir, regexps):
+  '''
+  Create an empty file for every resource referenced, so that the localizers
+  find them all there and nothing gets downloaded.
+  '''
+  for regexp in regexps:
+    for m in regexp.finditer(s):
+      if m.group('url'):
+        open(os.path.join(dir, FBParser.url_to_file(m.group('url'))),
+             'w').close()
+
+
+# @param s(str)  source
+# @param regexp(RegexObject)  pattern with a 'url' group
+# @param prefix(str)  prefix of the local files
+# @return (str)  source rewritten the way the localizers used to
+def replace_each(s, regexp, prefix):
+  for m in regexp.finditer(s):
+    url = m.group('url')
+    s = s.replace(url, prefix + FBParser.url_to_file(url), 1)
+  return s
+
+
+def bench_localize(args):
+  dom = localize_page(args.refs)
+  print "page of {size} bytes, {n} references of each kind".format(
+    size=len(dom), n=args.refs)
+  # every resource is already there, so nothing gets downloaded
+  dir = tempfile.mkdtemp()
+  touch_resources(dom, dir, (re_html_img, re_html_css, re_json_css, re_json_js))
+  cases = [
+    ('css_in_html', FBParser.css.css_in_html, re_html_css, 'css/'),
+    ('css_in_json', FBParser.css.css_in_json, re_json_css, 'css\\/'),
+    ('js_in_json', FBParser.js.js_in_json, re_json_js, 'js\\/'),
+    ('img_in_html', FBParser.img.img_in_html, re_html_img, 'img/'),
+  ]
+  for name, localizer, regexp, prefix in cases:
+    old, old_dom = timeit(replace_each, dom, regexp, prefix)
+    new, ret = timeit(lambda s: localizer(s, dir=dir, prefix=prefix), dom)
+    report(name, old, new, old_dom == ret['source'])
+  # the localizers chained, against one scan and one splice for them all
+  localizers = [(localizer, prefix) for name, localizer, regexp, prefix
+                in cases]
+  scanned = [
+    (FBParser.css.css_edits_in_html, 'css/'),
+    (FBParser.css.css_edits_in_json, 'css\\/'),
+    (FBParser.js.js_edits_in_json, 'js\\/'),
+    (FBParser.img.img_edits_in_html, 'img/'),
+  ]
+
+  def chain(dom):
+    for localizer, prefix in localizers:
+      dom = localizer(dom, dir=dir, prefix=prefix)['source']
+    return re_href_http.sub('href="about:blank"', dom)
+
+  def scan(dom):
+    refs = FBParser.scan.scan_resources(dom)
+    edits = FBParser.EditBuffer(dom)
+    for localizer, prefix in scanned:
+      edits.extend(localizer(refs, dir=dir, prefix=prefix)['edits'])
+    for m_href in refs[REF_HREF]:
+      if not edits.overlaps(m_href.start(), m_href.end()):
+        edits.replace(m_href.start(), m_href.end(), 'href="about:blank"')
+    return edits.apply()
+  old, old_dom = timeit(chain, dom)
+  new, new_dom = timeit(scan, dom)
+  report('chain', old, new, old_dom == new_dom)
+  shutil.rmtree(dir)
+  # every kind of reference in one scan, against a pass per pattern
+  for page, dom in (('localize', dom),
+                    ('synth', FBParser.synth.synth_page(
+                      pagelets=args.refs / 10, resources=args.refs)['html'])):
+    old, old_refs = timeit(
+      lambda: dict((kind, [m.span() for m in regexp.finditer(dom)])
+                   for regexps in FBParser.scan.PATTERNS.values()
+                   for kind, regexp in regexps))
+    new, new_refs = timeit(
+      lambda: dict((kind, [m.span() for m in matches])
+                   for kind, matches in
+                   FBParser.scan.scan_resources(dom).items()))
+    report('scan ' + page, old, new, old_refs == new_refs)
+
+
+#
+# anonym
+#
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua '
+         u'caf\xe9 na\xefve \u2014 \u4e2d\u6587').split()
+CLASSES = ('clearfix', 'uiStreamMessage', 'actorName', 'fsm', 'fwn', 'fcg')
+
+
+# @param n(int)  number of paragraphs
+# @return (tuple)  a text-heavy page, and the selectors to keep on it
+def anonym_page(n):
+  rand = random.Random(n)
+  pieces = [u'<html><head><title>News Feed</title></head><body>\n']
+  for i in range(n):
+    words = [rand.choice(WORDS) for w in range(rand.randint(5, 60))]
+    pieces.append(
+      u'<div id="story_{i}" class="{cls} uiStory-{i}" data-ft="{ft}">'
+      u'<a title="{name}" href="/p{i}">{name}</a>'
+      u'<span class="{cls}">{text}</span></div>\n'.format(
+        i=i, cls=' '.join(rand.sample(CLASSES, 3)),
+        ft='{"qid":%d,"mf_story_key":%d}' % (i, i * 7919),
+        name=' '.join(words[:2]), text=' '.join(words)))
+  pieces.append(u'</body></html>')
+  return ''.join(pieces), {'id': [], 'class': list(CLASSES[:4])}
+
+
+# @param s(str)  the original string
+# @param mode(int)  how to replace the original characters
+# @return (str)  anonymized string, the way anonym_str used to
+def old_anonym_str(s, mode):
+  if mode == MODE_MONO:
+    return re.sub("[^\s]", "?", s)
+  if mode == MODE_BABBLE:
+    return re.sub("[^\s]{1}", chr(random.randint(97, 122)), s)
+
+
+# @param v(str)  the original value string
+# @param selectors(list)  a list of css selectors
+# @param mode(str)  How to replace a string with meaningless chars
+# @return (str)  anonymized value, the way anonym_val used to
+def old_anonym_val(v, selectors, mode):
+  new_v = ''
+  for item in v.split():
+    new_v += ' '
+    if item in selectors:
+      new_v += item
+    elif '-' in item:
+      [key, suffix] = item.split('-', 1)
+      if key in selectors:
+        new_v += key + '-' + old_anonym_str(suffix, mode)
+      else:
+        new_v += old_anonym_str(key, mode) + '-' + old_anonym_str(suffix, mode)
+    else:
+      new_v += old_anonym_str(item, mode)
+  return new_v[1:]
+
+
+# @param t(str)  a tag, looking like <name attr="val">, to be anonymized
+# @param selectors(dict)  a dictionary of css selectors (id & class)
+# @param mode(str)  How to replace a string with meaningless chars
+# @return (str)  anonymized tag, the way anonym_tag used to
+def old_anonym_tag(t, selectors, mode):
+  from FBParser.Constants import EXEMPTED_TAGS, HTML_ELEMENTS
+  from FBParser.regexp import re_tag_label, re_attr_sq, re_attr_dq
+  if re_tag_label.match(t).group('label') in EXEMPTED_TAGS:
+    return t
+  new_t = t
+  m_attrs = list(re_attr_sq.finditer(t)) + list(re_attr_dq.finditer(t))
+  for m_attr in m_attrs:
+    name = m_attr.group('name')
+    value = m_attr.group('value')
+    if name in selectors.keys():
+      anon_value = FBParser.dom.anonym_val(value, selectors[name], mode)
+    elif name not in HTML_ELEMENTS:
+      anon_value = FBParser.dom.anonym_str(value, mode)
+    else:
+      continue
+    new_t = new_t.replace(
+      m_attr.group(0),
+      ' {name}="{value}"'.format(name=name, value=anon_value),
+      1)
+  return new_t
+
+
+# @param dom(str)  page to be anonymized
+# @param selectors(dict)  contains id & class list
+# @param mode(int)  how to replace the original characters
+# @return (str)  the page anonymized with the old anonym_str/anonym_val
+def old_anonym_dom(dom, selectors, mode):
+  new_str, new_val = FBParser.dom.anonym_str, FBParser.dom.anonym_val
+  FBParser.dom.anonym_str, FBParser.dom.anonym_val = \
+    old_anonym_str, old_anonym_val
+  try:
+    return FBParser.dom.anonym_dom(dom, selectors, mode)
+  finally:
+    FBParser.dom.anonym_str, FBParser.dom.anonym_val = new_str, new_val
+
+
+def bench_anonym(args):
+  dom, selectors = anonym_page(args.paragraphs)
+  print "page of {size} chars, {n} paragraphs".format(
+    size=len(dom), n=args.paragraphs)
+  old, old_dom = timeit(old_anonym_dom, dom, selectors, MODE_MONO)
+  new, new_dom = timeit(FBParser.dom.anonym_dom, dom, selectors, MODE_MONO)
+  report('anonym mono', old, new, old_dom == new_dom)
+  # letters differ by design, the shape of the page must not
+  old, old_dom = timeit(old_anonym_dom, dom, selectors, MODE_BABBLE)
+  new, new_dom = timeit(FBParser.dom.anonym_dom, dom, selectors, MODE_BABBLE)
+  report('anonym babble', old, new,
+         FBParser.dom.anonym_str(old_dom) == FBParser.dom.anonym_str(new_dom))
+  # tags alone, one plan for the page against anonym_tag on each tag
+  tags = [(text, label)
+          for kind, text, label in FBParser.dom.stream_tokens([dom])
+          if kind in (TOKEN_OPEN, TOKEN_EMPTY)]
+  old, old_tags = timeit(
+    lambda: [old_anonym_tag(tag, selectors, MODE_MONO) for tag, label in tags])
+  new, new_tags = timeit(
+    lambda plan: [plan.tag(tag, label) for tag, label in tags],
+    FBParser.dom.AnonymPlan(selectors, MODE_MONO))
+  report('tags mono', old, new, old_tags == new_tags)
+  new, new_tags = timeit(
+    lambda: [FBParser.dom.anonym_tag(tag, selectors, MODE_MONO)
+             for tag, label in tags])
+  report('anonym_tag mono', old, new, old_tags == new_tags)
+  # anonym_str alone, on every text node of the page
+  texts = [text for kind, text, label in FBParser.dom.stream_tokens([dom])
+           if kind == TOKEN_TEXT]
+  for name, mode in (('str mono', MODE_MONO), ('str babble', MODE_BABBLE)):
+    old, old_texts = timeit(
+      lambda: [old_anonym_str(text, mode) for text in texts])
+    new, new_texts = timeit(
+      lambda: [FBParser.dom.anonym_str(text, mode) for text in texts])
+    report(name, old, new,
+           map(FBParser.dom.anonym_str, old_texts) ==
+           map(FBParser.dom.anonym_str, new_texts))
+
+
+#
+# garble
+#
+
+
+# @param data(Image data)  a list like object containing pixel information
+# @return (list)  encrypted pixels, the way garble_image._encrypt used to
+def old_encrypt(data):
+  from Crypto.Cipher import Blowfish
+  from Crypto.Util.randpool import RandomPool
+  cleartext = ''
+  pixel_size = len(data[0])
+  for pixel in data:
+    for val in pixel:
+      cleartext += chr(val)
+  blowfish = Blowfish.new(RandomPool().get_bytes(8), 2, '\x00' * 8)
+  padding = '\x00' * (8 - (len(cleartext) - 1) % 8 - 1)
+  ciphered = blowfish.encrypt(cleartext + padding)[len(padding):]
+  ret = []
+  for i in range(len(data)):
+    ret.append(struct.unpack(
+      'B' * pixel_size, ciphered[pixel_size * i: pixel_size * (1 + i)]))
+  return ret
+
+
+# @param img(Image)  a photo
+# @return (Image)  the photo garbled the way garble used to
+def old_garble(img):
+  img = img.copy()
+  img.putdata(old_encrypt(img.getdata()), 1, 0)
+  return img
+
+
+# @param image(str)  a PNG or GIF image file
+def old_garble_sprite(image):
+  from FBParser.garble_image import Image
+  img = Image.open(image)
+  img.load()
+  if img.format == 'PNG':
+    Image.new("RGB", img.size, "orange").save(image, 'PNG')
+  else:
+    pixels = []
+    for pixel in range(img.size[0] * img.size[1]):
+      pixels.append(random.uniform(0, 255))
+    img.putdata(pixels, 1, 0)
+    img.save(image, 'GIF')
+
+
+# @param n(int)  number of images of each format
+# @return (str)  a directory of small PNG & GIF images
+def sprites(n):
+  from FBParser.garble_image import Image
+  dir = tempfile.mkdtemp()
+  for i in range(n):
+    size = (16 + i % 5 * 8, 16 + i % 3 * 50)
+    Image.new('RGBA', size, 'red').save(
+      os.path.join(dir, 's{i}.png'.format(i=i)), 'PNG')
+    Image.new('P', size).save(
+      os.path.join(dir, 's{i}.gif'.format(i=i)), 'GIF')
+  return dir
+
+
+# @param dir(str)  directory of images
+# @return (list)  (file, format, size) of each image
+def describe(dir):
+  from FBParser.garble_image import Image
+  return [(file, Image.open(os.path.join(dir, file)).format,
+           Image.open(os.path.join(dir, file)).size)
+          for file in sorted(os.listdir(dir))]
+
+
+def bench_garble(args):
+  import warnings
+  from FBParser.garble_image import Image, _encrypt, _garble_one
+  warnings.simplefilter('ignore')  # RandomPool is deprecated
+  width, height = args.size
+  img = Image.new('RGB', (width, height))
+  img.putdata([(x % 256, y % 256, (x * y) % 256)
+               for y in range(height) for x in range(width)])
+  print "{w}x{h} RGB photo".format(w=width, h=height)
+  old, old_img = timeit(old_garble, img)
+  new, new_img = timeit(_encrypt, img)
+  report('encrypt', old, new,
+         (old_img.mode, old_img.size) == (new_img.mode, new_img.size) and
+         new_img.tobytes() != img.tobytes())
+  print "{n} PNG and {n} GIF sprites".format(n=args.sprites)
+  timings = []
+  same = True  # formats and sizes are kept
+  for garble_sprite in (old_garble_sprite, _garble_one):
+    dir = sprites(args.sprites)
+    before = describe(dir)
+    start = time.time()
+    for file in os.listdir(dir):
+      garble_sprite(os.path.join(dir, file))
+    timings.append(time.time() - start)
+    same = same and describe(dir) == before
+    shutil.rmtree(dir)
+  report('sprites', timings[0], timings[1], same)
+
+
+#
+# scale
+#
+
+SCALE_KNOBS = ('pagelets', 'depth', 'words', 'resources')
+PIPE_EXCLUDES = ['onload', 'onafterload']
+
+
+# @param sizes(list)  sizes of the input
+# @param times(list)  seconds taken on each
+# @return (float)  least squares slope of log(time) over log(size), i.e. k
+#                  where time grows as size^k
+def exponent(sizes, times):
+  xs = [math.log(size) for size in sizes]
+  ys = [math.log(max(t, 1e-6)) for t in times]
+  mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+  var = sum((x - mean_x) ** 2 for x in xs)
+  if not var:
+    return 0.0
+  return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var
+
+
+# @param page(dict)  as returned by synth_page
+# @param dir(str)  directory of the local resources, all there
+# @return (list)  (name, function) of the operations to be timed on the page
+def scale_cases(page, dir):
+  dom = page['html']
+  css = ''.join(page['css'].values())
+  selectors = {'id': set(), 'class': set()}
+  for content in page['css'].values():
+    for key, value in FBParser.css.selector_index(content).items():
+      selectors[key].update(value)
+  return [
+    ('prettify', lambda: FBParser.dom.prettify(dom)),
+    ('anonym_dom', lambda: FBParser.dom.anonym_dom(dom, selectors, MODE_MONO)),
+    ('unload_pagelets',
+     lambda: FBParser.dom.unload_pagelets(dom, PIPE_EXCLUDES)),
+    ('css_in_html',
+     lambda: FBParser.css.css_in_html(dom, dir=dir, prefix='css/')),
+    ('css_in_json',
+     lambda: FBParser.css.css_in_json(dom, dir=dir, prefix='css\\/')),
+    ('js_in_html', lambda: FBParser.js.js_in_html(dom, dir=dir, prefix='js/')),
+    ('js_in_json',
+     lambda: FBParser.js.js_in_json(dom, dir=dir, prefix='js\\/')),
+    ('img_in_html',
+     lambda: FBParser.img.img_in_html(dom, dir=dir, prefix='img/')),
+    ('img_in_css', lambda: FBParser.img.img_in_css(css, dir=dir)),
+  ]
+
+
+def bench_scale(args):
+  knobs = dict((knob, getattr(args, knob)) for knob in SCALE_KNOBS)
+  grown = ('pagelets', 'resources') if args.knob == 'all' else (args.knob,)
+  sizes = []
+  timings = {}  # operation -> seconds, by factor
+  names = []
+  for factor in args.factors:
+    page = FBParser.synth.synth_page(**dict(
+      knobs, **dict((knob, knobs[knob] * factor) for knob in grown)))
+    dir = tempfile.mkdtemp()
+    touch_resources(page['html'], dir,
+                    (re_html_css, re_json_css, re_html_js, re_json_js,
+                     re_html_img))
+    touch_resources(''.join(page['css'].values()), dir, (re_css_img,))
+    sizes.append(len(page['html']))
+    print "x{f:<3} page of {size} chars, {n} pagelets".format(
+      f=factor, size=sizes[-1], n=len(page['pagelets']))
+    for name, func in scale_cases(page, dir):
+      if name not in timings:
+        names.append(name)
+        timings[name] = []
+      timings[name].append(timeit(func)[0])
+    shutil.rmtree(dir)
+  line = '{name:<16}'.format(name='{knob} x'.format(knob=args.knob))
+  for factor in args.factors:
+    line += ' {f:>8}'.format(f=factor)
+  print line + '  exponent'
+  for name in names:
+    line = '{name:<16}'.format(name=name)
+    for elapsed in timings[name]:
+      line += ' {t:7.3f}s'.format(t=elapsed)
+    k = exponent(sizes, timings[name])
+    print line + '  {k:8.2f} {warn}'.format(
+      k=k, warn='superlinear' if k > 1.25 else '')
+
+
+
+#
+# pipes
+#
+
+PIPE_KEYS_BY_FIELD = dict((field, key) for key, field in PIPE_KEYS.items())
+
+
+# @param dom(str)  source
+# @param pipe_exclude(list)  fields to be dropped from the pipes
+# @return (dict)  the way unload_pagelets used to, matching every pipe with
+#                 re_html_bigpipe and replacing each in the whole source
+def old_unload_pagelets(dom, pipe_exclude=[]):
+  m_pipes = []
+  for m_script in re_html_js.finditer(dom):
+    if re_html_bigpipe.match(m_script.group(0)):
+      m_pipes.append(re_html_bigpipe.match(m_script.group(0)))
+  index = FBParser.dom.ElementIndex(dom)
+  pagelets = []
+  elements = []
+  taken = set()
+  ids = []
+  for m_pipe in m_pipes:
+    id = m_pipe.group('id')[6:-2]
+    ids.append(id)
+    pagelets.append(m_pipe.groupdict())
+    pagelets[-1]['orig'] = m_pipe.group(0)
+    element = index.find(id)
+    if element < 0 or element in taken or not index.content(element):
+      element = -1
+    else:
+      taken.add(element)
+    elements.append(element)
+  embedded = {-1: []}
+  for element in sorted(taken):
+    outer = -1
+    for ancestor in index.ancestors(element):
+      if ancestor in taken:
+        outer = ancestor
+        break
+    embedded.setdefault(outer, []).append(element)
+    embedded.setdefault(element, [])
+  nodes = {}
+  for idx, element in enumerate(elements):
+    if element < 0:
+      nodes[idx] = ''
+    else:
+      start, end = index.content(element)
+      nodes[idx] = FBParser.splice(
+        dom,
+        [index.content(inner) + ('',) for inner in embedded[element]],
+        start, end)
+  dom = FBParser.splice(
+    dom, [index.content(outer) + ('',) for outer in embedded[-1]])
+  for idx in range(len(pagelets)):
+    if nodes[idx]:
+      pagelets[idx]['content'] = '"content":{' + pagelets[idx]['id'][5:-1] +\
+      ':"' + FBParser.jsonify(nodes[idx]) + '"},'
+    else:
+      pagelets[idx]['content'] = '"content":[],'
+    pipe = '<script>big_pipe.onPageletArrive({'
+    for field in PIPE_FIELDS:
+      if pagelets[idx][field] and field not in pipe_exclude:
+        pipe += pagelets[idx][field]
+    pipe += '});</script>'
+    dom = dom.replace(pagelets[idx]['orig'], pipe, 1)
+  return {'html': dom, 'pagelets': ids}
+
+
+# @param scripts(list)  big pipe scripts
+# @return (list)  field -> text of each pipe, as matched by re_html_bigpipe
+def old_pipe_fields(scripts):
+  pipes = []
+  for script in scripts:
+    groups = re_html_bigpipe.match(script).groupdict()
+    pipes.append(dict((PIPE_KEYS_BY_FIELD[field], text.rstrip(','))
+                      for field, text in groups.items()
+                      if field in PIPE_KEYS_BY_FIELD and text))
+  return pipes
+
+
+# @param scripts(list)  big pipe scripts
+# @return (list)  JSON key -> text of each pipe, as parsed by parse_pipe
+def new_pipe_fields(scripts):
+  pipes = []
+  for script in scripts:
+    fields = FBParser.bigpipe.parse_pipe(script)
+    pipes.append(dict((key, script[start:end])
+                      for key, (start, value, end) in fields.items()))
+  return pipes
+
+
+def bench_pipes(args):
+  page = FBParser.synth.synth_page(pagelets=args.pagelets, words=args.words)
+  dom = page['html']
+  print "page of {size} chars, {n} pagelets".format(
+    size=len(dom), n=len(page['pagelets']))
+  # the pipes of the page, holding their pagelets as once unloaded
+  unloaded = FBParser.dom.unload_pagelets(dom)['html']
+  contents = {}
+  for m in re_html_js.finditer(unloaded):
+    fields = FBParser.bigpipe.parse_pipe(m.group(0))
+    if fields is not None and 'content' in fields:
+      start, value, end = fields['content']
+      contents[FBParser.bigpipe.pipe_id(m.group(0), fields)] = \
+        m.group(0)[start:end]
+  scripts = []
+  for m in re_html_js.finditer(dom):
+    fields = FBParser.bigpipe.parse_pipe(m.group(0))
+    if re_html_bigpipe.match(m.group(0)) and fields is not None:
+      content = contents[FBParser.bigpipe.pipe_id(m.group(0), fields)]
+      scripts.append(FBParser.bigpipe.build_pipe(
+        m.group(0), fields, lambda field: True, {'content': content}))
+  print "{n} pipes of {size} chars".format(
+    n=len(scripts), size=sum(len(script) for script in scripts))
+  old, old_fields = timeit(old_pipe_fields, scripts)
+  new, new_fields = timeit(new_pipe_fields, scripts)
+  report('parse pipes', old, new, old_fields == new_fields)
+  for pipe_exclude in ([], PIPE_EXCLUDES):
+    old, old_ret = timeit(old_unload_pagelets, dom, pipe_exclude)
+    new, new_ret = timeit(FBParser.dom.unload_pagelets, dom, pipe_exclude)
+    report('unload -{n}'.format(n=len(pipe_exclude)), old, new,
+           old_ret == new_ret)
+  # a field the pipes did not use to have is kept apart by parse_pipe; the
+  # regular expression still matches, folding it into a neighbouring group
+  script = scripts[0].replace('"css":', '"jsmods":{"require":[]},"css":', 1)
+  old_keys = sorted(old_pipe_fields([script])[0])
+  new_keys = sorted(new_pipe_fields([script])[0])
+  print "unknown field: {old} by re_html_bigpipe, {new} by parse_pipe".format(
+    old='kept apart' if 'jsmods' in old_keys else 'merged',
+    new='kept apart' if 'jsmods' in new_keys else 'merged')
+
+
+
+#
+# io
+#
+
+
+# @param filename(str)  file to be read
+# @param encoding(str)  encoding used by the file
+# @return (unicode)  the content, the way get_content used to read it
+def old_get_content(filename, encoding='utf-8'):
+  f = codecs.open(filename, 'r', encoding)
+  s = ''.join(f.readlines())
+  f.close()
+  return s
+
+
+# @param s(unicode)  content
+# @param filename(str)  file to be written
+# @param encoding(str)  encoding used for the file
+def old_save_content(s, filename, encoding='utf-8'):
+  if os.path.isfile(filename):
+    os.remove(filename)
+  f = codecs.open(filename, 'w', encoding)
+  f.write(s)
+  f.close()
+
+
+# @param chunks(iterable)  content, in chunks
+# @param filename(str)  file to be written
+# @param encoding(str)  encoding used for the file
+def old_save_chunks(chunks, filename, encoding='utf-8'):
+  if os.path.isfile(filename):
+    os.remove(filename)
+  f = codecs.open(filename, 'w', encoding)
+  for chunk in chunks:
+    f.write(chunk)
+  f.close()
+
+
+# @param func(str)  name of the function to be measured, e.g.
+#                   'FBParser.get_content'
+# @param args  arguments to the function, given by their repr
+# @return (int)  peak resident memory in MB of a fresh interpreter that calls
+#                it, over that of one that does not
+def peak_memory(func, *args):
+  # VmHWM, as ru_maxrss carries the peak of the parent over through exec
+  code = ('import sys; sys.path.insert(0, {dir!r}); '
+          'import FBParser, benchmark_parser; {call}; '
+          'print [line.split()[1] for line in open("/proc/self/status") '
+          'if line.startswith("VmHWM:")][0]')
+  peaks = []
+  for call in ('None', '{func}(*{args!r})'.format(func=func, args=args)):
+    peaks.append(int(subprocess.check_output([
+      sys.executable, '-c',
+      code.format(dir=os.path.dirname(os.path.abspath(__file__)),
+                  call=call)])))
+  return (peaks[1] - peaks[0]) >> 10
+
+
+def bench_io(args):
+  dir = tempfile.mkdtemp()
+  filename = os.path.join(dir, 'dom.html')
+  page = FBParser.synth.synth_page(pagelets=8, words=2000)['html']
+  dom = page * max(1, (args.size << 20) / len(page.encode('utf-8')))
+  old_save_content(dom, filename)
+  print "page of {size} MB".format(size=os.path.getsize(filename) >> 20)
+  old, old_dom = timeit(old_get_content, filename)
+  new, new_dom = timeit(FBParser.get_content, filename)
+  report('get_content', old, new, old_dom == new_dom)
+  print "{name:<16} before {old:6d} MB  after {new:6d} MB".format(
+    name='  peak memory',
+    old=peak_memory('benchmark_parser.old_get_content', filename),
+    new=peak_memory('FBParser.get_content', filename))
+  del old_dom, new_dom
+  old, ret = timeit(old_save_content, dom, filename)
+  old_file = open(filename, 'rb').read()
+  new, ret = timeit(FBParser.save_content, dom, filename)
+  report('save_content', old, new, open(filename, 'rb').read() == old_file)
+  new, ret = timeit(lambda: FBParser.save_content(dom, filename, atomic=True))
+  report('  atomic', old, new, open(filename, 'rb').read() == old_file)
+  # streamed, a line at a time
+  lines = dom.splitlines(True)
+  old, ret = timeit(old_save_chunks, lines, filename)
+  new, ret = timeit(FBParser.save_chunks, lines, filename)
+  report('save_chunks', old, new, open(filename, 'rb').read() == old_file)
+  shutil.rmtree(dir)
+
+
+
+#
+# serve
+#
+
+
+# @param dir(str)  directory to write the sample to
+# @param n(int)  number of css files, of js files and of images
+# @return (list)  paths of its files, relative to dir
+def serve_sample(dir, n):
+  FBParser.synth.write_page(dir, 'home_static.html', resources=n)
+  rand = random.Random(0)
+  for sub in ('js', 'img', 'misc'):
+    os.mkdir(os.path.join(dir, sub))
+  for i in range(n):
+    FBParser.save_content(
+      ''.join('var v{i}_{j}={j};'.format(i=i, j=j)
+              for j in range(rand.randint(100, 3000))),
+      os.path.join(dir, 'js', 'rsrc{i}.js'.format(i=i)))
+    f = open(os.path.join(dir, 'img', 'img{i}.jpg'.format(i=i)), 'wb')
+    f.write(os.urandom(rand.randint(1 << 10, 64 << 10)))
+    f.close()
+  f = open(os.path.join(dir, 'misc', 'video.swf'), 'wb')
+  f.write(os.urandom(4 << 20))
+  f.close()
+  return sorted(os.path.relpath(os.path.join(root, name), dir)
+                for root, dirs, files in os.walk(dir) for name in files
+                if not name.endswith('.gz'))
+
+
+# @param dir(str)  directory to be served
+# @param ports(multiprocessing.Queue)  where to put the port listened on
+def adhoc_server(dir, ports):
+  from BaseHTTPServer import HTTPServer
+  from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+  class Handler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+      pass
+  os.chdir(dir)
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  ports.put(server.server_address[1])
+  server.serve_forever()
+
+
+# @param dir(str)  directory to be served
+# @param ports(multiprocessing.Queue)  where to put the port listened on
+def static_server(dir, ports):
+  server = FBParser.serve.StaticServer(dir, port=0)
+  ports.put(server.address[1])
+  server.serve_forever()
+
+
+# @param server(function)  adhoc_server or static_server
+# @param dir(str)  directory to be served
+# @param paths(list)  files to be requested, relative to dir
+# @param clients(int)  number of clients, each requesting every file over
+#                      one (keep-alive) connection
+# @param headers={}(dict)  request headers
+# @return (tuple)  (seconds, CPU seconds of the server, whether every body
+#                  was the content of its file, bytes received by a client)
+def load(server, dir, paths, clients, headers={}):
+  ports = multiprocessing.Queue()
+  process = multiprocessing.Process(target=server, args=(dir, ports))
+  process.start()
+  port = ports.get()
+  contents = dict((path, open(os.path.join(dir, path), 'rb').read())
+                  for path in paths)
+  results = []
+
+  def client():
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    same, received = True, 0
+    for path in paths:
+      conn.request('GET', '/' + path, headers=headers)
+      response = conn.getresponse()
+      body = response.read()
+      received += len(body)
+      if response.getheader('content-encoding') == 'gzip':
+        body = gzip.GzipFile(fileobj=StringIO(body)).read()
+      same = same and response.status == 200 and body == contents[path]
+    conn.close()
+    results.append((same, received))
+
+  def run():
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  try:
+    elapsed, ret = timeit(run)
+    stat = open('/proc/{pid}/stat'.format(pid=process.pid)).read()
+    cpu = sum(int(ticks) for ticks in stat.rsplit(')', 1)[1].split()[11:13])
+  finally:
+    process.terminate()
+    process.join()
+  return (elapsed, cpu / float(os.sysconf('SC_CLK_TCK')) / 3,
+          all(same for same, received in results), results[-1][1])
+
+
+def bench_serve(args):
+  dir = tempfile.mkdtemp()
+  paths = serve_sample(dir, args.resources)
+  print "{n} files of {size} bytes, {c} clients".format(
+    n=len(paths), c=args.clients,
+    size=sum(os.path.getsize(os.path.join(dir, path)) for path in paths))
+  old, old_cpu, old_same, old_bytes = load(adhoc_server, dir, paths,
+                                           args.clients)
+  new, new_cpu, new_same, new_bytes = load(static_server, dir, paths,
+                                           args.clients)
+  report('serve', old, new, old_same and new_same)
+  report('  server cpu', old_cpu, new_cpu, old_same and new_same)
+  print "{n} file(s) precompressed".format(
+    n=FBParser.serve.precompress(dir))
+  new, new_cpu, new_same, new_bytes = load(static_server, dir, paths,
+                                           args.clients,
+                                           {'Accept-Encoding': 'gzip'})
+  report('  gzip', old, new, old_same and new_same)
+  report('  server cpu', old_cpu, new_cpu, old_same and new_same)
+  print "{name:<16} before {old:8d}B  after {new:8d}B".format(
+    name='  per client', old=old_bytes, new=new_bytes)
+  shutil.rmtree(dir)
+
+
+
+#
+# archive
+#
+
+
+# @param site(str)  url the resources are under
+# @param names(list)  names of the resources
+# @param dir(str)  where to save them
+# @return (Boolean)  whether they were all retrieved
+def fetch_all(site, names, dir):
+  os.mkdir(dir)
+  fetcher = FBParser.fetch.Fetcher()
+  for name in names:
+    fetcher.submit(site + name, dir, name)
+  failures = fetcher.wait()
+  fetcher.close()
+  return not failures
+
+
+def bench_archive(args):
+  dir = tempfile.mkdtemp()
+  fixtures = os.path.join(dir, 'fixtures')
+  os.mkdir(fixtures)
+  rand = random.Random(0)
+  names = []
+  for i in range(args.resources):
+    names.append('rsrc{i}.js'.format(i=i))
+    f = open(os.path.join(fixtures, names[-1]), 'wb')
+    f.write(os.urandom(rand.randint(1 << 10, 64 << 10)))
+    f.close()
+  print "{n} resources, {latency}s of latency each".format(
+    n=len(names), latency=args.latency)
+  server = FBParser.fetch._serve_fixtures(fixtures, args.latency)
+  site = 'http://127.0.0.1:{port}/'.format(port=server.server_address[1])
+  filename = os.path.join(dir, 'crawl.arc')
+  runs = iter(range(100))
+
+  def live():
+    return fetch_all(site, names, os.path.join(dir, str(next(runs))))
+  old, ok = timeit(live)
+  archive = FBParser.archive.use_archive(filename, 'record')
+  start = time.time()
+  ok = live()  # only the first run records
+  report('record', old, time.time() - start, ok)
+  archive.close()
+  archive = FBParser.archive.use_archive(filename, 'replay')
+  before = FBParser.fetch.fetch_stats()['fetches']
+  server.shutdown()  # so that nothing can come from the network
+  new, ok = timeit(live)
+  replayed = os.path.join(dir, str(next(runs) - 1))
+  ok = ok and FBParser.fetch.fetch_stats()['fetches'] == before and \
+    all(open(os.path.join(fixtures, name), 'rb').read() ==
+        open(os.path.join(replayed, name), 'rb').read() for name in names)
+  report('replay', old, new, ok)
+  archive.close()
+  shutil.rmtree(dir)
+
+
+#
+# match
+#
+
+MATCH_TAGS = ['div', 'ul', 'li', 'a', 'span', 'p', 'img', 'h3']
+MATCH_PSEUDOS = ['', '', '', ':first-child', ':last-child', ':hover',
+                 ':nth-child(2n+1)', ':not(.hidden_elem)', '::before']
+
+
+# @param n(int)  number of elements
+# @param rand(Random)  source of randomness
+# @return (str)  a page of nested elements, with ids and classes
+def match_page(n, rand):
+  classes = ['c{i}'.format(i=i) for i in range(n / 20)]
+  html = ['<html><body>']
+  depth = 0
+  for i in range(n):
+    tag = rand.choice(MATCH_TAGS)
+    attrs = ' class="{c}"'.format(c=' '.join(rand.sample(classes, 2)))
+    if not rand.randrange(10):
+      attrs += ' id="e{i}"'.format(i=i)
+    if tag == 'img' or depth > 12 or depth and not rand.randrange(3):
+      html.append('<{tag}{attrs}></{tag}>'.format(tag=tag, attrs=attrs))
+      if depth and rand.randrange(2):
+        html.append('</div>')
+        depth -= 1
+    else:
+      html.append('<div{attrs}>'.format(attrs=attrs))
+      depth += 1
+  html.append('</div>' * depth + '</body></html>')
+  return ''.join(html)
+
+
+# @param n(int)  number of rules
+# @param elements(int)  number of elements of the page
+# @param rand(Random)  source of randomness
+# @return (str)  a style sheet, half of whose selectors can't match
+def match_sheet(n, elements, rand):
+  def compound():
+    kind = rand.randrange(4)
+    name = rand.randrange(elements / 10)  # beyond the page, half the time
+    if kind == 0:
+      text = '#e{i}'.format(i=name * 10)
+    elif kind == 1:
+      text = rand.choice(MATCH_TAGS)
+    else:
+      text = '.c{i}'.format(i=name)
+    return text + rand.choice(MATCH_PSEUDOS)
+  rules = []
+  for i in range(n):
+    selectors = []
+    for j in range(rand.randint(1, 3)):
+      parts = [compound() for k in range(rand.randint(1, 3))]
+      selectors.append(rand.choice([' ', ' > ']).join(parts))
+    rules.append(', '.join(selectors) + ' { color: red }')
+  return '\n'.join(rules)
+
+
+# @param tree(ElementTree)  elements of a page
+# @param texts(list)  selectors
+# @return (set)  those matching at least one element
+def naive_match(tree, texts):
+  matched = set()
+  for text in set(texts):
+    selector = FBParser.match.parse_selector(text)
+    if selector is None or \
+       any(selector.matches(el) for el in tree.elements):
+      matched.add(text)
+  return matched
+
+
+def bench_match(args):
+  rand = random.Random(0)
+  page = match_page(args.elements, rand)
+  css = match_sheet(args.rules, args.elements, rand)
+  start = time.time()
+  tree = FBParser.match.ElementTree(page)
+  print "{n} elements, parsed in {t:.3f}s".format(
+    n=len(tree), t=time.time() - start)
+  rules = FBParser.match.parse_sheet(css)
+  texts = list(FBParser.match.sheet_selectors(css, rules))
+  print "{n} rules, {s} selectors".format(n=len(rules), s=len(texts))
+  start = time.time()
+  expected = naive_match(tree, texts)  # once, it is slow
+  old = time.time() - start
+  new, matched = timeit(
+    lambda: FBParser.match.SelectorMatcher(tree).match(texts))
+  report('match', old, new, matched == expected)
+  ret = FBParser.match.prune_sheet(css, rules, matched)
+  print "{kept}/{n} rules kept, {b}/{size} bytes".format(
+    kept=ret['rules_kept'], n=ret['rules'], b=ret['bytes_kept'],
+    size=ret['bytes'])
+
+
+#
+# json
+#
+
+
+def old_jsonify(s):
+  s = s.replace("\\", "\\\\")
+  s = s.replace("/", "\\/")
+  s = s.replace("'", "\\'")
+  s = s.replace('"', '\\"')
+  s = s.replace('\r', '\\r')
+  s = s.replace('\n', '\\n')
+  return s
+
+
+def old_dejsonify(s):
+  s = s.replace("\\\\", "\\")
+  s = s.replace("\\/", "/")
+  s = s.replace("\\'", "'")
+  s = s.replace('\\"', '"')
+  s = s.replace('\\r', '\r')
+  s = s.replace('\\n', '\n')
+  return s
+
+
+# @param s(str)  string to be cut
+# @param rand(Random)  source of randomness
+# @return (list)  s in chunks of random sizes, some of them empty
+def random_chunks(s, rand):
+  cuts = sorted(rand.randint(0, len(s)) for i in range(rand.randint(0, 8)))
+  return [s[start:end] for start, end in zip([0] + cuts, cuts + [len(s)])]
+
+
+# @param n(int)  number of random strings
+# @param rand(Random)  source of randomness
+# @return (tuple)  numbers of strings s for which dejsonify(jsonify(s)) != s
+#                  with the old and the new codec, and for which the
+#                  streamed codec differs from the new one
+def round_trips(n, rand):
+  old = new = stream = 0
+  alphabet = '\\/\'"rn\r\nab' + unichr(0xe9)
+  for i in range(n):
+    s = u''.join(rand.choice(alphabet) for j in range(rand.randint(0, 12)))
+    if old_dejsonify(old_jsonify(s)) != s:
+      old += 1
+    escaped = FBParser.jsonify(s)
+    if FBParser.dejsonify(escaped) != s:
+      new += 1
+    if u''.join(FBParser.stream_jsonify(random_chunks(s, rand))) != \
+       escaped or u''.join(FBParser.stream_dejsonify(
+         random_chunks(escaped, rand))) != s:
+      stream += 1
+  return old, new, stream
+
+
+# @param dom(str)  page whose pagelets are escaped
+# @param spans(list)  (start, end) of the pagelets
+# @return (list)  content field of their pipes, as jsonify'ed whole pagelets
+def old_contents(dom, spans):
+  return ['"content":{"id":"' + FBParser.jsonify(dom[start:end]) + '"}'
+          for start, end in spans]
+
+
+# @param dom(str)  page whose pagelets are escaped
+# @param spans(list)  (start, end) of the pagelets
+# @return (list)  content field of their pipes, escaped straight into them
+def new_contents(dom, spans):
+  contents = []
+  for start, end in spans:
+    pieces = ['"content":{', '"id"', ':"']
+    pieces.extend(FBParser.stream_jsonify([dom[start:end]]))
+    pieces.append('"}')
+    contents.append(''.join(pieces))
+  return contents
+
+
+def bench_json(args):
+  page = FBParser.synth.synth_page(pagelets=8, words=args.words)
+  dom = unicode(page['html'])
+  escaped = FBParser.jsonify(dom)
+  mb = len(dom) / float(1 << 20)
+  print "page of {size} chars, {n} to be escaped".format(
+    size=len(dom), n=len(escaped) - len(dom))
+  old, old_ret = timeit(old_jsonify, dom)
+  new, new_ret = timeit(FBParser.jsonify, dom)
+  report('jsonify', old, new, old_ret == new_ret)
+  print "{name:<16} {mbs:8.1f}MB/s".format(name='', mbs=mb / new)
+  old, old_ret = timeit(old_dejsonify, escaped)
+  new, new_ret = timeit(FBParser.dejsonify, escaped)
+  report('dejsonify', old, new, old_ret == new_ret == dom)
+  print "{name:<16} {mbs:8.1f}MB/s".format(name='', mbs=mb / new)
+  chunks = [escaped[start:start + FBParser.CHUNK_SIZE]
+            for start in range(0, len(escaped), FBParser.CHUNK_SIZE)]
+  new, new_ret = timeit(lambda: u''.join(FBParser.stream_dejsonify(chunks)))
+  report('  streamed', old, new, new_ret == dom)
+  index = FBParser.dom.ElementIndex(dom)
+  spans = filter(None, (index.content(index.find(id))
+                        for id in page['pagelets'] if index.find(id) >= 0))
+  old, old_ret = timeit(old_contents, dom, spans)
+  new, new_ret = timeit(new_contents, dom, spans)
+  report('pipe content', old, new, old_ret == new_ret)
+  old, new, stream = round_trips(args.round_trips, random.Random(0))
+  print "round trips: {old} failed before, {new} after, {stream} streamed " \
+    "apart, of {n} strings".format(old=old, new=new, stream=stream,
+                                   n=args.round_trips)
+
+
+# main
+if __name__ == '__main__':
+  args = get_args()
+  globals()['bench_' + args.action](args)
@@ -3,9 +3,10 @@ __doc__ = '''
     Use the convert option to turn a DOM file (from domdumper) into a benchmark.
     This works together with the domdumper and assumes the DOM file is named
     as dom.html in its own directory (named after the original html file).
-    The Script cleans up the original DOM file when it's done and removes the
-    whole directory if there is an error. So what's left is ready to be included
-    into the benchmark suite.
+    The Script cleans up the original DOM file when it's done. If there is an
+    error, the stages completed so far are kept (see FBParser.stages) and
+    running the script again resumes from the stage that failed. So what's
+    left is ready to be included into the benchmark suite.
 '''
 __author__ = 'Yao Yue(yyue), yueyao@facebook.com'
 
@@ -18,12 +19,23 @@ import FBParser.garble_image
 import FBParser.dom
 import FBParser.css
 import FBParser.js
+import FBParser.fetch
+import FBParser.cache
+import FBParser.archive
+import FBParser.stages
+import FBParser.timing
+import FBParser.scan
 from FBParser.Constants import MODE_MONO, MODE_BABBLE
+from FBParser.Constants import REF_NOSCRIPT, REF_SEARCH, REF_ICON, REF_IFRAME
+from FBParser.Constants import REF_HREF
+from FBParser.scan import first_ref
 # external imports
 import re
 import sys
 import os
 import random
+import shutil
+import atexit
 try:
   from argparse import ArgumentParser
   from argparse import RawDescriptionHelpFormatter
@@ -48,6 +60,79 @@ def get_args():
     description=__doc__)
   subparsers = parser.add_subparsers(dest='action')
   parser.add_argument('file')
+  parser.add_argument(
+    '--cache',
+    help='''
+      Directory of a resource cache shared across pages, so that resources
+      already downloaded for another page are hardlinked instead.
+      ''',
+    default='')
+  parser.add_argument(
+    '--cache-size',
+    help='''
+      Size bound of the resource cache, in MB. Default to 1024.
+      ''',
+    type=int,
+    default=1024)
+  archive = parser.add_mutually_exclusive_group()
+  archive.add_argument(
+    '--record',
+    help='''
+      Archive file to append every resource retrieved to (see
+      FBParser.archive), so that the conversion can be replayed offline;
+      resources already in it are not retrieved again.
+      ''',
+    default='')
+  archive.add_argument(
+    '--replay',
+    help='''
+      Archive file to take every resource from, without going to the
+      network: resources it doesn't have are missing.
+      ''',
+    default='')
+  parser.add_argument(
+    '-j', '--jobs',
+    help='''
+      Number of images garbled in parallel, default to one per core.
+      ''',
+    type=int,
+    default=0)
+  parser.add_argument(
+    '--profile',
+    help='''
+      Record wall/CPU time, bytes in/out and network retrievals of every
+      stage of the conversion into profile.json, next to the DOM file.
+      ''',
+    action='store_true')
+  parser.add_argument(
+    '--fresh',
+    help='''
+      Convert from scratch, rather than resuming from the stage where the
+      previous run stopped.
+      ''',
+    action='store_true')
+  parser.add_argument(
+    '--selector-cache',
+    help='''
+      SQLite file of the selectors found in css files, shared across pages,
+      so that a css file already scanned for another page is not scanned
+      again.
+      ''',
+    default='')
+  parser.add_argument(
+    '--garble-cache',
+    help='''
+      Directory of a cache of garbled images shared across pages, so that
+      an image already garbled for another page is hardlinked instead.
+      ''',
+    default='')
+  parser.add_argument(
+    '--garble-cache-size',
+    help='''
+      Size bound of the garble cache, in MB. Default to 1024.
+      ''',
+    type=int,
+    default=1024)
 
   parser_pretty = subparsers.add_parser(
     'pretty',
@@ -67,54 +152,52 @@ def get_args():
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources and anonymizing the hrefs are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with href anonymized
-def localize_misc(dom, path, prefix='misc'):
+def localize_misc(dom, path, refs, edits, prefix='misc'):
   '''
   A few standalone resources to localize, including an xml, an ico and an iframe
   '''
   misc_path = os.path.join(path, prefix)
   if not os.path.exists(misc_path):
     os.mkdir(misc_path)
-  re_noscript = re.compile(
-    '(?s)<noscript>.+?content="(?P<url>.+?)".+?</noscript>')
-  m_noscript = re_noscript.search(dom)
-  url = m_noscript.group('url')
-  noscript = m_noscript.group(0)
-  dom = dom.replace(noscript, noscript.replace(url, "about:blank"))
-  re_search = re.compile(
-'<link rel="search" type="application/opensearchdescription\+xml" \
-href="(?P<url>http://.*?\.xml)" title="Facebook">')
-  m_search = re_search.search(dom)
+  fetcher = FBParser.fetch.Fetcher()
+  m_noscript = first_ref(refs, REF_NOSCRIPT)
+  edits.replace(m_noscript.start('url'), m_noscript.end('url'), 'about:blank')
+  m_search = first_ref(refs, REF_SEARCH)
   url = m_search.group('url')
   file = FBParser.url_to_file(url)
-  FBParser.save_resource(url, misc_path, file)
-  dom = dom.replace(url, os.path.join(prefix, file))
-  re_ico = re.compile(
-'<link rel="shortcut icon" href="(?P<url>http://.*?\.ico)">')
-  m_ico = re_ico.search(dom)
+  FBParser.save_resource(url, misc_path, file, fetcher)
+  edits.replace_all(url, os.path.join(prefix, file))
+  m_ico = first_ref(refs, REF_ICON)
   url = m_ico.group('url')
   file = FBParser.url_to_file(url)
-  FBParser.save_resource(url, misc_path, file)
-  dom = dom.replace(url, os.path.join(prefix, file))
-  re_uicif = re.compile('<iframe src="(?P<url>http://.*?\.html)"')
-  m_uicif = re_uicif.search(dom)
+  FBParser.save_resource(url, misc_path, file, fetcher)
+  edits.replace_all(url, os.path.join(prefix, file))
+  m_uicif = first_ref(refs, REF_IFRAME)
   if m_uicif:
     url = m_uicif.group('url')
     file = FBParser.url_to_file(url)
-    FBParser.save_resource(url, misc_path, file)
-    dom = dom.replace(url, os.path.join(prefix, file))
+    FBParser.save_resource(url, misc_path, file, fetcher)
+    edits.replace_all(url, os.path.join(prefix, file))
+  fetcher.close()
   # redirect the rest of the hrefs to about:blank (most of them are hyperlinks)
-  # (call this after localize_css!)
-  dom = re.sub('href="http://.+?"', 'href="about:blank"', dom)
-  return dom
+  # (call this after the other localizers, the hrefs they localized are
+  # left alone)
+  for m_href in refs[REF_HREF]:
+    if not edits.overlaps(m_href.start(), m_href.end()):
+      edits.replace(m_href.start(), m_href.end(), 'href="about:blank"')
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with external resources localized
-def localize_css(dom, path, prefix='css'):
+def localize_css(dom, path, refs, edits, prefix='css'):
   '''
   Find out all css files loaded for this page, replace urls with local files.
   '''
@@ -123,22 +206,27 @@ def localize_css(dom, path, prefix='css'):
   if not os.path.exists(css_path):
     os.mkdir(css_path)
   css_set = set()
-  ret = FBParser.css.css_in_html(dom, dir=css_path, prefix=prefix + '/')
-  dom = ret['source']
+  ret = FBParser.css.css_edits_in_html(refs, dir=css_path,
+                                       prefix=prefix + '/')
+  edits.extend(ret['edits'])
   css_set.update(ret['csses'])
-  ret = FBParser.css.css_in_json(dom, dir=css_path, prefix=prefix + '\/')
-  dom = ret['source']
+  ret = FBParser.css.css_edits_in_json(refs, dir=css_path,
+                                       prefix=prefix + '\/')
+  edits.extend(ret['edits'])
   css_set.update(ret['csses'])
   images = set()
   # localize images in the css files
+  fetcher = FBParser.fetch.Fetcher()
   for css_file in css_set:
     css = FBParser.get_content(os.path.join(path, css_file), encoding='ascii')
-    ret = FBParser.img.img_in_css(css, dir=css_path, prefix='')
+    ret = FBParser.img.img_in_css(
+      css, dir=css_path, prefix='', fetcher=fetcher)
     FBParser.save_content(
       ret['source'],
       os.path.join(path, css_file),
       encoding='ascii')
     images.update(ret['images'])
+  fetcher.close()
   # FBParser.save_content(
     # '\n'.join(list(images)),
     # os.path.join(path, filename.rstrip('html') + 'cssimage_list'),
@@ -147,14 +235,15 @@ def localize_css(dom, path, prefix='css'):
     '\n'.join(list(css_set)),
     os.path.join(path, filename.rstrip('html') + 'css_list'),
     encoding='ascii')
-  return dom
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with external resources localized
-def localize_img(dom, path, prefix='img'):
+def localize_img(dom, path, refs, edits, prefix='img'):
   '''
   Find out all images loaded for this page, replace urls with local files.
   '''
@@ -162,23 +251,24 @@ def localize_img(dom, path, prefix='img'):
   img_path = os.path.join(path, prefix)
   if not os.path.exists(img_path):
     os.mkdir(img_path)
-  ret = FBParser.img.img_in_html(
-    dom,
+  ret = FBParser.img.img_edits_in_html(
+    refs,
     dir=img_path,
     prefix=prefix + '/')
-  dom = ret['source']
+  edits.extend(ret['edits'])
   FBParser.save_content(
     '\n'.join(list(ret['images'])),
     os.path.join(path, filename.rstrip('html') + 'img_list'),
     encoding='ascii')
-  return dom
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with external resources localized
-def localize_js(dom, path, prefix='js'):
+def localize_js(dom, path, refs, edits, prefix='js'):
   '''
   Find out all js files loaded for this page, replace urls with local files.
   '''
@@ -187,24 +277,46 @@ def localize_js(dom, path, prefix='js'):
   if not os.path.exists(js_path):
     os.mkdir(js_path)
   js_set = set()
-  ret = FBParser.js.js_in_html(dom, dir=js_path, prefix=prefix + '/')
-  dom = ret['source']
+  ret = FBParser.js.js_edits_in_html(refs, dir=js_path,
+                                     prefix=prefix + '/')
+  edits.extend(ret['edits'])
   js_set.update(ret['javascripts'])
-  ret = FBParser.js.js_in_json(dom, dir=js_path, prefix=prefix + '\/')
-  dom = ret['source']
+  ret = FBParser.js.js_edits_in_json(refs, dir=js_path,
+                                     prefix=prefix + '\/')
+  edits.extend(ret['edits'])
   js_set.update(ret['javascripts'])
   FBParser.save_content(
     '\n'.join(list(js_set)),
     os.path.join(path, filename.rstrip('html') + 'js_list'),
     mode='w',
     encoding='ascii')
-  return dom
+
+
+# @param dom(str)  DOM, cavalry and injected scripts removed
+# @param path(str)  path of the DOM file
+# @param measure=None(function)  runs each localizer as a named stage, e.g.
+#                                StageProfile.run
+# @return (str)  DOM with all external resources localized
+def localize(dom, path, measure=None):
+  # the page is scanned once for all the localizers, whose edits are all
+  # applied at once
+  if measure is None:
+    measure = lambda stage, func, *inputs: func(*inputs)
+  refs = FBParser.scan.scan_resources(dom)
+  edits = FBParser.EditBuffer(dom)
+  for stage, localizer in [('localize_css', localize_css),
+                           ('localize_js', localize_js),
+                           ('localize_img', localize_img),
+                           ('localize_misc', localize_misc)]:
+    measure(stage, localizer, dom, path, refs, edits)
+  return edits.apply()
 
 
 # @param path(str)  path of the DOM file
 # @param filename(str)  name of the DOM file
+# @param cache=None(SelectorCache)  selectors of css files seen before
 # @return (dict)  a set of selectors for each type (id, calss)
-def get_css_selectors(path, filename):
+def get_css_selectors(path, filename, cache=None):
   '''
   Get all the selectors from a list of css files.
   Call this AFTER localizing all css resources and css_list is in place.
@@ -218,7 +330,7 @@ def get_css_selectors(path, filename):
   for css_file in css_files:
     css_file = css_file.replace('\\', '')
     css = FBParser.get_content(os.path.join(path, css_file), encoding='ascii')
-    ret = FBParser.css.selector_index(css)
+    ret = FBParser.css.selector_index(css, cache)
     for key in ret.keys():
       if key in selectors:
         selectors[key].update(ret[key])
@@ -229,28 +341,67 @@ def get_css_selectors(path, filename):
 
 # @param dom(str)  DOM in a string
 # @param path(str)  path of DOM/html files
+# @param jobs=1(int)  number of images garbled in parallel, 0 for one per core
+# @param cache=None(GarbleCache)  images garbled on previous pages/runs
 # @return  (str)  new DOM with anonymized image sources
-def anonym_images(dom, path, filename):
+def anonym_images(dom, path, filename, jobs=1, cache=None):
   '''
   Anonymize images and regenerate file names.
+  The new names are kept in img_mapping and the original images are only
+  removed once all of them are garbled, so that running this again after
+  an error picks up where it stopped.
   '''
   img_files = FBParser.get_content(
     os.path.join(path, filename.rstrip('html') + 'img_list'),
     encoding='ascii')
-  img_files = img_files.split('\n')
+  img_files = [img_file for img_file in img_files.split('\n') if img_file]
+  mapping_file = os.path.join(path, filename.rstrip('html') + 'img_mapping')
   images = {}
+  known = None
+  if os.path.isfile(mapping_file):  # names given by a previous run
+    img_mapping = FBParser.get_content(mapping_file, encoding='ascii')
+    for mapping in img_mapping.split('\n'):
+      if mapping:
+        img_file, new_file = mapping.split(': ')
+        images[img_file] = new_file
+    known = len(images)
+  # images no longer listed are forgotten, newly listed ones are named
+  images = dict((img_file, images[img_file])
+                for img_file in img_files if img_file in images)
+  if len(images) != known or len(images) != len(img_files):
+    for img_file in img_files:
+      if img_file not in images:
+        ext = os.path.splitext(img_file)[1]
+        prefix = os.path.split(img_file)[0]
+        images[img_file] = \
+          prefix + '/anonym_' + str(random.getrandbits(40)) + ext
+    FBParser.save_content(
+      '\n'.join(key + ': ' + val for key, val in images.items()),
+      mapping_file, encoding='ascii', atomic=True)
+  todo = []
+  for img_file in img_files:
+    dom = dom.replace(img_file, images[img_file])
+    original = os.path.join(path, img_file)
+    new_file = os.path.join(path, images[img_file])
+    if os.path.isfile(original):
+      if os.path.isfile(new_file):  # may be hardlinked to the garble cache
+        os.remove(new_file)
+      shutil.copyfile(original, new_file)
+      todo.append(new_file)
+    elif not os.path.isfile(new_file):  # never retrieved
+      todo.append(new_file)
+    # else garbled by a previous run, the original removed
+  garbled = FBParser.garble_image.garble(
+    todo, jobs, progress=sys.stdout, cache=cache)
+  # whatever could not be garbled must not be left as it is
+  left = set(todo).difference(garbled)
+  if left:
+    print >> sys.stderr, "{n} image(s) not garbled, replaced by "\
+      "placeholders".format(n=len(left))
+    FBParser.garble_image.placehold(left)
   for img_file in img_files:
-    ext = os.path.splitext(img_file)[1]
-    prefix = os.path.split(img_file)[0]
-    new_file = prefix + '/anonym_' + str(random.getrandbits(40)) + ext
-    images[img_file] = new_file
-    dom = dom.replace(img_file, new_file)
-    FBParser.save_resource(os.path.join(path, img_file), path, new_file)
-    os.remove(os.path.join(path, img_file))
-  st_mapping = []
-  for image in images:
-    images[image] = os.path.join(path, images[image])
-  FBParser.garble_image.garble(images.values())
+    if os.path.isfile(os.path.join(path, img_file)):
+      os.remove(os.path.join(path, img_file))
   return dom
 
 
@@ -263,73 +414,126 @@ def decavalry(dom):
   return dom[:start] + re_cavalry_node.sub('', dom[start:], 1)
 
 
+# @param path(str)  path of the DOM file
 def retry_resource(path):
+  '''
+  Retry the resources logged in missing_files.log of each sub-dir.
+  Those still missing are logged again.
+  '''
+  fetcher = FBParser.fetch.Fetcher()
   for subdir in SUBDIRS:
     dir = os.path.join(path, subdir)
     log = os.path.join(dir, 'missing_files.log')
-    # err_log = open(os.path.join(path, 'missing_files.log'), 'w')
     if os.path.isfile(log):
       f = open(log, 'r')
-      files = f.readlines(f)
+      entries = f.readlines()
       f.close()
       os.remove(log)
       for entry in entries:
         url, file = entry.rstrip('\n').split()
-        try:
-          urlretrieve(url, os.path.join(dir, file))
-        except ValueError, err:
-          pass
-          # err_log.write(url + ' ' + os.path.join(subdir, file) + '\n')
-  # err_log.close()
+        FBParser.save_resource(url, dir, file, fetcher)
+  fetcher.close()
 
 
 # main
 if __name__ == '__main__':
   args = get_args()
   path, filename = os.path.split(args.file)
-  dom = FBParser.get_content(args.file, encoding='latin1')
 
   if args.action == 'pretty':
-    pretty_dom = FBParser.dom.prettify(dom)
-    FBParser.save_content(
-      pretty_dom,
-      os.path.join(path, 'pretty-' + filename))
+    # streamed, so that huge pages are never held in memory as a whole
+    chunks = FBParser.read_chunks(args.file, encoding='latin1')
+    chunks = FBParser.stream_del_blockcomment(chunks)
+    FBParser.save_chunks(
+      FBParser.dom.stream_prettify(FBParser.dom.stream_tokens(chunks)),
+      os.path.join(path, 'pretty-' + filename), atomic=True)
 
   if args.action == "convert":
-    dom = decavalry(dom)
-    dom = FBParser.js.remove_cavalry(dom)
-    dom = FBParser.dom.descript_injected(dom)
-    dom = localize_css(dom, path)
-    dom = localize_js(dom, path)
-    dom = localize_img(dom, path)
-    local_dom = localize_misc(dom, path)
-    retry_resource(path)
+    dom = FBParser.get_content(args.file, encoding='latin1')
+    if args.cache:
+      FBParser.cache.use_cache(args.cache, args.cache_size << 20)
+    if args.record:
+      FBParser.archive.use_archive(args.record, 'record')
+    elif args.replay:
+      FBParser.archive.use_archive(args.replay, 'replay')
+    profile = None
+    measure = lambda stage, func, *inputs: func(*inputs)
+    if args.profile:
+      profile = FBParser.timing.StageProfile(args.file)
+      measure = profile.run
+      # saved even if a stage fails, that is when it is most interesting
+      atexit.register(profile.save, os.path.join(path, 'profile.json'))
+    stages = FBParser.stages.StageManifest(
+      path, 'convert', args.fresh, profile)
+    mapping_file = os.path.join(path, 'dom.img_mapping')
+    if args.fresh and os.path.isfile(mapping_file):  # names of a previous run
+      os.remove(mapping_file)
+    dom = stages.run('decavalry', decavalry, dom)
+    dom = stages.run('remove_cavalry', FBParser.js.remove_cavalry, dom)
+    dom = stages.run('descript_injected', FBParser.dom.descript_injected, dom)
+    local_dom = stages.run('localize',
+                           lambda dom: localize(dom, path, measure), dom)
+    if stages.skipped:
+      print "resumed, done already: " + ', '.join(stages.skipped)
+    measure('retry_resource', retry_resource, path)
     dom_13 = local_dom
-    ret = FBParser.dom.unload_pagelets(dom_13)
-    pagelets = ret['pagelets']
-    dom_12 = FBParser.dom.descript_onclick(dom_13)
-    dom_11 = FBParser.dom.descript_pipeonly(dom_12)
+    pagelets = stages.run('pagelet_ids', FBParser.dom.pagelet_ids, dom_13)
+    dom_12 = stages.run('descript_onclick', FBParser.dom.descript_onclick,
+                        dom_13)
+    dom_11 = stages.run('descript_pipeonly', FBParser.dom.descript_pipeonly,
+                        dom_12)
     # Anonymized pages, we don't go beyond js level 2
     selectors = {'id': set(pagelets), 'class': set()}
-    ret = get_css_selectors(path, filename)
+    selector_cache = None
+    if args.selector_cache:
+      selector_cache = FBParser.cache.SelectorCache(args.selector_cache)
+    ret = measure('get_css_selectors', get_css_selectors, path, filename,
+                  selector_cache)
+    if selector_cache is not None:
+      selector_cache.close()
     for key in selectors.keys():
       if key in ret:
         selectors[key].update(ret[key])
-    anondom = anonym_images(dom_11, path, filename)
+    garble_cache = None
+    if args.garble_cache:
+      garble_cache = FBParser.cache.GarbleCache(
+        args.garble_cache, args.garble_cache_size << 20)
+    # skipped on resume once done, resumed where it stopped otherwise
+    anondom = stages.run(
+      'anonym_images',
+      lambda dom: anonym_images(dom, path, filename, args.jobs, garble_cache),
+      dom_11)
+    if garble_cache is not None:
+      garble_cache.close()
+      print "garble cache hit rate: {hit_rate:.2f}".format(
+        **garble_cache.report())
     print "anonymized, home_dynamic"
-    anondom_11 = FBParser.dom.anonym_dom(anondom, selectors, mode=MODE_BABBLE)
-    anonhtml_11 = \
-      FBParser.dom.unload_pagelets(anondom_11, PIPE_EXCLUDES)['html']
-    FBParser.save_content(
-      FBParser.dom.decss_injected(anonhtml_11),
-      os.path.join(path, 'home_dynamic.html'))
+    anondom_11 = stages.run(
+      'anonym_dom',
+      lambda dom, selectors: FBParser.dom.anonym_dom(dom, selectors,
+                                                     mode=MODE_BABBLE),
+      anondom, selectors)
+    anonhtml_11 = measure(
+      'unload_pagelets_anonym',
+      lambda dom: FBParser.dom.unload_pagelets(dom, PIPE_EXCLUDES)['html'],
+      anondom_11)
+    anonhtml_11 = measure('decss_injected', FBParser.dom.decss_injected,
+                          anonhtml_11)
+    measure('save_home_dynamic',
+            lambda s: FBParser.save_content(
+              s, os.path.join(path, 'home_dynamic.html'), atomic=True),
+            anonhtml_11)
     print "anonymized, home_static"
-    anonhtml_10 = FBParser.dom.descript_html(anondom_11)
-    FBParser.save_content(
-      anonhtml_10,
-      os.path.join(path, 'home_static.html'))
+    anonhtml_10 = measure('descript_html', FBParser.dom.descript_html,
+                          anondom_11)
+    measure('save_home_static',
+            lambda s: FBParser.save_content(
+              s, os.path.join(path, 'home_static.html'), atomic=True),
+            anonhtml_10)
 
     os.remove(os.path.join(path, 'dom.js_list'))
     os.remove(os.path.join(path, 'dom.css_list'))
     os.remove(os.path.join(path, 'dom.img_list'))
+    os.remove(os.path.join(path, 'dom.img_mapping'))
     os.remove(os.path.join(path, 'dom.html'))
+    stages.clear()
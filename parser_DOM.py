@@ -13,10 +13,20 @@ import FBParser.garble_image
 import FBParser.dom
 import FBParser.css
 import FBParser.js
+import FBParser.fetch
+import FBParser.cache
+import FBParser.archive
+import FBParser.graph
+import FBParser.scan
+import FBParser.match
+from FBParser.Constants import MODE_MONO
+from FBParser.Constants import REF_SEARCH, REF_ICON, REF_IFRAME, REF_HREF
+from FBParser.scan import first_ref
+from FBParser.regexp import re_html_css
 # external imports
-import re
 import sys
 import os
+import json
 import random
 try:
   from argparse import ArgumentParser
@@ -30,6 +40,9 @@ except ImportError:
 
 PIPE_EXCLUDES = ['onload', 'onafterload']
 SUBDIRS = ['css', 'img', 'js', 'misc']
+VARIANTS = ['css1js3', 'css1js2', 'css1js1', 'css1js0', 'css1pruned',
+            'css0js3', 'css0js2', 'css0js1', 'css0js0',
+            'anon_css1js1', 'anon_css1js0', 'anon_css0js1', 'anon_css0js0']
 
 
 # @return (dict)  Arguments in a dictionary
@@ -42,6 +55,66 @@ def get_args():
     description=__doc__)
   subparsers = parser.add_subparsers(dest='action')
   parser.add_argument('file')
+  parser.add_argument(
+    '--cache',
+    help='''
+      Directory of a resource cache shared across pages, so that resources
+      already downloaded for another page are hardlinked instead.
+      ''',
+    default='')
+  parser.add_argument(
+    '--cache-size',
+    help='''
+      Size bound of the resource cache, in MB. Default to 1024.
+      ''',
+    type=int,
+    default=1024)
+  archive = parser.add_mutually_exclusive_group()
+  archive.add_argument(
+    '--record',
+    help='''
+      Archive file to append every resource retrieved to (see
+      FBParser.archive), so that the conversion can be replayed offline;
+      resources already in it are not retrieved again.
+      ''',
+    default='')
+  archive.add_argument(
+    '--replay',
+    help='''
+      Archive file to take every resource from, without going to the
+      network: resources it doesn't have are missing.
+      ''',
+    default='')
+  parser.add_argument(
+    '-j', '--jobs',
+    help='''
+      Number of images garbled, or variants built, in parallel, default to
+      one per core.
+      ''',
+    type=int,
+    default=0)
+  parser.add_argument(
+    '--selector-cache',
+    help='''
+      SQLite file of the selectors found in css files, shared across pages,
+      so that a css file already scanned for another page is not scanned
+      again.
+      ''',
+    default='')
+  parser.add_argument(
+    '--garble-cache',
+    help='''
+      Directory of a cache of garbled images shared across pages, so that
+      an image already garbled for another page is hardlinked instead.
+      ''',
+    default='')
+  parser.add_argument(
+    '--garble-cache-size',
+    help='''
+      Size bound of the garble cache, in MB. Default to 1024.
+      ''',
+    type=int,
+    default=1024)
 
   parser_pretty = subparsers.add_parser(
     'pretty',
@@ -65,6 +138,7 @@ def get_args():
       Dimension 2, css:
         css0: no css rules applied
         css1: all css rules are applied
+        css1pruned: css1js0, with only the css rules matching its elements
       *Special:
         fp: I call it "fake pipe", which takes a js0-css1 dom tree, and insert
         pagelets into DOM like Big Pipe does, but with minimal script overhead.
@@ -75,53 +149,64 @@ def get_args():
       Given a DOM in html, <filename>, the following html files are generated:
       For clear-text html files, we have:
       ''')
+  parser_decouple.add_argument(
+    '--variants',
+    help='''
+      Variants to be generated, default to all of them. Only the
+      intermediate DOMs they need are computed.
+      ''',
+    nargs='+',
+    choices=VARIANTS,
+    default=VARIANTS)
   return parser.parse_args()
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources and anonymizing the hrefs are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with href anonymized
-def localize_misc(dom, path, prefix='misc'):
+def localize_misc(dom, path, refs, edits, prefix='misc'):
   '''
   A few standalone resources to localize, including an xml, an ico and an iframe
   '''
   misc_path = os.path.join(path, prefix)
   if not os.path.exists(misc_path):
     os.mkdir(misc_path)
-  re_search = re.compile(
-'<link rel="search" type="application/opensearchdescription\+xml" \
-href="(?P<url>http://.*?\.xml)" title="Facebook">')
-  m_search = re_search.search(dom)
+  fetcher = FBParser.fetch.Fetcher()
+  m_search = first_ref(refs, REF_SEARCH)
   url = m_search.group('url')
   file = FBParser.url_to_file(url)
-  FBParser.save_resource(url, misc_path, file)
-  dom = dom.replace(url, os.path.join(prefix, file))
-  re_ico = re.compile(
-'<link rel="shortcut icon" href="(?P<url>http://.*?\.ico)">')
-  m_ico = re_ico.search(dom)
+  FBParser.save_resource(url, misc_path, file, fetcher)
+  edits.replace_all(url, os.path.join(prefix, file))
+  m_ico = first_ref(refs, REF_ICON)
   url = m_ico.group('url')
   file = FBParser.url_to_file(url)
-  FBParser.save_resource(url, misc_path, file)
-  dom = dom.replace(url, os.path.join(prefix, file))
-  re_uicif = re.compile('<iframe src="(?P<url>http://.*?\.html)"')
-  m_uicif = re_uicif.search(dom)
+  FBParser.save_resource(url, misc_path, file, fetcher)
+  edits.replace_all(url, os.path.join(prefix, file))
+  m_uicif = first_ref(refs, REF_IFRAME)
   if m_uicif:
     url = m_uicif.group('url')
     file = FBParser.url_to_file(url)
-    FBParser.save_resource(url, misc_path, file)
-    dom = dom.replace(url, os.path.join(prefix, file))
+    FBParser.save_resource(url, misc_path, file, fetcher)
+    edits.replace_all(url, os.path.join(prefix, file))
+  fetcher.close()
   # redirect the rest of the hrefs to about:blank (most of them are hyperlinks)
-  # (call this after localize_css!)
-  dom = re.sub('href="http://.+?"', 'href="about:blank"', dom)
-  return dom
+  # (call this after the other localizers, the hrefs they localized are
+  # left alone)
+  for m_href in refs[REF_HREF]:
+    if not edits.overlaps(m_href.start(), m_href.end()):
+      edits.replace(m_href.start(), m_href.end(), 'href="about:blank"')
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with external resources localized
-def localize_css(dom, path, prefix='css'):
+def localize_css(dom, path, refs, edits, prefix='css'):
   '''
   Find out all css files loaded for this page, replace urls with local files.
   '''
@@ -130,22 +215,27 @@ def localize_css(dom, path, prefix='css'):
   if not os.path.exists(css_path):
     os.mkdir(css_path)
   css_set = set()
-  ret = FBParser.css.css_in_html(dom, dir=css_path, prefix=prefix + '/')
-  dom = ret['source']
+  ret = FBParser.css.css_edits_in_html(refs, dir=css_path,
+                                       prefix=prefix + '/')
+  edits.extend(ret['edits'])
   css_set.update(ret['csses'])
-  ret = FBParser.css.css_in_json(dom, dir=css_path, prefix=prefix + '\/')
-  dom = ret['source']
+  ret = FBParser.css.css_edits_in_json(refs, dir=css_path,
+                                       prefix=prefix + '\/')
+  edits.extend(ret['edits'])
   css_set.update(ret['csses'])
   images = set()
   # localize images in the css files
+  fetcher = FBParser.fetch.Fetcher()
   for css_file in css_set:
     css = FBParser.get_content(os.path.join(path, css_file), encoding='ascii')
-    ret = FBParser.img.img_in_css(css, dir=css_path, prefix=prefix + '/')
+    ret = FBParser.img.img_in_css(
+      css, dir=css_path, prefix=prefix + '/', fetcher=fetcher)
     FBParser.save_content(
       ret['source'],
       os.path.join(path, css_file),
       encoding='ascii')
     images.update(ret['images'])
+  fetcher.close()
   FBParser.save_content(
     '\n'.join(list(images)),
     os.path.join(path, filename.rstrip('html') + 'cssimage_list'),
@@ -154,14 +244,15 @@ def localize_css(dom, path, prefix='css'):
     '\n'.join(list(css_set)),
     os.path.join(path, filename.rstrip('html') + 'css_list'),
     encoding='ascii')
-  return dom
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with external resources localized
-def localize_img(dom, path, prefix='img'):
+def localize_img(dom, path, refs, edits, prefix='img'):
   '''
   Find out all images loaded for this page, replace urls with local files.
   '''
@@ -169,23 +260,24 @@ def localize_img(dom, path, prefix='img'):
   img_path = os.path.join(path, prefix)
   if not os.path.exists(img_path):
     os.mkdir(img_path)
-  ret = FBParser.img.img_in_html(
-    dom,
+  ret = FBParser.img.img_edits_in_html(
+    refs,
     dir=img_path,
     prefix=prefix + '/')
-  dom = ret['source']
+  edits.extend(ret['edits'])
   FBParser.save_content(
     '\n'.join(list(ret['images'])),
     os.path.join(path, filename.rstrip('html') + 'img_list'),
     encoding='ascii')
-  return dom
 
 
 # @param dom(str)  DOM string to search
 # @param path(str)  path to the source file
+# @param refs(dict)  references in dom, see FBParser.scan.scan_resources
+# @param edits(EditBuffer)  edits of dom, to which those localizing the
+#                           resources are added
 # @param prefix(str)  prefix of sub-dir to store the external resources
-# @return (str)  DOM with external resources localized
-def localize_js(dom, path, prefix='js'):
+def localize_js(dom, path, refs, edits, prefix='js'):
   '''
   Find out all js files loaded for this page, replace urls with local files.
   '''
@@ -194,24 +286,26 @@ def localize_js(dom, path, prefix='js'):
   if not os.path.exists(js_path):
     os.mkdir(js_path)
   js_set = set()
-  ret = FBParser.js.js_in_html(dom, dir=js_path, prefix=prefix + '/')
-  dom = ret['source']
+  ret = FBParser.js.js_edits_in_html(refs, dir=js_path,
+                                     prefix=prefix + '/')
+  edits.extend(ret['edits'])
   js_set.update(ret['javascripts'])
-  ret = FBParser.js.js_in_json(dom, dir=js_path, prefix=prefix + '\/')
-  dom = ret['source']
+  ret = FBParser.js.js_edits_in_json(refs, dir=js_path,
+                                     prefix=prefix + '\/')
+  edits.extend(ret['edits'])
   js_set.update(ret['javascripts'])
   FBParser.save_content(
     '\n'.join(list(js_set)),
     os.path.join(path, filename.rstrip('html') + 'js_list'),
     mode='w',
     encoding='ascii')
-  return dom
 
 
 # @param path(str)  path of the DOM file
 # @param filename(str)  name of the DOM file
+# @param cache=None(SelectorCache)  selectors of css files seen before
 # @return (dict)  a set of selectors for each type (id, calss)
-def get_css_selectors(path, filename):
+def get_css_selectors(path, filename, cache=None):
   '''
   Get all the selectors from a list of css files.
   Call this AFTER localizing all css resources and css_list is in place.
@@ -225,7 +319,7 @@ def get_css_selectors(path, filename):
   for css_file in css_files:
     css_file = css_file.replace('\\', '')
     css = FBParser.get_content(os.path.join(path, css_file), encoding='ascii')
-    ret = FBParser.css.selector_index(css)
+    ret = FBParser.css.selector_index(css, cache)
     for key in ret.keys():
       if key in selectors:
         selectors[key].update(ret[key])
@@ -236,8 +330,10 @@ def get_css_selectors(path, filename):
 
 # @param dom(str)  DOM in a string
 # @param path(str)  path of DOM/html files
+# @param jobs=1(int)  number of images garbled in parallel, 0 for one per core
+# @param cache=None(GarbleCache)  images garbled on previous pages/runs
 # @return  (str)  new DOM with anonymized image sources
-def anonym_images(dom, path, filename):
+def anonym_images(dom, path, filename, jobs=1, cache=None):
   '''
   Anonymize images and regenerate file names.
   '''
@@ -273,117 +369,205 @@ def anonym_images(dom, path, filename):
       encoding='ascii')
     for image in images:
       images[image] = os.path.join(path, images[image])
-    FBParser.garble_image.garble(images.values())
+    garbled = FBParser.garble_image.garble(
+      images.values(), jobs, progress=sys.stdout, cache=cache)
+    # whatever could not be garbled must not be left as it is
+    left = set(images.values()).difference(garbled)
+    if left:
+      print >> sys.stderr, "{n} image(s) not garbled, replaced by "\
+        "placeholders".format(n=len(left))
+      FBParser.garble_image.placehold(left)
   return dom
 
 
+# @param path(str)  path of the DOM file
 def retry_resource(path):
+  '''
+  Retry the resources logged in missing_files.log of each sub-dir.
+  Those still missing are logged again.
+  '''
+  fetcher = FBParser.fetch.Fetcher()
   for subdir in SUBDIRS:
     dir = os.path.join(path, subdir)
     log = os.path.join(dir, 'missing_files.log')
-    err_log = open(os.path.join(path, 'missing_files.log'), 'w')
     if os.path.isfile(log):
       f = open(log, 'r')
-      files = f.readlines(f)
+      entries = f.readlines()
       f.close()
       os.remove(log)
       for entry in entries:
         url, file = entry.rstrip('\n').split()
-        try:
-          urlretrieve(url, os.path.join(dir, file))
-        except ValueError, err:
-          err_log.write(url + ' ' + os.path.join(subdir, file) + '\n')
-  err_log.close()
+        FBParser.save_resource(url, dir, file, fetcher)
+  fetcher.close()
+
+
+# @param file(str)  the DOM file
+# @param path(str)  path of the DOM file
+# @return (str)  DOM with all external resources localized
+def localize(file, path):
+  dom = FBParser.get_content(file)
+  dom = FBParser.js.remove_cavalry(dom)
+  dom = FBParser.dom.decss_injected(dom)
+  # the page is scanned once for all the localizers, whose edits are all
+  # applied at once
+  refs = FBParser.scan.scan_resources(dom)
+  edits = FBParser.EditBuffer(dom)
+  localize_css(dom, path, refs, edits)
+  localize_js(dom, path, refs, edits)
+  localize_img(dom, path, refs, edits)
+  localize_misc(dom, path, refs, edits)
+  retry_resource(path)
+  return edits.apply()
+
+
+# @param dom(str)  localized DOM
+# @param path(str)  path of the DOM file
+# @param filename(str)  name of the DOM file
+# @param cache=''(str)  SQLite file of a selector cache, if any
+# @return (dict)  id & class selectors to be kept by anonym_dom
+def anonym_selectors(dom, path, filename, cache=''):
+  selectors = {'id': set(FBParser.dom.pagelet_ids(dom)), 'class': set()}
+  selector_cache = FBParser.cache.SelectorCache(cache) if cache else None
+  ret = get_css_selectors(path, filename, selector_cache)
+  if selector_cache is not None:
+    selector_cache.close()
+  for key in selectors.keys():
+    if key in ret:
+      selectors[key].update(ret[key])
+  return selectors
+
+
+# @param dom(str)  static DOM, i.e. without scripts
+# @param path(str)  path of the DOM file
+# @param filename(str)  name of the DOM file
+# @param prefix='pruned-'(str)  prefix of the pruned copies of the sheets
+# @return (str)  DOM whose local style sheets only have the rules matching
+#                at least one of its elements
+def prune_css(dom, path, filename, prefix='pruned-'):
+  '''
+  Match the rules of the style sheets linked by dom against its elements
+  all at once, and link pruned copies of the sheets instead. How much of
+  each sheet is used is saved to <filename>css_coverage, in JSON.
+  '''
+  tree = FBParser.match.ElementTree(dom)
+  sheets = []  # (m_css, file, css, rules)
+  for m_css in re_html_css.finditer(dom):
+    file = m_css.group('url')
+    if '//' in file or not os.path.isfile(os.path.join(path, file)):
+      continue  # not localized
+    css = FBParser.get_content(os.path.join(path, file))
+    sheets.append(
+      (m_css, file, css, FBParser.match.parse_sheet(css)))
+  matched = FBParser.match.SelectorMatcher(tree).match(
+    selector for m_css, file, css, rules in sheets
+    for selector in FBParser.match.sheet_selectors(css, rules))
+  edits = FBParser.EditBuffer(dom)
+  coverage = {}
+  pruned = {}
+  for m_css, file, css, rules in sheets:
+    if file not in pruned:
+      ret = FBParser.match.prune_sheet(css, rules, matched)
+      dir, name = os.path.split(file)
+      pruned[file] = dir + '/' + prefix + name if dir else prefix + name
+      FBParser.save_content(
+        ret.pop('css'), os.path.join(path, pruned[file]), atomic=True)
+      coverage[file] = ret
+    edits.replace(m_css.start('url'), m_css.end('url'), pruned[file])
+  total = dict.fromkeys(('rules', 'rules_kept', 'selectors',
+                         'selectors_kept', 'bytes', 'bytes_kept'), 0)
+  for ret in coverage.values():
+    for key, value in ret.items():
+      total[key] += value
+  total['sheets'] = len(coverage)
+  total['elements'] = len(tree)
+  coverage['total'] = total
+  FBParser.save_content(
+    json.dumps(coverage, indent=2, sort_keys=True),
+    os.path.join(path, filename.rstrip('html') + 'css_coverage'),
+    encoding='ascii')
+  print ('css coverage: {rules_kept}/{rules} rules, '
+         '{selectors_kept}/{selectors} selectors, {bytes_kept}/{bytes} bytes '
+         'of {sheets} sheets, against {elements} elements').format(**total)
+  return edits.apply()
+
+
+# @param args  command line options
+# @param path(str)  path of the DOM file
+# @param filename(str)  name of the DOM file
+# @return (TransformGraph)  transforms from the DOM file to all the variants
+def variant_graph(args, path, filename):
+  '''
+  Declare every variant (see VARIANTS) as transforms of shared intermediate
+  DOMs, so that each of them is computed once, and only if needed.
+  '''
+  dom = FBParser.dom
+  graph = FBParser.graph.TransformGraph()
+  graph.add('dom_13', lambda: localize(args.file, path), local=True)
+  graph.add('css1js3', lambda d: dom.unload_pagelets(d)['html'], ['dom_13'])
+  graph.add('dom_12', dom.descript_onclick, ['dom_13'])
+  graph.add('css1js2', lambda d: dom.unload_pagelets(d)['html'], ['dom_12'])
+  graph.add('dom_11', dom.descript_pipeonly, ['dom_12'])
+  graph.add('css1js1', lambda d: dom.unload_pagelets(d, PIPE_EXCLUDES)['html'],
+            ['dom_11'])
+  graph.add('css1js0', dom.descript_html, ['dom_12'])
+  # the static page, with only the css rules matching its elements
+  graph.add('css1pruned', lambda d: prune_css(d, path, filename),
+            ['css1js0'], local=True)
+  # css-free source files
+  for js in '3210':
+    graph.add('css0js' + js, dom.unload_css, ['css1js' + js])
+
+  # Anonymized pages, we don't go beyond js level 1
+  def garble(dom_11):
+    garble_cache = None
+    if args.garble_cache:
+      garble_cache = FBParser.cache.GarbleCache(
+        args.garble_cache, args.garble_cache_size << 20)
+    anondom = anonym_images(dom_11, path, filename, args.jobs, garble_cache)
+    if garble_cache is not None:
+      garble_cache.close()
+      print "garble cache hit rate: {hit_rate:.2f}".format(
+        **garble_cache.report())
+    return anondom
+  graph.add('selectors',
+            lambda d: anonym_selectors(d, path, filename, args.selector_cache),
+            ['dom_13'], local=True)
+  graph.add('anondom', garble, ['dom_11'], local=True)
+  graph.add('anondom_11', lambda d, s: dom.anonym_dom(d, s, MODE_MONO),
+            ['anondom', 'selectors'])
+  graph.add('anon_css1js1',
+            lambda d: dom.unload_pagelets(d, PIPE_EXCLUDES)['html'],
+            ['anondom_11'])
+  graph.add('anon_css1js0', dom.descript_html, ['anondom_11'])
+  # css-free anonymous source files
+  for js in '10':
+    graph.add('anon_css0js' + js, dom.unload_css, ['anon_css1js' + js])
+  return graph
 
 
 # main
 if __name__ == '__main__':
   args = get_args()
   path, filename = os.path.split(args.file)
-  dom = FBParser.get_content(args.file)
 
   if args.action == 'pretty':
-    pretty_dom = FBParser.dom.prettify(dom)
-    FBParser.save_content(
-      pretty_dom,
-      os.path.join(path, 'pretty-' + filename))
+    # streamed, so that huge pages are never held in memory as a whole
+    chunks = FBParser.stream_del_blockcomment(FBParser.read_chunks(args.file))
+    FBParser.save_chunks(
+      FBParser.dom.stream_prettify(FBParser.dom.stream_tokens(chunks)),
+      os.path.join(path, 'pretty-' + filename), atomic=True)
 
   if args.action == "convert":
-    dom = FBParser.js.remove_cavalry(dom)
-    dom = FBParser.dom.decss_injected(dom)
-    dom = localize_css(dom, path)
-    dom = localize_js(dom, path)
-    dom = localize_img(dom, path)
-    local_dom = localize_misc(dom, path)
-    retry_resource(path)
-    dom_13 = local_dom
-    print "css 1, javascript 3"
-    ret = FBParser.dom.unload_pagelets(dom_13)
-    html_13 = ret['html']
-    pagelets = ret['pagelets']
-    FBParser.save_content(
-      html_13,
-      os.path.join(path, 'css1js3-' + filename))
-    print "css 1, javascript 2"
-    dom_12 = FBParser.dom.descript_onclick(dom_13)
-    html_12 = FBParser.dom.unload_pagelets(dom_12)['html']
-    FBParser.save_content(
-      html_12,
-      os.path.join(path, 'css1js2-' + filename))
-    print "css 1, javascript 1"
-    dom_11 = FBParser.dom.descript_pipeonly(dom_12)
-    html_11 = FBParser.dom.unload_pagelets(dom_11, PIPE_EXCLUDES)['html']
-    FBParser.save_content(
-      html_11,
-      os.path.join(path, 'css1js1-' + filename))
-    print "css 1, javascript 0"
-    html_10 = FBParser.dom.descript_html(dom_12)
-    FBParser.save_content(
-      html_10,
-      os.path.join(path, 'css1js0-' + filename))
-    # css-free source files
-    print "css 0, javascript 3"
-    FBParser.save_content(
-      FBParser.dom.unload_css(html_13),
-      os.path.join(path, 'css0js3-' + filename))
-    print "css 0, javascript 2"
-    FBParser.save_content(
-      FBParser.dom.unload_css(html_12),
-      os.path.join(path, 'css0js2-' + filename))
-    print "css 0, javascript 1"
-    FBParser.save_content(
-      FBParser.dom.unload_css(html_11),
-      os.path.join(path, 'css0js1-' + filename))
-    print "css 0, javascript 0"
-    FBParser.save_content(
-      FBParser.dom.unload_css(html_10),
-      os.path.join(path, 'css0js0-' + filename))
-
-    # Anonymized pages, we don't go beyond js level 2
-    selectors = {'id': set(pagelets), 'class': set()}
-    ret = get_css_selectors(path, filename)
-    for key in selectors.keys():
-      if key in ret:
-        selectors[key].update(ret[key])
-    anondom = anonym_images(dom_11, path, filename)
-    print "anonymized, css 1, javascript 1"
-    anondom_11 = FBParser.dom.anonym_dom(anondom, selectors)
-    anonhtml_11 = \
-      FBParser.dom.unload_pagelets(anondom_11, PIPE_EXCLUDES)['html']
-    FBParser.save_content(
-      anonhtml_11,
-      os.path.join(path, 'anon_css1js1-' + filename))
-    print "anonymized, css 1, javascript 0"
-    anonhtml_10 = FBParser.dom.descript_html(anondom_11)
-    FBParser.save_content(
-      anonhtml_10,
-      os.path.join(path, 'anon_css1js0-' + filename))
-    # css-free anonymous source files
-    print "anonymized, css 0, javascript 1"
-    FBParser.save_content(
-      FBParser.dom.unload_css(anonhtml_11),
-      os.path.join(path, 'anon_css0js1-' + filename))
-    print "anonymized, css 0, javascript 0"
-    FBParser.save_content(
-      FBParser.dom.unload_css(anonhtml_10),
-      os.path.join(path, 'anon_css0js0-' + filename))
+    if args.cache:
+      FBParser.cache.use_cache(args.cache, args.cache_size << 20)
+    if args.record:
+      FBParser.archive.use_archive(args.record, 'record')
+    elif args.replay:
+      FBParser.archive.use_archive(args.replay, 'replay')
+    values = variant_graph(args, path, filename).build(args.variants, args.jobs)
+    for variant in VARIANTS:
+      if variant in values:
+        print variant
+        FBParser.save_content(
+          values[variant],
+          os.path.join(path, variant + '-' + filename), atomic=True)
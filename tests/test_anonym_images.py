@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_anonym_images.py
+
+The anonym_images stage of get_benchmark, run again after an error.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+import FBParser
+import FBParser.garble_image
+# external imports
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+import Image
+
+get_benchmark = imp.load_source(
+  'get_benchmark',
+  os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+               'get_benchmark.py'))
+
+
+class AnonymImagesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.dir, 'img'))
+    self.names = ['img/a.png', 'img/b.gif', 'img/c.jpg']
+    for i, name in enumerate(self.names):
+      Image.new('RGB', (20 + i, 10), (i * 80, 0, 0)).save(
+        os.path.join(self.dir, name))
+    FBParser.save_content('\n'.join(self.names),
+                          os.path.join(self.dir, 'dom.img_list'))
+    self.dom = ''.join('<img src="{name}" />'.format(name=name)
+                       for name in self.names)
+    self.garble = FBParser.garble_image.garble
+
+  def tearDown(self):
+    FBParser.garble_image.garble = self.garble
+    shutil.rmtree(self.dir)
+
+  # @return (list)  names of the image files of the page
+  def listdir(self):
+    return sorted('img/' + name
+                  for name in os.listdir(os.path.join(self.dir, 'img')))
+
+  # @param dom(str)  the page, anonymized
+  def assertAnonymized(self, dom):
+    files = self.listdir()
+    self.assertEqual(len(files), len(self.names))
+    for file in files:
+      self.assertTrue(file.startswith('img/anonym_'), files)
+      self.assertTrue(file in dom)
+    for name in self.names:
+      self.assertFalse(name in dom)
+
+  def test_resumes_after_an_error(self):
+    def garble_one_and_fail(images, *args, **kwargs):
+      self.garble(images[:1], *args, **kwargs)
+      raise KeyboardInterrupt()
+    FBParser.garble_image.garble = garble_one_and_fail
+    self.assertRaises(KeyboardInterrupt, get_benchmark.anonym_images,
+                      self.dom, self.dir, 'dom.html')
+    # the originals are still there, next to their copies
+    self.assertEqual(len(self.listdir()), 2 * len(self.names))
+    FBParser.garble_image.garble = self.garble
+    dom = get_benchmark.anonym_images(self.dom, self.dir, 'dom.html')
+    self.assertAnonymized(dom)
+    # and again, once done: the same names, nothing garbled again
+    garbled = dict((file, open(os.path.join(self.dir, file), 'rb').read())
+                   for file in self.listdir())
+    self.assertEqual(
+      get_benchmark.anonym_images(self.dom, self.dir, 'dom.html'), dom)
+    for file, content in garbled.items():
+      self.assertEqual(open(os.path.join(self.dir, file), 'rb').read(),
+                       content)
+
+  def test_reconciles_a_stale_mapping(self):
+    # left by a run on other images, knowing only one of these
+    mapping = os.path.join(self.dir, 'dom.img_mapping')
+    FBParser.save_content('img/gone.png: img/anonym_1.png\n'
+                          'img/a.png: img/anonym_2.png', mapping)
+    dom = get_benchmark.anonym_images(self.dom, self.dir, 'dom.html')
+    self.assertAnonymized(dom)
+    self.assertTrue('img/anonym_2.png' in dom)
+    names = sorted(line.split(': ')[0]
+                   for line in open(mapping).read().split('\n'))
+    self.assertEqual(names, self.names)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_archive.py
+
+Conversion of a page recorded into an archive, replayed in another directory.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+import FBParser
+import FBParser.img
+import FBParser.archive
+from FBParser.fetch import _serve_fixtures
+# external imports
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+import Image
+
+get_benchmark = imp.load_source(
+  'get_benchmark',
+  os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+               'get_benchmark.py'))
+
+
+class RecordReplayTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.fixtures = os.path.join(self.dir, 'fixtures')
+    os.mkdir(self.fixtures)
+    self.names = ['a.png', 'b.gif', 'c.jpg']
+    for i, name in enumerate(self.names):
+      Image.new('RGB', (20 + i, 10), (i * 80, 0, 0)).save(
+        os.path.join(self.fixtures, name))
+    self.server = _serve_fixtures(self.fixtures, 0)
+    self.page = ''.join(
+      '<img src="http://127.0.0.1:{port}/{name}" />'.format(
+        port=self.server.server_address[1], name=name)
+      for name in self.names)
+    self.archive = os.path.join(self.dir, 'crawl.arc')
+
+  def tearDown(self):
+    FBParser.archive._active = None
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.dir)
+
+  # @param mode(str)  'record' or 'replay'
+  # @param name(str)  directory of the page, under self.dir
+  # @return (tuple)  (directory of the page, page with anonymized images)
+  def convert(self, mode, name):
+    '''
+    Localize the images of the page and run the image stage of a conversion
+    on them, with the archive in use.
+    '''
+    archive = FBParser.archive.use_archive(self.archive, mode)
+    path = os.path.join(self.dir, name)
+    os.makedirs(os.path.join(path, 'img'))
+    try:
+      ret = FBParser.img.img_in_html(
+        self.page, dir=os.path.join(path, 'img'), prefix='img/')
+      FBParser.save_content('\n'.join(ret['images']),
+                            os.path.join(path, 'dom.img_list'))
+      dom = get_benchmark.anonym_images(ret['source'], path, 'dom.html')
+    finally:
+      archive.close()
+    return path, dom
+
+  # @param path(str)  directory of a converted page
+  # @param dom(str)  the page, anonymized
+  def assertAnonymized(self, path, dom):
+    self.assertFalse(os.path.exists(
+      os.path.join(path, 'img', 'missing_files.log')))
+    files = sorted(os.listdir(os.path.join(path, 'img')))
+    self.assertEqual(len(files), len(self.names))
+    for file in files:
+      # originals are gone, every anonymized image is in the page and valid
+      self.assertTrue(file.startswith('anonym_'), files)
+      self.assertTrue('img/' + file in dom)
+      Image.open(os.path.join(path, 'img', file)).load()
+
+  def test_replays_into_another_directory(self):
+    self.assertAnonymized(*self.convert('record', 'recorded'))
+    archived = sorted(FBParser.archive.ResourceArchive(self.archive).index)
+    # the network only, not the local copies of the image stage
+    self.assertEqual(len(archived), len(self.names))
+    self.assertTrue(all(url.startswith('http://') for url in archived))
+    # nothing is retrieved when replaying
+    self.server.shutdown()
+    self.assertAnonymized(*self.convert('replay', 'replayed'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_dom.py
+
+tokenize and stream_tokens of FBParser.dom, on markup cut anywhere.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+from FBParser.dom import tokenize, stream_tokens
+from FBParser.Constants import TOKEN_TEXT, TOKEN_OPEN, TOKEN_CLOSE, TOKEN_EMPTY
+# external imports
+import random
+import unittest
+
+PARTS = ['<', '>', '"', '\\', 'a', ' ', '/', '!', '<div class="x">', '</div>',
+         '<br>', '<!--', '\n', "'", 'p', '<a title="<b>">', '"\\""']
+
+
+# @param s(str)  markup
+# @return (list)  (kind, text, label) of its tokens, as tokenize tells
+def tokens(s):
+  return [(kind, s[start:end], label)
+          for kind, start, end, label in tokenize(s)]
+
+
+class StreamTokensTest(unittest.TestCase):
+
+  def setUp(self):
+    rand = random.Random(6)
+    self.pages = ['', '<', 'a"b', '<a title="x', 'a\\', '<p>"<b>"</p>']
+    for n in range(400):
+      self.pages.append(''.join(rand.choice(PARTS)
+                                for i in range(rand.randint(1, 30))))
+
+  def test_tokens(self):
+    self.assertEqual(
+      tokens('<p class="a">x "<b>" y</p><br>\\<z'),
+      [(TOKEN_OPEN, '<p class="a">', 'p'), (TOKEN_TEXT, 'x "<b>" y', None),
+       (TOKEN_CLOSE, '</p>', 'p'), (TOKEN_EMPTY, '<br>', 'br'),
+       (TOKEN_TEXT, '\\<z', None)])
+
+  def test_streams_every_split(self):
+    for s in self.pages:
+      expected = tokens(s)
+      for cut in range(len(s) + 1):
+        chunks = [s[:cut], s[cut:]]
+        self.assertEqual(list(stream_tokens(chunks)), expected, chunks)
+      for size in (1, 2, 3):
+        chunks = [s[i:i + size] for i in range(0, len(s), size)]
+        self.assertEqual(list(stream_tokens(chunks)), expected, chunks)
+
+  def test_streams_tokens_spanning_chunks(self):
+    string = '"' + 'x\\"' * 3000 + '<b>"'
+    s = ('<script>f(' + string + ')</script><div title="' + 'y' * 5000 +
+         '">' + 'z' * 5000 + '</div>')
+    chunks = [s[i:i + 7] for i in range(0, len(s), 7)]
+    self.assertEqual(list(stream_tokens(chunks)), tokens(s))
+    self.assertEqual(list(stream_tokens(chunks))[1],
+                     (TOKEN_TEXT, 'f(' + string + ')', None))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_fetch.py
+
+Fetcher and retrieve against the local fixture server of FBParser.fetch.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+import FBParser.fetch
+from FBParser.fetch import Fetcher, retrieve, _serve_fixtures
+# external imports
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+# @param dir(str)  directory of the fixture files
+# @return (tuple)  (server, list of the connections it accepted)
+def counting_server(dir):
+  '''
+  Serve the fixtures, recording the client address of every connection.
+  '''
+  server = _serve_fixtures(dir, 0)
+  connections = []
+  lock = threading.Lock()
+  handler = server.RequestHandlerClass
+
+  class Counting(handler):
+    def setup(self):
+      with lock:
+        connections.append(self.client_address)
+      handler.setup(self)
+
+  server.RequestHandlerClass = Counting
+  return server, connections
+
+
+class FetcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.fixtures = os.path.join(self.dir, 'fixtures')
+    self.out = os.path.join(self.dir, 'out')
+    os.mkdir(self.fixtures)
+    os.mkdir(self.out)
+    self.names = []
+    for i in range(12):
+      self.names.append('rsrc{i}.js'.format(i=i))
+      f = open(os.path.join(self.fixtures, self.names[-1]), 'wb')
+      f.write(os.urandom(1000 + i * 100))
+      f.close()
+    self.server, self.connections = counting_server(self.fixtures)
+    self.site = 'http://127.0.0.1:{port}/'.format(
+      port=self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.dir)
+
+  # @param name(str)  a fixture
+  # @param dir=None(str)  where it was retrieved, default to self.out
+  def assertRetrieved(self, name, dir=None):
+    f = open(os.path.join(self.fixtures, name), 'rb')
+    expected = f.read()
+    f.close()
+    f = open(os.path.join(dir or self.out, name), 'rb')
+    self.assertEqual(f.read(), expected)
+    f.close()
+
+  def test_retrieves_every_file(self):
+    fetcher = Fetcher(workers=3)
+    for name in self.names:
+      self.assertTrue(fetcher.submit(self.site + name, self.out, name))
+    self.assertEqual(fetcher.wait(), [])
+    fetcher.close()
+    self.assertEqual(fetcher.fetched, len(self.names))
+    for name in self.names:
+      self.assertRetrieved(name)
+    self.assertFalse(
+      [name for name in os.listdir(self.out) if name.endswith('.part')])
+
+  def test_reuses_connections(self):
+    fetcher = Fetcher(workers=2)
+    for name in self.names:
+      fetcher.submit(self.site + name, self.out, name)
+    self.assertEqual(fetcher.wait(), [])
+    fetcher.close()
+    # one keep-alive connection per worker, not one per file
+    self.assertTrue(1 <= len(self.connections) <= 2, self.connections)
+
+  def test_pools_connections_per_host(self):
+    other, other_connections = counting_server(self.fixtures)
+    other_site = 'http://127.0.0.1:{port}/'.format(
+      port=other.server_address[1])
+    pool = {}
+    try:
+      for name in self.names[:4]:
+        retrieve(self.site + name, os.path.join(self.out, name), pool)
+        retrieve(other_site + name, os.path.join(self.out, name + '.2'),
+                 pool)
+    finally:
+      for conn in pool.values():
+        conn.close()
+      other.shutdown()
+      other.server_close()
+    self.assertEqual(len(pool), 2)
+    self.assertEqual(len(self.connections), 1)
+    self.assertEqual(len(other_connections), 1)
+    self.assertRetrieved(self.names[3])
+
+  def test_reports_failures_and_goes_on(self):
+    fetcher = Fetcher(workers=1)
+    fetcher.submit(self.site + 'missing.js', self.out, 'missing.js')
+    fetcher.submit(self.site + self.names[0], self.out, self.names[0])
+    self.assertEqual(fetcher.wait(), [self.site + 'missing.js'])
+    # the worker is still there after the failure
+    fetcher.submit(self.site + self.names[1], self.out, self.names[1])
+    self.assertEqual(fetcher.wait(), [])
+    fetcher.close()
+    self.assertRetrieved(self.names[0])
+    self.assertRetrieved(self.names[1])
+    self.assertFalse(os.path.exists(os.path.join(self.out, 'missing.js')))
+    f = open(os.path.join(self.out, 'missing_files.log'))
+    self.assertEqual(f.read(), self.site + 'missing.js missing.js\n')
+    f.close()
+
+  def test_skips_existing_and_pending_files(self):
+    open(os.path.join(self.out, self.names[0]), 'wb').close()
+    fetcher = Fetcher(workers=1)
+    self.assertFalse(
+      fetcher.submit(self.site + self.names[0], self.out, self.names[0]))
+    self.assertTrue(
+      fetcher.submit(self.site + self.names[1], self.out, self.names[1]))
+    # being retrieved, or retrieved already
+    self.assertFalse(
+      fetcher.submit(self.site + self.names[1], self.out, self.names[1]))
+    fetcher.close()
+    self.assertEqual(fetcher.fetched, 1)
+    self.assertEqual(
+      os.path.getsize(os.path.join(self.out, self.names[0])), 0)
+
+  def test_counts_fetches(self):
+    before = FBParser.fetch.fetch_stats()
+    retrieve(self.site + self.names[0], os.path.join(self.out, 'a'))
+    after = FBParser.fetch.fetch_stats()
+    self.assertEqual(after['fetches'] - before['fetches'], 1)
+    self.assertEqual(after['bytes'] - before['bytes'],
+                     os.path.getsize(os.path.join(self.out, 'a')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_garble_image.py
+
+garble and placehold of FBParser.garble_image, serial and in parallel.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+from FBParser.garble_image import garble, placehold
+# external imports
+import os
+import shutil
+import tempfile
+import unittest
+import Image
+
+
+class GarbleTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.images = []
+    for i, name in enumerate(['a.png', 'b.gif', 'c.jpg', 'd.bmp']):
+      self.images.append(os.path.join(self.dir, name))
+      Image.new('RGB', (20 + i, 10), (i * 80, 0, 0)).save(self.images[-1])
+    self.broken = os.path.join(self.dir, 'e.jpg')
+    f = open(self.broken, 'wb')
+    f.write('\xff\xd8 not really a JPEG')
+    f.close()
+    self.missing = os.path.join(self.dir, 'f.png')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  # @param workers(int)  processes garbling the images
+  def check_garble(self, workers):
+    images = self.images + [self.broken, self.missing]
+    original = open(self.images[0], 'rb').read()
+    # garbled images are new files, those they are hardlinked to stay
+    os.link(self.images[0], os.path.join(self.dir, 'link'))
+    # bad images are reported, not raised, and left out
+    self.assertEqual(sorted(garble(images, workers)), self.images[:3])
+    self.assertEqual(open(os.path.join(self.dir, 'link'), 'rb').read(),
+                     original)
+    for i, image in enumerate(self.images[:3]):
+      self.assertEqual(Image.open(image).size, (20 + i, 10))
+    self.assertNotEqual(open(self.images[0], 'rb').read(), original)
+    self.assertEqual(sorted(os.listdir(self.dir)),
+                     ['a.png', 'b.gif', 'c.jpg', 'd.bmp', 'e.jpg', 'link'])
+
+  def test_garbles_serially(self):
+    self.check_garble(1)
+
+  def test_garbles_in_parallel(self):
+    self.check_garble(3)
+
+  def test_placeholds(self):
+    left = [self.images[2], self.images[3], self.broken, self.missing]
+    placehold(left)
+    self.assertEqual(Image.open(self.images[2]).size, (22, 10))
+    self.assertEqual(Image.open(self.images[2]).format, 'JPEG')
+    self.assertEqual(Image.open(self.images[3]).size, (23, 10))
+    self.assertEqual(Image.open(self.broken).size, (1, 1))
+    self.assertEqual(Image.open(self.missing).format, 'PNG')
+    self.assertEqual(len(os.listdir(self.dir)), 6)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_jsonify.py
+
+jsonify, dejsonify and their streaming versions on escape-heavy strings.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+from FBParser import jsonify, dejsonify, stream_jsonify, stream_dejsonify
+# external imports
+import random
+import unittest
+
+ALPHABET = u'\\/\'"\r\nrnab \xe9\u4e2d'  # every escape, what follows them
+ESCAPED = {'\\': '\\', '/': '/', "'": "'", '"': '"', 'r': '\r', 'n': '\n'}
+
+
+# @param s(str)  string to be JSON-ified
+# @return (str)  s escaped by a replace per char, backslash first
+def chained_jsonify(s):
+  s = s.replace('\\', '\\\\')
+  s = s.replace('/', '\\/')
+  s = s.replace("'", "\\'")
+  s = s.replace('"', '\\"')
+  s = s.replace('\r', '\\r')
+  s = s.replace('\n', '\\n')
+  return s
+
+
+# @param s(str)  JSON-ified string
+# @return (str)  s decoded one char at a time, other backslashes left alone
+def scanned_dejsonify(s):
+  out = []
+  i = 0
+  while i < len(s):
+    if s[i] == '\\' and i + 1 < len(s) and s[i + 1] in ESCAPED:
+      out.append(ESCAPED[s[i + 1]])
+      i += 2
+    else:
+      out.append(s[i])
+      i += 1
+  return ''.join(out)
+
+
+# @param s(str)  string to be cut
+# @param cuts(list)  positions of the cuts, in order
+# @return (list)  chunks of s
+def split(s, cuts):
+  cuts = [0] + list(cuts) + [len(s)]
+  return [s[start:end] for start, end in zip(cuts, cuts[1:])]
+
+
+class JsonifyTest(unittest.TestCase):
+
+  def setUp(self):
+    rand = random.Random(25)
+    self.strings = [u'', u'\\', u'\\\\', u'\\\\\\', u'\\n', u'\\\\n',
+                    u'a\\', u'\\\\\\n\\']
+    for n in range(500):
+      self.strings.append(u''.join(rand.choice(ALPHABET)
+                                   for i in range(rand.randint(1, 24))))
+
+  def test_escapes_like_the_chained_replaces(self):
+    for s in self.strings:
+      self.assertEqual(jsonify(s), chained_jsonify(s))
+      self.assertEqual(jsonify(s.encode('utf-8')),
+                       chained_jsonify(s.encode('utf-8')))
+
+  def test_round_trips(self):
+    for s in self.strings:
+      self.assertEqual(dejsonify(jsonify(s)), s, repr(s))
+
+  def test_unescapes_in_one_pass(self):
+    for s in self.strings:
+      self.assertEqual(dejsonify(s), scanned_dejsonify(s), repr(s))
+    # an escaped backslash does not escape what follows it
+    self.assertEqual(dejsonify('\\\\n'), '\\n')
+    self.assertEqual(dejsonify('\\\\\\n'), '\\\n')
+    # other backslashes, dangling ones included, are left alone
+    self.assertEqual(dejsonify('\\x\\'), '\\x\\')
+
+  def test_streams_every_split(self):
+    for s in self.strings:
+      escaped = jsonify(s)
+      for cut in range(len(s) + 1):
+        self.assertEqual(''.join(stream_jsonify(split(s, [cut]))), escaped)
+      for cut in range(len(escaped) + 1):
+        chunks = split(escaped, [cut])
+        self.assertEqual(''.join(stream_dejsonify(chunks)), s,
+                         repr(chunks))
+
+  def test_streams_splits_in_backslash_runs(self):
+    for s in self.strings:
+      expected = dejsonify(s)
+      for first in range(len(s) + 1):
+        for second in range(first, len(s) + 1):
+          chunks = split(s, [first, second])
+          self.assertEqual(''.join(stream_dejsonify(chunks)), expected,
+                           repr(chunks))
+      # a char at a time, with empty chunks in between
+      chunks = [c for char in s for c in (char, u'')]
+      self.assertEqual(''.join(stream_dejsonify(chunks)), expected)
+      self.assertEqual(''.join(stream_jsonify(chunks)), jsonify(s))
+
+  def test_streams_dangling_backslash(self):
+    self.assertEqual(list(stream_dejsonify(['a\\'])), ['a', '\\'])
+    self.assertEqual(''.join(stream_dejsonify(['a\\', '\\', '\\'])), 'a\\\\')
+    self.assertEqual(list(stream_dejsonify([])), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
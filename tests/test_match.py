@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_match.py
+
+ElementTree, SelectorMatcher and prune_sheet of FBParser.match.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+from FBParser.match import ElementTree, SelectorMatcher
+from FBParser.match import parse_sheet, sheet_selectors, prune_sheet
+# external imports
+import unittest
+
+
+# @param dom(str)  a page
+# @param selectors(list)  selectors to be matched against it
+# @return (set)  those matching at least one of its elements
+def match(dom, selectors):
+  return SelectorMatcher(ElementTree(dom)).match(selectors)
+
+
+class MatchTest(unittest.TestCase):
+
+  # @param dom(str)  a page
+  # @param hits(list)  selectors matching one of its elements
+  # @param misses(list)  selectors matching none of them
+  def assertMatches(self, dom, hits, misses=()):
+    self.assertEqual(match(dom, list(hits) + list(misses)), set(hits))
+
+  def test_optional_end_tags(self):
+    self.assertMatches(
+      '<ul><li class="x">1<li class="y">2</ul><p>t<p>u',
+      ['li + li', 'li.x ~ li.y', 'p + p', 'html body ul > li.y',
+       'li:nth-child(2)', 'ul + p', 'html > body > p:last-child'],
+      ['li li', 'p p', 'li > li', 'li:only-child', 'ul p'])
+    self.assertMatches(
+      '<dl><dt>a<dd>b<dt>c</dl><p>a<div>b</div>'
+      '<select><option>a<option>b<optgroup><option>c</select>',
+      ['dd + dt', 'dt:first-child', 'p + div', 'option + option',
+       'optgroup > option', 'option + optgroup'],
+      ['dt dd', 'p div', 'option option', 'optgroup + option'])
+    # a p isn't ended by inline elements, nor from within a button
+    self.assertMatches('<p><span>a</span><button><div>b</div></button>',
+                       ['p > span', 'p > button > div'], ['p + div'])
+
+  def test_tables(self):
+    self.assertMatches(
+      '<table><tr><td>1<td class="b">2<tr><th>3</table>',
+      ['table > tbody > tr + tr', 'td + td.b', 'tr > th:only-child',
+       'tbody > tr:nth-child(2)'],
+      ['table > tr', 'td td', 'tr tr', 'td + th'])
+    # a nested table doesn't end the cells of the outer one
+    self.assertMatches(
+      '<table><tr><td><table><tr><td>1</table><td class="b">2</table>',
+      ['td > table', 'td + td.b'], ['td td.b'])
+
+  def test_head_and_body(self):
+    self.assertMatches(
+      '<title>t</title><link rel="x"><div>a</div>',
+      [':root > head > title + link', 'html > body > div', 'head + body'],
+      ['head div', 'body link', 'body + head'])
+    # attributes of a second html/body tag are those of the first one
+    self.assertMatches(
+      '<html class="a"><head></head><body><body class="b">'
+      '<div id="x"></div></body></html><script></script>',
+      ['.a .b #x', 'html.a > body.b > div', 'div + script'],
+      ['html > script', 'head div'])
+
+  def test_compounds(self):
+    self.assertMatches(
+      '<div id="nav" class="uiList big" role="Menu" lang="en-US">'
+      '<a href="http://x.com/a.html" title="a b">x</a></div>',
+      ['#nav.uiList.big', 'div[role=menu]', '[lang|=en]', 'a[title~=b]',
+       'a[href^="http://"]', 'a[href$=".html"]', 'a[href*=x]',
+       'div:not(.small) > a', 'a:hover', 'a::before', 'div a:visited'],
+      ['#nav.small', '#nav#other', 'div[title]', '[lang|=fr]',
+       'a[title~=c]', 'div:not(.big)', 'span:hover', 'a > div'])
+
+  def test_not_understood_matches(self):
+    self.assertMatches('<div></div>',
+                       ['svg|rect', 'div\\:x', 'div:nth-child(foo)'],
+                       ['span'])
+
+  def test_script_content_is_no_markup(self):
+    self.assertMatches(
+      '<i></i><script>document.write("<li class=\\"x\\"></li>")</script>'
+      '<b></b>',
+      ['i + script + b', 'head + body'], ['li', '.x'])
+
+
+class PruneSheetTest(unittest.TestCase):
+
+  # @param dom(str)  a page
+  # @param css(str)  a style sheet
+  # @return (dict)  as returned by prune_sheet
+  def prune(self, dom, css):
+    rules = parse_sheet(css)
+    return prune_sheet(css, rules, match(dom, sheet_selectors(css, rules)))
+
+  def test_keeps_what_matches(self):
+    ret = self.prune(
+      '<ul><li class="x">1<li>2</ul>',
+      'li + li { color: red }\n'
+      'li li, .y, li.x { margin: 0 }\n'
+      '.y { color: blue }\n'
+      '@media print { .y { x: 1 } li { x: 2 } }\n'
+      '@media screen { .z { x: 3 } }\n'
+      '@font-face { font-family: f }\n')
+    self.assertEqual(
+      ret['css'],
+      'li + li { color: red }\n'
+      'li.x { margin: 0 }\n'
+      '@media print { li { x: 2 } }\n'
+      '@font-face { font-family: f }\n')
+    self.assertEqual((ret['rules'], ret['rules_kept']), (6, 3))
+    self.assertEqual((ret['selectors'], ret['selectors_kept']), (8, 3))
+    self.assertEqual(ret['bytes_kept'], len(ret['css']))
+
+  def test_keeps_strings_and_comments(self):
+    css = ('/* a } comment */ a[title="{;}"]::after { content: "}" }\n'
+           '.gone { content: "{" }')
+    ret = self.prune('<a title="{;}"></a>', css)
+    self.assertEqual(ret['css'], css[:css.index('.gone')])
+
+
+if __name__ == '__main__':
+  unittest.main()
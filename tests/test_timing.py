@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+__doc__ = '''
+tests/test_timing.py
+
+StageProfile of FBParser.timing, with stages run from within others.
+'''
+__author__ = 'Yao Yue(yyue), yueyao@facebook.com'
+
+#
+# Imports
+#
+from FBParser.timing import StageProfile, rollup
+# external imports
+import unittest
+
+
+class StageProfileTest(unittest.TestCase):
+
+  def test_nested_stages(self):
+    profile = StageProfile('page')
+    def outer(s):
+      profile.run('inner_a', lambda s: s + 'a', s)
+      profile.run('inner_b', lambda s: s + 'bb', s)
+      return s * 2
+    self.assertEqual(profile.run('outer', outer, 'xyz'), 'xyzxyz')
+    profile.run('last', lambda s: s, 'x')
+    report = profile.report()
+    self.assertEqual([(entry['stage'], entry.get('within'))
+                      for entry in report['stages']],
+                     [('outer', None), ('inner_a', 'outer'),
+                      ('inner_b', 'outer'), ('last', None)])
+    self.assertEqual(report['stages'][2]['bytes_out'], 5)
+    # the inner stages are in the outer one's figures already
+    self.assertEqual(report['total']['bytes_out'], 7)
+    self.assertEqual(list(rollup([report]).keys()),
+                     ['outer', 'inner_a', 'inner_b', 'last', 'total'])
+
+  def test_counts_bytes(self):
+    profile = StageProfile()
+    profile.run('stage', lambda s, d: [s, 'ab'], u'\xe9\u4e2dx',
+                {'k': u'\xe9', 'n': 1})
+    entry = profile.report()['stages'][0]
+    self.assertEqual((entry['bytes_in'], entry['bytes_out']), (8, 8))
+
+  def test_failed_stage(self):
+    profile = StageProfile()
+    def fail():
+      profile.run('inner', lambda: 'x')
+      raise ValueError()
+    self.assertRaises(ValueError, profile.run, 'outer', fail)
+    profile.run('next', lambda: 'y')
+    self.assertEqual([(entry['stage'], entry.get('within'))
+                      for entry in profile.report()['stages']],
+                     [('inner', 'outer'), ('next', None)])
+
+
+if __name__ == '__main__':
+  unittest.main()